@@ -0,0 +1,106 @@
+"""
+Module that writes android packages with aligned entries
+"""
+
+import os
+import zipfile
+
+# Alignment of the data of uncompressed entries, as zipalign 4
+ALIGNMENT = 4
+
+# Size of the local file header without file name and extra field
+LOCAL_HEADER_SIZE = 30
+
+# Fixed timestamp so the same contents give the same package
+DEFAULT_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+class ApkWriter():
+    """
+    Class that writes an android package in one pass, padding the local header
+    of each uncompressed entry so its data starts 4-byte aligned
+    """
+    def __init__(self, path=None, alignment=ALIGNMENT):
+        self.path = path
+        self.alignment = alignment
+        self.tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        self._zf = zipfile.ZipFile(self.tmp_path, 'w')
+        self._names = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _pad(self, zinfo):
+        if zinfo.compress_type != zipfile.ZIP_STORED:
+            return
+        offset = self._zf.fp.tell() + LOCAL_HEADER_SIZE + \
+            len(zinfo.filename) + len(zinfo.extra)
+        padding = (self.alignment - offset % self.alignment) % self.alignment
+        zinfo.extra += '\0' * padding
+
+    def has_entry(self, name):
+        return name in self._names
+
+    def add(self, name, data, compress_type=zipfile.ZIP_DEFLATED,
+            date_time=DEFAULT_DATE_TIME):
+        """ Adds an entry with the given contents """
+        zinfo = zipfile.ZipInfo(name, date_time)
+        zinfo.compress_type = compress_type
+        zinfo.external_attr = 0644 << 16L
+        self._pad(zinfo)
+        self._zf.writestr(zinfo, data)
+        self._names.add(name)
+        self.on_entry(zinfo, data)
+
+    def add_file(self, name, fpath, compress_type=zipfile.ZIP_DEFLATED):
+        with open(fpath, 'rb') as _f:
+            self.add(name, _f.read(), compress_type)
+
+    def add_archive(self, fpath, exclude=None):
+        """ Copies the entries of another archive keeping their compression """
+        with zipfile.ZipFile(fpath, 'r') as src:
+            for _info in src.infolist():
+                if _info.filename.endswith('/') or \
+                        (exclude and exclude(_info.filename)):
+                    continue
+                self.add(_info.filename,
+                         src.read(_info.filename),
+                         _info.compress_type,
+                         _info.date_time)
+
+    def on_entry(self, zinfo, data):
+        """ Called for every entry once it is written """
+        pass
+
+    def on_close(self):
+        """ Called before the central directory is written """
+        pass
+
+    def close(self):
+        self.on_close()
+        self._zf.close()
+        os.rename(self.tmp_path, self.path)
+
+    def abort(self):
+        self._zf.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+# Writes a package with the packaged resources and the DEX executable
+def write_apk(apk_path, resources_apk, classes_dex, writer_class=ApkWriter, **kwargs):
+    with writer_class(apk_path, **kwargs) as writer:
+        writer.add_archive(resources_apk,
+                           exclude=lambda _n: _n == 'classes.dex')
+        writer.add_file('classes.dex', classes_dex)
+    return True
+
+# Rewrites a package aligning its uncompressed entries, like zipalign 4
+def align_apk(src_path, dst_path):
+    with ApkWriter(dst_path) as writer:
+        writer.add_archive(src_path)
+    return True
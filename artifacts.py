@@ -0,0 +1,313 @@
+"""
+Module that keeps the outputs of build actions in a cache shared by every project
+and checkout of the workspace, evicting the least recently used ones
+"""
+
+import os
+import time
+import errno
+import shutil
+import hashlib
+import logging
+import threading
+from fingerprint import get_stat_signature
+from utils import BuildSetup, create_dir
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Setting logger
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+fmt = logging.Formatter(datefmt="%H:%M:%S",
+                        fmt='%(asctime)s %(levelname)-8s: %(name)s: %(message)s')
+sh = logging.StreamHandler()
+sh.setFormatter(fmt)
+log.addHandler(sh)
+
+# Directory of the cache under cache_path
+ARTIFACTS_DIR = 'artifacts'
+
+# Name of the database of the cache entries
+DB_FILENAME = 'artifacts.db'
+
+# Byte budget unless "artifact_cache_size" is set up
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+# Stands for the project path in the action keys, so checkouts share entries
+PROJECT_VAR = '$PROJECT'
+
+# ioctl cloning a file on copy-on-write file systems (btrfs, xfs)
+FICLONE = 0x40049409
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS entries ('
+    ' key TEXT NOT NULL PRIMARY KEY,'
+    ' stage TEXT NOT NULL,'
+    ' size INTEGER NOT NULL,'
+    ' files INTEGER NOT NULL,'
+    ' created_at REAL NOT NULL,'
+    ' used_at REAL NOT NULL,'
+    ' hits INTEGER NOT NULL DEFAULT 0)',
+    'CREATE INDEX IF NOT EXISTS entries_used_at ON entries (used_at)',
+    'CREATE TABLE IF NOT EXISTS counters ('
+    ' name TEXT NOT NULL PRIMARY KEY,'
+    ' value INTEGER NOT NULL)',
+]
+
+COUNTERS = ['hits', 'misses', 'stores', 'evictions']
+
+# {cache path: ArtifactCache}
+_caches = {}
+_caches_lock = threading.Lock()
+
+def _reflink(src, dst):
+    with open(src, 'rb') as _src:
+        with open(dst, 'wb') as _dst:
+            fcntl.ioctl(_dst.fileno(), FICLONE, _src.fileno())
+
+# Copies a file, sharing its blocks where the file system allows it
+def clone_file(src, dst):
+    if fcntl is not None:
+        try:
+            _reflink(src, dst)
+            return
+        except (IOError, OSError):
+            pass
+    shutil.copyfile(src, dst)
+
+# Restores a file from the cache: reflink, else hard link, else copy
+def restore_file(src, dst):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    create_dir(os.path.dirname(dst))
+    if fcntl is not None:
+        try:
+            _reflink(src, dst)
+            return
+        except (IOError, OSError):
+            if os.path.exists(dst):
+                os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+# Gives the file its own inode again if it is hard linked with the cache,
+# so a tool rewriting it in place doesn't corrupt the cached copy
+def unshare_file(fpath):
+    try:
+        if os.stat(fpath).st_nlink <= 1:
+            return
+    except OSError:
+        return
+    tmp = '%s.%d.unshare' % (fpath, os.getpid())
+    shutil.copy2(fpath, tmp)
+    os.rename(tmp, fpath)
+
+class ArtifactCache():
+    """
+    Class that stores the outputs of build actions by action key, a hash of the
+    inputs, tools and command lines of the action, and restores them on a hit.
+    The least recently used entries are evicted above the byte budget
+    """
+    def __init__(self, path=None, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes if max_bytes is not None else DEFAULT_MAX_BYTES
+        self.entries_path = os.path.join(path, 'entries')
+        self._lock = threading.RLock()
+        create_dir(self.entries_path)
+        # Several builds share the database, timeout waits for their writes
+        self._db = sqlite3.connect(os.path.join(path, DB_FILENAME),
+                                   timeout=60, check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        with self._db:
+            for _statement in SCHEMA:
+                self._db.execute(_statement)
+
+    def _get_entry_path(self, key):
+        return os.path.join(self.entries_path, key[:2], key)
+
+    def _count(self, name, value=1):
+        self._db.execute('INSERT OR IGNORE INTO counters VALUES (?, 0)', (name,))
+        self._db.execute('UPDATE counters SET value = value + ? WHERE name = ?', (value, name))
+
+    def get_action_key(self, stage=None, steps=None, project_path=None, inputs=None):
+        """ Returns the key of an action: its stage, command lines with the tools and
+        files outside of the project they use, and its inputs [(path, digest), ...] """
+        hasher = hashlib.sha1()
+        hasher.update('%s\n' % (stage))
+        project_path = os.path.join(project_path, '')
+        for _step in steps:
+            for _arg in _step:
+                hasher.update('%s\0' % (_arg.replace(project_path, PROJECT_VAR + os.sep)))
+                # Tools, SDK jars, keystores... changing under the same path
+                for _f in _arg.split(os.pathsep):
+                    if _f.startswith(os.sep) and not _f.startswith(project_path) and \
+                            os.path.isfile(_f):
+                        hasher.update('%s\0' % (get_stat_signature(_f),))
+            hasher.update('\n')
+        for _path, _digest in sorted(inputs if inputs else []):
+            hasher.update('%s\0%s\n' % (os.path.relpath(_path, project_path), _digest))
+        return hasher.hexdigest()
+
+    def restore(self, key=None, project_path=None):
+        """ Links the outputs of the action into the project, returns True on a hit """
+        entry_path = self._get_entry_path(key)
+        with self._lock:
+            with self._db:
+                row = self._db.execute('SELECT files FROM entries WHERE key = ?',
+                                       (key,)).fetchone()
+                if row is None or not os.path.isdir(entry_path):
+                    self._count('misses')
+                    return False
+        try:
+            restored = 0
+            for _root, _dirs, _files in os.walk(entry_path):
+                for _f in _files:
+                    src = os.path.join(_root, _f)
+                    restore_file(src, os.path.join(project_path,
+                                                   os.path.relpath(src, entry_path)))
+                    restored += 1
+        except (IOError, OSError) as e:
+            # Evicted meanwhile by another build
+            log.warn('Unable to restore "%s" from the artifact cache: %s' % (key, e))
+            restored = -1
+        with self._lock:
+            with self._db:
+                if restored != row[0]:
+                    self._count('misses')
+                    return False
+                self._db.execute('UPDATE entries SET used_at = ?, hits = hits + 1 WHERE key = ?',
+                                 (time.time(), key))
+                self._count('hits')
+        return True
+
+    def store(self, key=None, stage=None, project_path=None, files=None):
+        """ Copies the outputs of the action into the cache """
+        entry_path = self._get_entry_path(key)
+        if os.path.isdir(entry_path) or not files:
+            return True
+        size = sum([os.path.getsize(_f) for _f in files])
+        if size > self.max_bytes:
+            log.debug('Outputs of "%s" do not fit in the artifact cache' % (stage))
+            return False
+        tmp = '%s.%d.%d.tmp' % (entry_path, os.getpid(), threading.current_thread().ident)
+        try:
+            for _f in files:
+                dst = os.path.join(tmp, os.path.relpath(_f, project_path))
+                create_dir(os.path.dirname(dst))
+                clone_file(_f, dst)
+            os.rename(tmp, entry_path)
+        except OSError as e:
+            shutil.rmtree(tmp, ignore_errors=True)
+            # Stored meanwhile by another build
+            if e.errno in (errno.EEXIST, errno.ENOTEMPTY):
+                return True
+            log.warn('Unable to store the outputs of "%s": %s' % (stage, e))
+            return False
+        now = time.time()
+        with self._lock:
+            with self._db:
+                self._db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, 0)',
+                                 (key, stage, size, len(files), now, now))
+                self._count('stores')
+            self.evict()
+        return True
+
+    def evict(self, max_bytes=None):
+        """ Removes the least recently used entries until the cache fits in the budget """
+        max_bytes = max_bytes if max_bytes is not None else self.max_bytes
+        evicted = 0
+        with self._lock:
+            total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            if total <= max_bytes:
+                return 0
+            cursor = self._db.execute('SELECT key, size FROM entries ORDER BY used_at')
+            victims = []
+            for _key, _size in cursor.fetchall():
+                if total <= max_bytes:
+                    break
+                victims.append(_key)
+                total -= _size
+            with self._db:
+                for _key in victims:
+                    self._db.execute('DELETE FROM entries WHERE key = ?', (_key,))
+                self._count('evictions', len(victims))
+            for _key in victims:
+                shutil.rmtree(self._get_entry_path(_key), ignore_errors=True)
+                evicted += 1
+        return evicted
+
+    def get_stats(self):
+        """ Returns {counter or total: value} and [(stage, entries, bytes, hits), ...] """
+        with self._lock:
+            stats = dict([(_c, 0) for _c in COUNTERS])
+            stats.update(dict(self._db.execute('SELECT name, value FROM counters').fetchall()))
+            stats['entries'], stats['bytes'] = self._db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+            stats['max_bytes'] = self.max_bytes
+            stages = self._db.execute('SELECT stage, COUNT(*), SUM(size), SUM(hits) FROM entries '
+                                      'GROUP BY stage ORDER BY SUM(size) DESC').fetchall()
+        return stats, stages
+
+# Returns the artifact cache of the workspace, None if disabled
+def get_artifact_cache():
+    if sqlite3 is None:
+        return None
+    bs = BuildSetup()
+    max_bytes = bs.get_artifact_cache_size()
+    if not bs.get_cache_path() or max_bytes == 0:
+        return None
+    path = os.path.join(bs.get_cache_path(), ARTIFACTS_DIR)
+    with _caches_lock:
+        if not _caches.has_key(path) or not os.path.isdir(path):
+            _caches[path] = ArtifactCache(path, max_bytes)
+        elif max_bytes is not None:
+            _caches[path].max_bytes = max_bytes
+        return _caches[path]
+
+# Closes the databases of the artifact caches, i.e. before forking,
+# they are opened again on the next use
+def close_caches():
+    with _caches_lock:
+        for _cache in _caches.values():
+            with _cache._lock:
+                _cache._db.close()
+        _caches.clear()
+
+def _format_size(size):
+    for _unit in ['B', 'KB', 'MB']:
+        if size < 1024:
+            return '%.1f%s' % (size, _unit)
+        size /= 1024.0
+    return '%.1fGB' % (size)
+
+# Logs the usage of the artifact cache, returns False if it is disabled
+def print_cache_stats():
+    cache = get_artifact_cache()
+    if cache is None:
+        log.warn('The artifact cache is disabled')
+        return False
+    stats, stages = cache.get_stats()
+    lookups = stats['hits'] + stats['misses']
+    log.info('Artifact cache "%s":' % (cache.path))
+    log.info('\t%d entries, %s of %s' % (stats['entries'],
+                                         _format_size(stats['bytes']),
+                                         _format_size(stats['max_bytes'])))
+    log.info('\t%d hits, %d misses (%.1f%% hit rate)' % (stats['hits'], stats['misses'],
+                                                        100.0 * stats['hits'] / lookups if lookups else 0))
+    log.info('\t%d stores, %d evictions' % (stats['stores'], stats['evictions']))
+    for _stage, _entries, _size, _hits in stages:
+        log.info('\t%-10s %5d entries %10s %6d hits' % (_stage, _entries, _format_size(_size), _hits))
+    return True
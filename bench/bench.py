@@ -0,0 +1,224 @@
+#! /usr/bin/env python
+"""
+Module that benchmarks UBS builds of a synthetic project with a stub toolchain
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+from generate import generate_workspace
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+UBS = os.path.join(os.path.dirname(BENCH_DIR), 'ubs.py')
+
+PROJECT = 'Bench0'
+
+SCENARIOS = ['cold', 'no-op', 'edit', 'resource', 'replace', 'touch']
+
+# Trace categories reported as UBS bookkeeping
+BOOKKEEPING = ['scan', 'fingerprint', 'meta']
+
+def _get_files(dirpath, ext):
+    list_fs = []
+    for _root, _dirs, _files in os.walk(dirpath):
+        list_fs.extend([os.path.join(_root, _f) for _f in _files if _f.endswith(ext)])
+    return sorted(list_fs)
+
+def _bump(fpath, revision):
+    with open(fpath) as _f:
+        data = _f.read()
+    start = data.index('revision ') + len('revision ')
+    end = start
+    while data[end].isdigit():
+        end += 1
+    with open(fpath, 'w') as _f:
+        _f.write(data[:start] + '%d' % (revision) + data[end:])
+
+class Bench():
+    """
+    Class that runs the build scenarios on a generated workspace and reports
+    UBS bookkeeping apart from the time spent in the tools
+    """
+    def __init__(self, root=None, setup_file=None, latency=0.0, startup=0.0):
+        self.root = root
+        self.setup_file = setup_file
+        self.workspace = os.path.join(root, 'workspace')
+        self.project_path = os.path.join(self.workspace, PROJECT)
+        self.env = os.environ.copy()
+        self.env['UBS_SETUP_FILE'] = setup_file
+        self.env['UBS_STUB_LATENCY'] = '%s' % (latency)
+        self.env['UBS_STUB_STARTUP'] = '%s' % (startup)
+        self.env['JAVA_HOME'] = os.path.join(root, 'tools')
+        self.env['ANDROID_HOME'] = os.path.join(root, 'tools')
+        self.revision = 0
+
+    def _clean(self):
+        for _dir in ['bin', 'obj', 'gen']:
+            shutil.rmtree(os.path.join(self.project_path, _dir), ignore_errors=True)
+        for _f in os.listdir(self.project_path):
+            if _f.startswith('meta.'):
+                os.remove(os.path.join(self.project_path, _f))
+        shutil.rmtree(os.path.join(self.workspace, '.ubs-cache'), ignore_errors=True)
+
+    def _edit_source(self):
+        self.revision += 1
+        sources = _get_files(os.path.join(self.project_path, 'src'), '.java')
+        _bump([_s for _s in sources if 'Class' in _s][0], self.revision)
+
+    def _edit_resource(self):
+        layout = _get_files(os.path.join(self.project_path, 'res'), '.xml')[0]
+        with open(layout, 'a') as _f:
+            _f.write('<!-- edit -->\n')
+
+    def _replace_resource(self):
+        # Like editors saving to a new file renamed over the old one
+        self.revision += 1
+        layout = _get_files(os.path.join(self.project_path, 'res'), '.xml')[0]
+        with open(layout) as _f:
+            data = _f.read()
+        tmp = '%s.tmp' % (layout)
+        with open(tmp, 'w') as _f:
+            _f.write(data + '<!-- replaced %d -->\n' % (self.revision))
+        os.rename(tmp, layout)
+
+    def check_mirror(self):
+        """ Raises if the resources mirrored for packaging differ from res/ """
+        res_path = os.path.join(self.project_path, 'res')
+        mirror_path = os.path.join(self.project_path, 'bin', 'res')
+        if not os.path.isdir(mirror_path):
+            return
+        for _src in _get_files(res_path, '.xml'):
+            dst = os.path.join(mirror_path, os.path.relpath(_src, res_path))
+            with open(_src) as _f:
+                data = _f.read()
+            with open(dst) as _f:
+                if _f.read() != data:
+                    raise RuntimeError('Stale mirrored resource "%s"' % (dst))
+
+    def _touch(self):
+        now = time.time()
+        for _dir in ['src', 'res', 'libs']:
+            for _f in _get_files(os.path.join(self.project_path, _dir), ''):
+                os.utime(_f, (now, now))
+
+    def prepare(self, scenario):
+        if scenario == 'cold':
+            self._clean()
+        elif scenario == 'edit':
+            self._edit_source()
+        elif scenario == 'resource':
+            self._edit_resource()
+        elif scenario == 'replace':
+            self._replace_resource()
+        elif scenario == 'touch':
+            self._touch()
+
+    def build(self, trace_path):
+        """ Packages the project, returns (wall time, trace events) """
+        start = time.time()
+        with open(os.devnull, 'w') as devnull:
+            rc = subprocess.call([sys.executable, UBS, '--package', PROJECT,
+                                  '--no-daemon', '--trace', trace_path],
+                                 env=self.env, stdout=devnull, stderr=devnull)
+        wall = time.time() - start
+        if rc != 0:
+            raise RuntimeError('Build failed with exit status %d' % (rc))
+        with open(trace_path) as _f:
+            return wall, json.load(_f)['traceEvents']
+
+    def run(self, scenarios=None, rounds=3):
+        """ Returns {scenario: [measures, ...]} """
+        results = dict([(_s, []) for _s in scenarios])
+        trace_path = os.path.join(self.root, 'trace.json')
+        for _r in xrange(rounds):
+            for _s in scenarios:
+                self.prepare(_s)
+                wall, events = self.build(trace_path)
+                self.check_mirror()
+                results[_s].append(analyze(wall, events))
+        return results
+
+# Returns the total length of the union of (start, end) intervals
+def _union(intervals):
+    total = 0
+    last_end = None
+    for _start, _end in sorted(intervals):
+        if last_end is None or _start > last_end:
+            total += _end - _start
+            last_end = _end
+        elif _end > last_end:
+            total += _end - last_end
+            last_end = _end
+    return total
+
+# Splits the wall time of a build into interpreter startup, tools and UBS bookkeeping
+def analyze(wall, events):
+    spans = [_e for _e in events if _e.get('ph') == 'X']
+    ubs = [_e for _e in spans if _e['cat'] == 'ubs']
+    build = ubs[0]['dur'] / 1000000.0 if ubs else wall
+    commands = [(_e['ts'], _e['ts'] + _e['dur']) for _e in spans if _e['cat'] == 'command']
+    tools = _union(commands) / 1000000.0
+    measure = {'wall': wall,
+               'startup': wall - build,
+               'tools': tools,
+               'ubs': build - tools,
+               'commands': len(commands)}
+    for _cat in BOOKKEEPING:
+        measure[_cat] = sum([_e['dur'] for _e in spans if _e['cat'] == _cat]) / 1000000.0
+    return measure
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def print_report(results, scenarios):
+    columns = ['wall', 'startup', 'tools', 'ubs'] + BOOKKEEPING
+    print('%-10s %s %8s' % ('scenario', ' '.join(['%9s' % (_c) for _c in columns]), 'commands'))
+    for _s in scenarios:
+        measures = results[_s]
+        print('%-10s %s %8d' % (_s,
+                                ' '.join(['%8.1fms' % (_median([_m[_c] for _m in measures]) * 1000)
+                                          for _c in columns]),
+                                _median([_m['commands'] for _m in measures])))
+    print('\nMedians; "ubs" is the build time outside of the tools, '
+          '"%s" are the summed spans of that bookkeeping' % ('/'.join(BOOKKEEPING)))
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Benchmarks UBS on a synthetic project')
+    parser.add_argument('--root', help='Directory for the generated workspace (default: temporary)')
+    parser.add_argument('--sources', type=int, default=500)
+    parser.add_argument('--resources', type=int, default=100)
+    parser.add_argument('--jars', type=int, default=5)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds every stub tool sleeps')
+    parser.add_argument('--startup', type=float, default=0.0,
+                        help='Seconds every stub tool process sleeps once, as a JVM startup')
+    parser.add_argument('--workers', action='store_true',
+                        help='Runs javac, dx and jarsigner on stub workers')
+    parser.add_argument('--packaging-mode', choices=['tools', 'python'], default='tools')
+    parser.add_argument('--scenarios', nargs='*', choices=SCENARIOS, default=SCENARIOS)
+    return parser
+
+def main():
+    args = get_parser().parse_args()
+    root = os.path.abspath(args.root) if args.root else tempfile.mkdtemp(prefix='ubs-bench-')
+    try:
+        setup_file = generate_workspace(root, 1, args.sources, args.resources, args.jars,
+                                        args.packaging_mode, args.workers)
+        # Cold builds are always the first of a round
+        scenarios = ['cold'] + [_s for _s in args.scenarios if _s != 'cold']
+        results = Bench(root, setup_file, args.latency, args.startup).run(scenarios, args.rounds)
+        print_report(results, [_s for _s in scenarios if _s in args.scenarios])
+    finally:
+        if not args.root:
+            shutil.rmtree(root, ignore_errors=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,193 @@
+#! /usr/bin/env python
+"""
+Module that generates synthetic android projects and a stub toolchain for benchmarks
+"""
+
+import os
+import sys
+import stat
+import struct
+import zipfile
+import argparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Tools of the setup file and the stub standing for them
+STUB_TOOLS = ['aapt', 'javac', 'dx', 'java', 'jarsigner', 'zipalign', 'adb']
+
+# Sources per java package
+SOURCES_PER_PACKAGE = 50
+
+# Smallest valid PNG (1x1, gray)
+PNG = '\x89PNG\r\n\x1a\n' \
+    '\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x00\x00\x00\x00:~\x9bU' \
+    '\x00\x00\x00\nIDATx\x9cc`\x00\x00\x00\x02\x00\x01H\xaf\xa4q' \
+    '\x00\x00\x00\x00IEND\xaeB`\x82'
+
+MANIFEST = '''<?xml version="1.0" encoding="utf-8"?>
+<manifest xmlns:android="http://schemas.android.com/apk/res/android"
+    package="%(package)s" android:versionCode="1" android:versionName="1.0">
+    <application android:label="%(name)s">
+        <activity android:name="MainActivity">
+            <intent-filter>
+                <action android:name="android.intent.action.MAIN" />
+                <category android:name="android.intent.category.LAUNCHER" />
+            </intent-filter>
+        </activity>
+    </application>
+</manifest>
+'''
+
+SOURCE = '''package %(package)s;
+
+%(imports)s
+public class %(name)s {
+    // revision 0
+    public int value() {
+        return %(body)s;
+    }
+}
+'''
+
+LAYOUT = '''<?xml version="1.0" encoding="utf-8"?>
+<LinearLayout xmlns:android="http://schemas.android.com/apk/res/android"
+    android:layout_width="fill_parent" android:layout_height="fill_parent">
+    <TextView android:id="@+id/text_%(idx)d" android:text="layout %(idx)d" />
+</LinearLayout>
+'''
+
+SETUP = '''workspace_path=%(workspace)s
+author=bench
+java_home=%(tools)s
+android_home=%(tools)s
+android_jar=%(tools)s/android.jar
+aapt_bin=%(tools)s/aapt
+javac_bin=%(tools)s/javac
+dx_bin=%(tools)s/dx
+java_bin=%(tools)s/java
+jarsigner_bin=%(tools)s/jarsigner
+zipalign_bin=%(tools)s/zipalign
+adb_bin=%(tools)s/adb
+key_store=%(tools)s/bench.keystore
+key_alias=bench
+key_pass=bench
+store_pass=bench
+unsigned_prefix=unsigned
+signed_prefix=signed
+zipped_prefix=zipped
+emu_proc_name=ubs-bench-emulator
+activity_name=MainActivity
+packaging_mode=%(packaging_mode)s
+'''
+
+# Runs javac, dx and jarsigner on stub workers
+WORKERS_SETUP = '''workers=on
+javac_worker=%(tools)s/javac --worker
+dx_worker=%(tools)s/dx --worker
+jarsigner_worker=%(tools)s/jarsigner --worker
+'''
+
+def create_dir(dirpath):
+    if not os.path.isdir(dirpath):
+        os.makedirs(dirpath)
+
+def write_file(fpath, data):
+    create_dir(os.path.dirname(fpath))
+    with open(fpath, 'wb') as _f:
+        _f.write(data)
+
+def _get_class_name(idx):
+    return 'Class%d' % (idx)
+
+def _get_java_package(project_package, idx):
+    return '%s.p%d' % (project_package, idx // SOURCES_PER_PACKAGE)
+
+# Writes a project with the given number of sources, resources and library jars
+def generate_project(project_path, name, sources=100, resources=20, jars=2):
+    package = 'com.bench.%s' % (name.lower())
+    write_file(os.path.join(project_path, 'AndroidManifest.xml'),
+               MANIFEST % {'package': package, 'name': name})
+    write_file(os.path.join(project_path, 'src', *package.split('.')) + '/MainActivity.java',
+               SOURCE % {'package': package, 'imports': '', 'name': 'MainActivity', 'body': '0'})
+    for _i in xrange(sources):
+        java_package = _get_java_package(package, _i)
+        # Each class uses the previous one of its package and one of the previous package
+        refs = []
+        if _i % SOURCES_PER_PACKAGE:
+            refs.append((java_package, _get_class_name(_i - 1)))
+        if _i >= SOURCES_PER_PACKAGE:
+            refs.append((_get_java_package(package, _i - SOURCES_PER_PACKAGE),
+                         _get_class_name(_i - SOURCES_PER_PACKAGE)))
+        imports = ''.join(['import %s.%s;\n' % (_p, _c) for _p, _c in refs
+                           if _p != java_package])
+        body = ' + '.join(['new %s().value()' % (_c) for _p, _c in refs] + ['%d' % (_i)])
+        write_file(os.path.join(project_path, 'src', *java_package.split('.')) +
+                   '/%s.java' % (_get_class_name(_i)),
+                   SOURCE % {'package': java_package, 'imports': imports,
+                             'name': _get_class_name(_i), 'body': body})
+    for _i in xrange(resources):
+        # Half layouts, half drawables
+        if _i % 2:
+            write_file(os.path.join(project_path, 'res', 'drawable', 'image_%d.png' % (_i)), PNG)
+        else:
+            write_file(os.path.join(project_path, 'res', 'layout', 'layout_%d.xml' % (_i)),
+                       LAYOUT % {'idx': _i})
+    write_file(os.path.join(project_path, 'res', 'values', 'strings.xml'),
+               '<resources>\n    <string name="app_name">%s</string>\n</resources>\n' % (name))
+    for _i in xrange(jars):
+        jar = os.path.join(project_path, 'libs', 'lib%d.jar' % (_i))
+        create_dir(os.path.dirname(jar))
+        with zipfile.ZipFile(jar, 'w') as zf:
+            for _j in xrange(10):
+                zf.writestr('com/lib%d/Util%d.class' % (_i, _j),
+                            struct.pack('>I', 0xCAFEBABE) + 'lib%d.%d' % (_i, _j))
+    return project_path
+
+# Writes the stub toolchain, one wrapper per tool running stubtool.py
+def generate_tools(tools_path, python=None):
+    python = python if python else sys.executable
+    stub = os.path.join(BENCH_DIR, 'stubtool.py')
+    for _tool in STUB_TOOLS:
+        wrapper = os.path.join(tools_path, _tool)
+        write_file(wrapper, '#!/bin/sh\nexec "%s" "%s" %s "$@"\n' % (python, stub, _tool))
+        os.chmod(wrapper, os.stat(wrapper).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    # DexMerger is looked for next to dx
+    write_file(os.path.join(tools_path, 'lib', 'dx.jar'), '')
+    write_file(os.path.join(tools_path, 'android.jar'), '')
+    write_file(os.path.join(tools_path, 'bench.keystore'), '')
+    return tools_path
+
+# Writes a workspace with its projects, the stub toolchain and its setup file.
+# Returns the path of the setup file, to be given in UBS_SETUP_FILE
+def generate_workspace(root, projects=1, sources=100, resources=20, jars=2,
+                       packaging_mode='tools', workers=False):
+    root = os.path.abspath(root)
+    workspace = os.path.join(root, 'workspace')
+    tools = generate_tools(os.path.join(root, 'tools'))
+    for _i in xrange(projects):
+        name = 'Bench%d' % (_i)
+        generate_project(os.path.join(workspace, name), name, sources, resources, jars)
+    setup_file = os.path.join(root, 'setup.properties')
+    setup = SETUP + (WORKERS_SETUP if workers else '')
+    write_file(setup_file, setup % {'workspace': workspace,
+                                    'tools': tools,
+                                    'packaging_mode': packaging_mode})
+    return setup_file
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Generates a benchmark workspace')
+    parser.add_argument('root', help='Directory of the workspace, tools and setup file')
+    parser.add_argument('--projects', type=int, default=1)
+    parser.add_argument('--sources', type=int, default=100)
+    parser.add_argument('--resources', type=int, default=20)
+    parser.add_argument('--jars', type=int, default=2)
+    parser.add_argument('--packaging-mode', choices=['tools', 'python'], default='tools')
+    parser.add_argument('--workers', action='store_true',
+                        help='Runs javac, dx and jarsigner on stub workers')
+    return parser
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    print('UBS_SETUP_FILE=%s' % (generate_workspace(args.root, args.projects, args.sources,
+                                                    args.resources, args.jars,
+                                                    args.packaging_mode, args.workers)))
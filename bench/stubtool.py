@@ -0,0 +1,253 @@
+#! /usr/bin/env python
+"""
+Module that stands for aapt, javac, dx, java, jarsigner, zipalign and adb in benchmarks.
+
+It is run under the name of each tool (or given it as first argument) and writes plausible outputs after
+sleeping UBS_STUB_LATENCY seconds (or UBS_STUB_<TOOL>_LATENCY for one tool). UBS_STUB_STARTUP seconds
+stand for the startup of the JVM, paid once by "--worker" which serves requests like worker/UbsWorker.java.
+UBS_STUB_WORKER_EXIT makes the worker exit on its next request instead of answering it, like a tool calling
+System.exit() does
+"""
+
+import os
+import re
+import sys
+import time
+import shutil
+import struct
+import hashlib
+import zipfile
+import cStringIO
+
+CLASS_MAGIC = 0xCAFEBABE
+
+_package_re = re.compile(r'^\s*package\s+([\w.]+)\s*;', re.M)
+_import_re = re.compile(r'^\s*import\s+([\w.]+)\s*;', re.M)
+_name_re = re.compile(r'\b([A-Z]\w*)\b')
+_constant_re = re.compile(r'\bstatic\s+final\s+int\s+(\w+)\s*=\s*(\d+)\s*;')
+
+def create_dir(dirpath):
+    if dirpath and not os.path.isdir(dirpath):
+        os.makedirs(dirpath)
+
+def get_opt(args, opt, default=None):
+    return args[args.index(opt) + 1] if opt in args else default
+
+# Expands "@argfile" arguments like javac does
+def expand_args(args):
+    expanded = []
+    for _a in args:
+        if _a.startswith('@') and os.path.isfile(_a[1:]):
+            with open(_a[1:]) as _f:
+                expanded.extend([_l.strip().strip('"') for _l in _f if _l.strip()])
+        else:
+            expanded.append(_a)
+    return expanded
+
+# Returns a class file for the given class, referencing the given classes and
+# declaring the given int constants [(name, value), ...]
+def make_class(name, refs, source_file, constants=()):
+    pool = []
+    def add(entry):
+        pool.append(entry)
+        return len(pool)
+    def utf8(value):
+        return add(struct.pack('>BH', 1, len(value)) + value)
+    def klass(value):
+        return add(struct.pack('>BH', 7, utf8(value)))
+    this_class = klass(name)
+    super_class = klass('java/lang/Object')
+    for _r in sorted(refs):
+        klass(_r)
+    source_attr = utf8('SourceFile')
+    source_idx = utf8(source_file)
+    fields = []
+    if constants:
+        constant_attr = utf8('ConstantValue')
+        descriptor = utf8('I')
+        for _n, _v in constants:
+            # public static final, ConstantValue pointing to an Integer
+            fields.append(struct.pack('>HHHHHIH', 0x19, utf8(_n), descriptor, 1,
+                                      constant_attr, 2, add(struct.pack('>Bi', 3, _v))))
+    data = struct.pack('>IHHH', CLASS_MAGIC, 0, 50, len(pool) + 1) + ''.join(pool)
+    data += struct.pack('>HHHH', 0x21, this_class, super_class, 0)
+    # The constant fields, no methods, the SourceFile attribute
+    data += struct.pack('>H', len(fields)) + ''.join(fields) + struct.pack('>H', 0)
+    data += struct.pack('>HHIH', 1, source_attr, 2, source_idx)
+    return data
+
+def aapt(args):
+    if args[0] == 'package':
+        if '-J' in args:
+            manifest = open(get_opt(args, '-M')).read()
+            package = re.search(r'package="([\w.]+)"', manifest).group(1)
+            gen_dir = os.path.join(get_opt(args, '-J'), *package.split('.'))
+            create_dir(gen_dir)
+            names = []
+            for _root, _dirs, _files in os.walk(get_opt(args, '-S')):
+                names.extend([os.path.splitext(_f)[0] for _f in _files])
+            fields = ''.join(['        public static final int %s = 0x7f%06x;\n' % (_n, _i)
+                              for _i, _n in enumerate(sorted(set(names)))])
+            with open(os.path.join(gen_dir, 'R.java'), 'w') as _f:
+                _f.write('package %s;\n\npublic final class R {\n    public static final class id {\n%s    }\n}\n'
+                         % (package, fields))
+        if '-F' in args:
+            res_dir = get_opt(args, '-S')
+            with zipfile.ZipFile(get_opt(args, '-F'), 'w') as zf:
+                zf.write(get_opt(args, '-M'), 'AndroidManifest.xml')
+                zf.writestr('resources.arsc', 'resources')
+                for _root, _dirs, _files in os.walk(res_dir):
+                    for _f in sorted(_files):
+                        path = os.path.join(_root, _f)
+                        zf.write(path, os.path.relpath(path, os.path.dirname(res_dir)),
+                                 zipfile.ZIP_STORED if _f.endswith('.png') else zipfile.ZIP_DEFLATED)
+    elif args[0] == 'add':
+        files = [_a for _a in args[1:] if not _a.startswith('-')]
+        with zipfile.ZipFile(files[0], 'a') as zf:
+            for _f in files[1:]:
+                zf.write(_f, os.path.basename(_f))
+    elif args[0] == 'singleCrunch':
+        shutil.copyfile(get_opt(args, '-i'), get_opt(args, '-o'))
+    elif args[0] == 'version':
+        print('Android Asset Packaging Tool, v0.2-stub')
+
+def javac(args):
+    args = expand_args(args)
+    out_dir = get_opt(args, '-d')
+    source_path = get_opt(args, '-sourcepath', '')
+    sources = [_a for _a in args if _a.endswith('.java')]
+    for _src in sources:
+        text = open(_src).read()
+        match = _package_re.search(text)
+        package = match.group(1).replace('.', '/') if match else ''
+        name = os.path.basename(_src)[:-len('.java')]
+        refs = set([_i.replace('.', '/') for _i in _import_re.findall(text)])
+        # Classes of the same package used by simple name
+        for _n in set(_name_re.findall(text)):
+            if _n != name and os.path.isfile(os.path.join(source_path, package, _n + '.java')):
+                refs.add('%s/%s' % (package, _n) if package else _n)
+        class_name = '%s/%s' % (package, name) if package else name
+        class_dir = os.path.join(out_dir, package)
+        create_dir(class_dir)
+        with open(os.path.join(class_dir, name + '.class'), 'wb') as _f:
+            _f.write(make_class(class_name, refs, name + '.java',
+                                [(_n, int(_v)) for _n, _v in _constant_re.findall(text)]))
+    print('compiled %d sources' % (len(sources)))
+
+def dx(args):
+    output = [_a for _a in args if _a.startswith('--output=')][0][len('--output='):]
+    hasher = hashlib.sha1()
+    for _in in [_a for _a in args if not _a.startswith('-')]:
+        if os.path.isdir(_in):
+            for _root, _dirs, _files in sorted(os.walk(_in)):
+                for _f in sorted(_files):
+                    hasher.update(open(os.path.join(_root, _f), 'rb').read())
+        elif os.path.isfile(_in):
+            hasher.update(open(_in, 'rb').read())
+    with open(output, 'w') as _f:
+        _f.write('dex\n035\0%s' % (hasher.hexdigest()))
+
+def java(args):
+    merger = 'com.android.dx.merge.DexMerger'
+    if merger in args:
+        idx = args.index(merger)
+        with open(args[idx + 1], 'w') as _f:
+            for _dex in args[idx + 2:]:
+                _f.write(open(_dex).read())
+    elif '-version' in args:
+        sys.stderr.write('java version "1.7.0-stub"\n')
+
+def jarsigner(args):
+    files = [_a for _a in args if not _a.startswith('-')]
+    shutil.copyfile(files[-2], get_opt(args, '-signedjar'))
+
+def zipalign(args):
+    shutil.copyfile(args[-2], args[-1])
+
+def adb(args):
+    args = [_a for _a in args if _a not in ('-e', '-d')]
+    if '-s' in args:
+        idx = args.index('-s')
+        args = args[:idx] + args[idx + 2:]
+    if args[:1] == ['devices']:
+        print('List of devices attached\nemulator-5554\tdevice\n')
+    elif args[:3] == ['shell', 'getprop', 'sys.boot_completed']:
+        print('1')
+    elif args[:3] == ['shell', 'pm', 'path']:
+        print('package:/data/app/%s-1/base.apk' % (args[-1]))
+    elif args[:1] == ['install']:
+        print('Success')
+    elif args[:2] == ['shell', 'am']:
+        print('Starting: Intent { cmp=%s }' % (args[-1]))
+
+TOOLS = {
+    'aapt': aapt,
+    'javac': javac,
+    'dx': dx,
+    'java': java,
+    'jarsigner': jarsigner,
+    'zipalign': zipalign,
+    'adb': adb,
+}
+
+def get_latency(tool):
+    return float(os.environ.get('UBS_STUB_%s_LATENCY' % (tool.upper()),
+                                os.environ.get('UBS_STUB_LATENCY', '0')))
+
+def _read(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise EOFError()
+    return data
+
+def _write_string(stream, data):
+    stream.write(struct.pack('>i', len(data)) + data)
+
+# Serves the requests of UBS over stdin/stdout with the framed protocol of workers.py
+def serve(tool):
+    requests, responses = sys.stdin, sys.stdout
+    responses.write(struct.pack('>i', 0))
+    responses.flush()
+    while True:
+        try:
+            argc = struct.unpack('>i', _read(requests, 4))[0]
+        except EOFError:
+            return 0
+        args = []
+        for _i in xrange(argc):
+            args.append(_read(requests, struct.unpack('>i', _read(requests, 4))[0]))
+        if os.environ.get('UBS_STUB_WORKER_EXIT'):
+            return 1
+        time.sleep(get_latency(tool))
+        sys.stdout, sys.stderr = cStringIO.StringIO(), cStringIO.StringIO()
+        try:
+            TOOLS[tool](args)
+            status = 0
+        except Exception as e:
+            sys.stderr.write('%s\n' % (e))
+            status = 1
+        out, err = sys.stdout.getvalue(), sys.stderr.getvalue()
+        sys.stdout, sys.stderr = responses, sys.__stderr__
+        responses.write(struct.pack('>i', status))
+        _write_string(responses, out)
+        _write_string(responses, err)
+        responses.flush()
+
+def main():
+    tool = os.path.basename(sys.argv[0])
+    args = sys.argv[1:]
+    # Run through a wrapper, i.e. "python stubtool.py javac ..."
+    if not TOOLS.has_key(tool) and args and TOOLS.has_key(args[0]):
+        tool, args = args[0], args[1:]
+    if not TOOLS.has_key(tool):
+        sys.stderr.write('Unknown stub tool "%s"\n' % (tool))
+        return 1
+    time.sleep(float(os.environ.get('UBS_STUB_STARTUP', '0')))
+    if args == ['--worker']:
+        return serve(tool)
+    time.sleep(get_latency(tool))
+    TOOLS[tool](args)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
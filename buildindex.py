@@ -0,0 +1,208 @@
+"""
+Module that indexes the fingerprints and outputs of every stage in a SQLite database
+"""
+
+import os
+import time
+import threading
+from metainfo import get_fingerprint_store
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+# Name of the database, next to meta.info
+INDEX_FILENAME = 'meta.db'
+
+# Separator between stage and path in meta.info keys
+KEY_SEP = '|'
+
+# Stage used for the checks done outside of a stage
+NO_STAGE = ''
+
+# Key prefix of the output records kept in meta.info
+OUTPUT_KEY = '>'
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS fingerprints ('
+    ' stage TEXT NOT NULL,'
+    ' path TEXT NOT NULL,'
+    ' fingerprint TEXT NOT NULL,'
+    ' PRIMARY KEY (stage, path))',
+    'CREATE TABLE IF NOT EXISTS outputs ('
+    ' path TEXT NOT NULL PRIMARY KEY,'
+    ' stage TEXT NOT NULL,'
+    ' built_at REAL NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS outputs_stage ON outputs (stage)',
+]
+
+# {index path: BuildIndex}
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+class BuildIndex():
+    """
+    Class that keeps the fingerprints of the inputs of each stage and the
+    outputs each stage produced in a SQLite database (WAL mode)
+    """
+    def __init__(self, path=None, meta_info_path=None):
+        self.path = path
+        self._lock = threading.RLock()
+        created = not os.path.exists(path)
+        # Stages run on their own threads, access is serialized by the lock
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        # {stage: {path: fingerprint}} read so far, valid until another
+        # connection writes to the database
+        self._fingerprints = {}
+        self._data_version = None
+        with self._db:
+            for _statement in SCHEMA:
+                self._db.execute(_statement)
+        if created and meta_info_path:
+            self._import_meta_info(meta_info_path)
+
+    def _import_meta_info(self, meta_info_path):
+        # Keeps the fingerprints of builds done before the index existed
+        store = get_fingerprint_store(meta_info_path)
+        rows = []
+        for _key, _fp in store.items():
+            stage, sep, path = _key.partition(KEY_SEP)
+            if stage != OUTPUT_KEY:
+                rows.append((stage, path, _fp) if sep else (NO_STAGE, _key, _fp))
+        with self._lock:
+            with self._db:
+                self._db.executemany('INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?)', rows)
+
+    def _check_data_version(self):
+        # Forgets the fingerprints read when another process committed meanwhile
+        data_version = self._db.execute('PRAGMA data_version').fetchone()[0]
+        if data_version != self._data_version:
+            self._fingerprints = {}
+            self._data_version = data_version
+
+    def get_fingerprints(self, stage=None):
+        """ Returns {path: fingerprint} of the inputs of a stage """
+        stage = stage if stage else NO_STAGE
+        with self._lock:
+            self._check_data_version()
+            if not self._fingerprints.has_key(stage):
+                cursor = self._db.execute('SELECT path, fingerprint FROM fingerprints '
+                                          'WHERE stage = ?', (stage,))
+                self._fingerprints[stage] = dict(cursor.fetchall())
+            return dict(self._fingerprints[stage])
+
+    def update_fingerprints(self, stage=None, deltas=None, removed=None):
+        """ Stores the changed fingerprints and forgets the removed inputs in one transaction """
+        if not deltas and not removed:
+            return
+        stage = stage if stage else NO_STAGE
+        with self._lock:
+            with self._db:
+                if deltas:
+                    self._db.executemany('INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?)',
+                                         [(stage, _p, _fp) for _p, _fp in deltas.items()])
+                if removed:
+                    self._db.executemany('DELETE FROM fingerprints WHERE stage = ? AND path = ?',
+                                         [(stage, _p) for _p in removed])
+            fingerprints = self._fingerprints.get(stage)
+            if fingerprints is not None:
+                fingerprints.update(deltas if deltas else {})
+                for _p in (removed if removed else []):
+                    fingerprints.pop(_p, None)
+
+    def record_outputs(self, stage=None, paths=None):
+        """ Records the files a stage produced """
+        if not paths:
+            return
+        now = time.time()
+        with self._lock:
+            with self._db:
+                self._db.executemany('INSERT OR REPLACE INTO outputs VALUES (?, ?, ?)',
+                                     [(_p, stage, now) for _p in paths])
+
+    def get_producer(self, path=None):
+        """ Returns the stage that last produced a file, or None """
+        with self._lock:
+            row = self._db.execute('SELECT stage FROM outputs WHERE path = ?',
+                                   (path,)).fetchone()
+        return row[0] if row else None
+
+    def get_outputs(self, stage=None):
+        """ Returns the files a stage produced """
+        with self._lock:
+            cursor = self._db.execute('SELECT path FROM outputs WHERE stage = ? ORDER BY path',
+                                      (stage,))
+            return [_r[0] for _r in cursor.fetchall()]
+
+class JournalIndex():
+    """
+    Class that offers the build index on top of the meta.info journal, used
+    when sqlite3 is not available
+    """
+    def __init__(self, meta_info_path=None):
+        self.meta_info_path = meta_info_path
+
+    def _store(self):
+        return get_fingerprint_store(self.meta_info_path)
+
+    def _key(self, stage, path):
+        return '%s%s%s' % (stage, KEY_SEP, path) if stage else path
+
+    def get_fingerprints(self, stage=None):
+        prefix = '%s%s' % (stage, KEY_SEP) if stage else None
+        fingerprints = {}
+        for _key, _fp in self._store().items():
+            if prefix:
+                if _key.startswith(prefix):
+                    fingerprints[_key[len(prefix):]] = _fp
+            elif KEY_SEP not in _key:
+                fingerprints[_key] = _fp
+        return fingerprints
+
+    def update_fingerprints(self, stage=None, deltas=None, removed=None):
+        self._store().update(dict([(self._key(stage, _p), _fp)
+                                   for _p, _fp in (deltas if deltas else {}).items()]),
+                             [self._key(stage, _p) for _p in (removed if removed else [])])
+
+    def record_outputs(self, stage=None, paths=None):
+        self._store().update(dict([(self._key(OUTPUT_KEY, _p), stage)
+                                   for _p in (paths if paths else [])]))
+
+    def get_producer(self, path=None):
+        return self._store().get(self._key(OUTPUT_KEY, path))
+
+    def get_outputs(self, stage=None):
+        prefix = '%s%s' % (OUTPUT_KEY, KEY_SEP)
+        return sorted([_k[len(prefix):] for _k, _s in self._store().items()
+                       if _k.startswith(prefix) and _s == stage])
+
+# Returns the build index of the project owning meta.info, shared between stages.
+# A read only index is not created, i.e. for a dry run, the fingerprints of
+# meta.info are read instead until the database exists
+def get_build_index(meta_info_path, read_only=False):
+    with _indexes_lock:
+        index_path = os.path.join(os.path.dirname(meta_info_path), INDEX_FILENAME)
+        if read_only and sqlite3 is not None and not os.path.exists(index_path):
+            return JournalIndex(meta_info_path)
+        # The database is opened again if the project was cleaned meanwhile
+        if not _indexes.has_key(meta_info_path) or \
+                (sqlite3 is not None and not os.path.exists(index_path)):
+            if sqlite3 is not None:
+                _indexes[meta_info_path] = BuildIndex(index_path, meta_info_path)
+            else:
+                _indexes[meta_info_path] = JournalIndex(meta_info_path)
+        return _indexes[meta_info_path]
+
+# Closes the databases of the build indexes, i.e. before forking,
+# they are opened again on the next use
+def close_indexes():
+    with _indexes_lock:
+        for _index in _indexes.values():
+            if isinstance(_index, BuildIndex):
+                with _index._lock:
+                    _index._db.close()
+        _indexes.clear()
@@ -0,0 +1,286 @@
+"""
+Module that indexes the dependencies between compiled java classes
+"""
+
+import os
+import re
+import struct
+
+CLASS_MAGIC = 0xCAFEBABE
+
+# Constant pool tags
+CONSTANT_Utf8 = 1
+CONSTANT_Class = 7
+# Size of the constant pool entries, other than Utf8, by tag
+CONSTANT_SIZES = {
+    3: 4,   # Integer
+    4: 4,   # Float
+    5: 8,   # Long
+    6: 8,   # Double
+    7: 2,   # Class
+    8: 2,   # String
+    9: 4,   # Fieldref
+    10: 4,  # Methodref
+    11: 4,  # InterfaceMethodref
+    12: 4,  # NameAndType
+    15: 3,  # MethodHandle
+    16: 2,  # MethodType
+    17: 4,  # Dynamic
+    18: 4,  # InvokeDynamic
+    19: 2,  # Module
+    20: 2,  # Package
+}
+
+# Class names referenced from field/method descriptors and signatures
+_descriptor_re = re.compile(r'L([\w/$]+)[;<]')
+
+class ClassFormatError(Exception):
+    pass
+
+class ClassInfo():
+    """
+    Class that holds the name, source file and references of a compiled class,
+    and whether it declares constants javac inlines into the classes using them
+    """
+    def __init__(self, name=None, source_file=None, refs=None, path=None, constants=False):
+        self.name = name
+        self.source_file = source_file
+        self.refs = refs if refs else set()
+        self.path = path
+        self.constants = constants
+
+    def get_source_path(self, src_dir):
+        """ Returns where the source of this class lives following the package layout """
+        if not self.source_file:
+            return None
+        package = os.path.dirname(self.name)
+        return os.path.join(src_dir, package.replace('/', os.sep), self.source_file)
+
+def _skip_attributes(data, offset):
+    count, = struct.unpack_from('>H', data, offset)
+    offset += 2
+    for _ in xrange(count):
+        length, = struct.unpack_from('>I', data, offset + 2)
+        offset += 6 + length
+    return offset
+
+# Parses a .class file, returns its ClassInfo
+def parse_class_file(path):
+    with open(path, 'rb') as _f:
+        data = _f.read()
+    try:
+        magic, = struct.unpack_from('>I', data, 0)
+        if magic != CLASS_MAGIC:
+            raise ClassFormatError('%s is not a class file' % (path))
+        cp_count, = struct.unpack_from('>H', data, 8)
+        offset = 10
+        utf8 = {}
+        # {class entry: name entry}
+        classes = {}
+        idx = 1
+        while idx < cp_count:
+            tag = ord(data[offset])
+            if tag == CONSTANT_Utf8:
+                length, = struct.unpack_from('>H', data, offset + 1)
+                utf8[idx] = data[offset + 3:offset + 3 + length]
+                offset += 3 + length
+            elif CONSTANT_SIZES.has_key(tag):
+                if tag == CONSTANT_Class:
+                    classes[idx], = struct.unpack_from('>H', data, offset + 1)
+                offset += 1 + CONSTANT_SIZES[tag]
+                # Long and Double take two entries
+                if tag in (5, 6):
+                    idx += 1
+            else:
+                raise ClassFormatError('Unknown constant pool tag %d in %s' % (tag, path))
+            idx += 1
+        this_class, = struct.unpack_from('>H', data, offset + 2)
+        interfaces, = struct.unpack_from('>H', data, offset + 6)
+        offset += 8 + 2 * interfaces
+        # Fields, those with a ConstantValue are inlined where they are used
+        constants = False
+        count, = struct.unpack_from('>H', data, offset)
+        offset += 2
+        for _ in xrange(count):
+            attributes, = struct.unpack_from('>H', data, offset + 6)
+            offset += 8
+            for _ in xrange(attributes):
+                name_idx, length = struct.unpack_from('>HI', data, offset)
+                if utf8.get(name_idx) == 'ConstantValue':
+                    constants = True
+                offset += 6 + length
+        # Methods
+        count, = struct.unpack_from('>H', data, offset)
+        offset += 2
+        for _ in xrange(count):
+            offset = _skip_attributes(data, offset + 6)
+        # Class attributes
+        source_file = None
+        count, = struct.unpack_from('>H', data, offset)
+        offset += 2
+        for _ in xrange(count):
+            name_idx, length = struct.unpack_from('>HI', data, offset)
+            if utf8.get(name_idx) == 'SourceFile':
+                source_file = utf8.get(struct.unpack_from('>H', data, offset + 6)[0])
+            offset += 6 + length
+    except (struct.error, IndexError):
+        raise ClassFormatError('Truncated class file %s' % (path))
+
+    name = utf8.get(classes.get(this_class))
+    refs = set()
+    for _idx in classes.values():
+        _name = utf8.get(_idx)
+        if _name:
+            # Arrays, i.e. "[Lcom/x/Foo;"
+            if _name.startswith('['):
+                refs.update(_descriptor_re.findall(_name))
+            else:
+                refs.add(_name)
+    for _s in utf8.values():
+        if 'L' in _s and ';' in _s:
+            refs.update(_descriptor_re.findall(_s))
+    refs.discard(name)
+    return ClassInfo(name=name, source_file=source_file, refs=refs, path=path,
+                     constants=constants)
+
+class DependencyIndex():
+    """
+    Class that maps sources to their classes and classes to the classes referencing them
+    """
+    def __init__(self, src_dir=None):
+        self.src_dir = src_dir
+        # {class name: ClassInfo}
+        self.classes = {}
+        # {source path: [class name, ...]}
+        self.sources = {}
+        # {class name: set(class names referencing it)}
+        self.dependents = {}
+
+    def build(self, class_files):
+        """ Indexes the given .class files, returns False if any can't be mapped to its source """
+        for _path in class_files:
+            try:
+                info = parse_class_file(_path)
+            except (IOError, ClassFormatError):
+                return False
+            source = info.get_source_path(self.src_dir)
+            if not info.name or not source:
+                return False
+            self.classes[info.name] = info
+            self.sources.setdefault(source, []).append(info.name)
+            for _ref in info.refs:
+                self.dependents.setdefault(_ref, set()).add(info.name)
+        return True
+
+    def declares_constants(self, sources):
+        """ Tells whether a class of the sources declares constants """
+        return len([_n for _s in sources for _n in self.sources.get(_s, [])
+                    if self.classes[_n].constants]) > 0
+
+    def get_removed_sources(self):
+        return [_s for _s in self.sources.keys() if not os.path.exists(_s)]
+
+    def get_affected(self, changed_sources):
+        """ Returns (sources to recompile, stale class files) for the changed sources,
+        the edited and removed sources plus every source depending on them transitively """
+        removed = self.get_removed_sources()
+        pending = []
+        for _s in list(changed_sources) + removed:
+            pending.extend(self.sources.get(_s, []))
+        affected = set(pending)
+        while pending:
+            for _dep in self.dependents.get(pending.pop(), []):
+                if _dep not in affected:
+                    affected.add(_dep)
+                    pending.append(_dep)
+        sources = set(changed_sources)
+        stale = []
+        for _name in affected:
+            info = self.classes[_name]
+            stale.append(info.path)
+            source = info.get_source_path(self.src_dir)
+            if source not in removed:
+                sources.add(source)
+        return sorted(sources), sorted(stale)
+
+    def _get_package_deps(self, packages):
+        # {package: set(packages among the given ones its classes reference)}
+        deps = dict([(_p, set()) for _p in packages])
+        for _p, _sources in packages.items():
+            for _s in _sources:
+                for _name in self.sources.get(_s, []):
+                    for _ref in self.classes[_name].refs:
+                        info = self.classes.get(_ref)
+                        if info is None:
+                            continue
+                        package = os.path.dirname(info.get_source_path(self.src_dir))
+                        if package != _p and deps.has_key(package):
+                            deps[_p].add(package)
+        return deps
+
+    def get_package_levels(self, sources):
+        """ Groups the sources by package, packages depending on each other in the same
+        group, and returns the groups by level [[[source, ...], ...], ...]: the groups of a
+        level only depend on those of the previous levels, so they compile independently """
+        packages = {}
+        for _s in sources:
+            packages.setdefault(os.path.dirname(_s), []).append(_s)
+        deps = self._get_package_deps(packages)
+        levels = []
+        # {package: level of its group}
+        level_of = {}
+        # Components come out after the components they depend on
+        for _component in get_strong_components(deps):
+            level = 1 + max([level_of[_d] for _p in _component for _d in deps[_p]
+                             if _d not in _component] + [-1])
+            for _p in _component:
+                level_of[_p] = level
+            if level == len(levels):
+                levels.append([])
+            levels[level].append(sorted([_s for _p in _component for _s in packages[_p]]))
+        return levels
+
+# Returns the strongly connected components of the graph {node: set(nodes)},
+# every component after the ones reachable from it (Tarjan's, without recursion)
+def get_strong_components(graph):
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+    for _root in sorted(graph.keys()):
+        if index.has_key(_root):
+            continue
+        work = [(_root, iter(sorted(graph[_root])))]
+        index[_root] = lowlink[_root] = len(index)
+        stack.append(_root)
+        on_stack.add(_root)
+        while work:
+            node, children = work[-1]
+            pushed = False
+            for _child in children:
+                if not index.has_key(_child):
+                    index[_child] = lowlink[_child] = len(index)
+                    stack.append(_child)
+                    on_stack.add(_child)
+                    work.append((_child, iter(sorted(graph[_child]))))
+                    pushed = True
+                    break
+                elif _child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[_child])
+            if pushed:
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+            if lowlink[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(component)
+    return components
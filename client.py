@@ -0,0 +1,58 @@
+"""
+Module that forwards ubs.py commands to a running UBS daemon
+"""
+
+import os
+import sys
+import json
+import socket
+
+# Returns the path of the unix domain socket the daemon listens on
+def get_socket_path():
+    return os.environ.get('UBS_DAEMON_SOCKET',
+                          os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                       'ubs.sock'))
+
+# Connects to the daemon, returns None when no daemon is running
+def connect(socket_path=None):
+    socket_path = socket_path if socket_path else get_socket_path()
+    if not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+# Sends a request to the daemon and relays its output.
+# Returns the exit status, or None if no daemon is running
+def send_request(request, socket_path=None, out=sys.stderr):
+    sock = connect(socket_path)
+    if sock is None:
+        return None
+    replied = False
+    try:
+        sock.sendall(json.dumps(request) + '\n')
+        for line in sock.makefile('rb'):
+            reply = json.loads(line)
+            replied = True
+            if reply.has_key('out'):
+                out.write(reply['out'])
+                out.flush()
+            if reply.has_key('rc'):
+                return reply['rc']
+    except (socket.error, ValueError):
+        pass
+    finally:
+        sock.close()
+    # Daemon went away without an exit status, only fall back
+    # to in-process execution when it didn't start on the request
+    return 1 if replied else None
+
+# Runs ubs.py arguments on the daemon, in the environment of the client
+def run_on_daemon(argv, socket_path=None):
+    return send_request({'argv': argv,
+                         'cwd': os.getcwd(),
+                         'env': dict(os.environ)}, socket_path)
@@ -3,10 +3,16 @@ Module that compiles a basic android project
 """
 
 import os
+import shutil
 import logging
-from utils import BuildSetup, create_dir, create_file, \
-    execute_command, check_files, get_files, find_file, \
-    check_if_new_or_modified_files
+from graph import Graph, Node
+from dexer import Dexer
+import multiprocessing
+from classdeps import DependencyIndex
+from snapshot import get_snapshot
+from artifacts import get_artifact_cache
+from utils import BuildSetup, create_file, create_dir, check_files, \
+    get_files, find_file, run_command, run_commands
 
 # Setting logger
 log = logging.getLogger(__name__)
@@ -18,6 +24,8 @@ sh = logging.StreamHandler()
 sh.setFormatter(fmt)
 log.addHandler(sh)
 
+# Sources per shard unless "javac_shard_size" is set up
+DEFAULT_SHARD_SIZE = 200
 
 class Compile():
     """
@@ -34,6 +42,12 @@ class Compile():
         self.dx_bin = bs.get_dx_bin()
         self.javac_bin = bs.get_javac_bin()
         self.android_jar = bs.get_android_jar()
+        self.java_bin = bs.get_java_bin()
+        self.cache_path = bs.get_cache_path()
+        self.aapt_timeout = bs.get_timeout('aapt')
+        self.javac_timeout = bs.get_timeout('javac')
+        self.dx_timeout = bs.get_timeout('dx')
+        self.shard_size = bs.get_javac_shard_size() or DEFAULT_SHARD_SIZE
         # Local setup
         if not kwargs.has_key('name'):
             log.warn('No project name given!')
@@ -41,27 +55,41 @@ class Compile():
         self.project_name = kwargs['name']
         self.project_path = os.path.join(bs.get_workspace_path(),
                                          self.project_name)
+        # Files of the project, scanned once per build
+        self.snapshot = kwargs['snapshot'] if kwargs.has_key('snapshot') else \
+            get_snapshot(self.project_path)
         self.package_name = 'com.%s.%s'%(self.author,
                                          self.project_name)
         self.app_manifest = os.path.join(self.project_path,
                                          'AndroidManifest.xml')
+        # Log why each stage runs or not, without running any on a dry run
+        self.explain = kwargs['explain'] if kwargs.has_key('explain') else False
+        self.dry_run = kwargs['dry_run'] if kwargs.has_key('dry_run') else False
         self.meta_info_path = os.path.join(self.project_path,
                                            'meta.info')
-        create_file(self.meta_info_path)
+        # Nothing is written on a dry run
+        if not self.dry_run:
+            create_file(self.meta_info_path)
+        # Number of javac shards compiled at the same time
+        self.jobs = kwargs['jobs'] if kwargs.has_key('jobs') and kwargs['jobs'] else \
+            multiprocessing.cpu_count()
 
     def _check_files(self, dir=None, exts=None):
         return check_files(os.path.join(self.project_path,
                                         dir),
-                           exts)
+                           exts,
+                           self.snapshot)
     def _get_files(self, dir=None, exts=None):
         return get_files(os.path.join(self.project_path,
                                       dir),
-                         exts)
+                         exts,
+                         self.snapshot)
 
     def _find_file(self, dir=None, filename=None):
         return find_file(os.path.join(self.project_path,
                                       dir),
-                          filename)
+                          filename,
+                          self.snapshot)
 
     def _check_resources(self):
         return self._check_files('res', ['.xml', '.png'])
@@ -78,28 +106,8 @@ class Compile():
     def _get_classes(self):
         return self._get_files('obj', ['.class'])
 
-    def _check_if_new_or_modified_files(self, dir=None, exts=None):
-        return check_if_new_or_modified_files(self.meta_info_path,
-                                              os.path.join(self.project_path ,dir),
-                                              exts)
-
-    def _check_if_new_or_modified_resources(self):
-        return self._check_if_new_or_modified_files('res', ['.xml'])
-
-    def _check_if_new_or_modified_sources(self):
-        return self._check_if_new_or_modified_files('src', ['.java'])
-
-    def _check_if_new_or_modified_classes(self):
-        return self._check_if_new_or_modified_files('obj', ['.class'])
-
-    def _need_to_re_create_R_java(self):
-        return len(self._check_if_new_or_modified_resources()) > 0
-
-    def _need_to_re_compile_java_sources(self):
-        return len(self._check_if_new_or_modified_sources()) > 0
-
-    def _need_to_re_compile_java_classes(self):
-        return len(self._check_if_new_or_modified_classes()) > 0
+    def _get_libs(self):
+        return self._get_files('libs', ['.jar'])
 
     def _check_R_java(self):
         return len(self._find_file('src','R.java')) > 0
@@ -110,26 +118,13 @@ class Compile():
     def _check_dex(self):
         return len(self._find_file('bin','.dex')) > 0
 
-    def _create_R_java_PRE(self):
-        if os.path.exists(self.project_path):
-            if self._check_resources() and \
-                    (True if self.aapt_bin else False) and \
-                    (True if self.app_manifest else False) and \
-                    (True if self.android_jar else False):
-
-                log.info('Generating R.java')
-                if  self._need_to_re_create_R_java() or \
-                    not self._check_R_java():
-                    self._create_R_java_task()
-                else:
-                    log.info('No new/modified resources to re-generate R.java')
-                    self._create_R_java_POST()
-            else:
-                log.warn('Missing resources and/or build tools!')
-        else:
-            log.warn('Project "%s" does not exist in workspace!'%(self.project_name))
+    def _requires_R_java(self):
+        return self._check_resources() and \
+            (True if self.aapt_bin else False) and \
+            (True if self.app_manifest else False) and \
+            (True if self.android_jar else False)
 
-    def _create_R_java_task(self):
+    def _create_R_java_cmds(self, changes=None):
         # Generate R.java
         cmd = [self.aapt_bin,
                 'package', '-f', '-m',
@@ -137,92 +132,255 @@ class Compile():
                 '-M', '%s'%(self.app_manifest),
                 '-I', '%s'%(self.android_jar),
                 '-J', '%s/src'%(self.project_path)]
-        if execute_command(cmd, cwd=self.project_path, os_env=self.os_environ):
-            log.info('Generated R.java')
-        self._create_R_java_POST()
-
-    def _create_R_java_POST(self):
-        if self._check_R_java():
-            self._compile_java_code_PRE()
-        else:
-            log.warn('Failed on generating R.java!')
-
-    def _compile_java_code_PRE(self):
-        if self._check_sources() and \
-                (True if self.javac_bin else False) and \
-                (True if self.project_path else False) and \
-                (True if self.android_jar else False):
-
-            # Create obj folder if doesn't exist
-            create_dir(os.path.join(self.project_path, 'obj'))
-
-            log.info('Compiling java source')
-            if  self._need_to_re_compile_java_sources() or \
-                not self._check_classes():
-                self._compile_java_code_task()
+        return [cmd]
+
+    def _requires_java_code(self):
+        return self._check_sources() and \
+            (True if self.javac_bin else False) and \
+            (True if self.project_path else False) and \
+            (True if self.android_jar else False)
+
+    def _get_dependency_index(self):
+        # Dependencies between the compiled classes, None if they can't be mapped to sources
+        if not self._check_classes():
+            return None
+        index = DependencyIndex(os.path.join(self.project_path, 'src'))
+        if not index.build(self._get_classes()):
+            return None
+        return index
+
+    def _get_sources_to_recompile(self, changes=None, index=None):
+        # Returns (sources, stale classes) affected by the changed sources,
+        # None when every source has to be recompiled
+        if not changes or index is None:
+            return None
+        # Removed sources are found by the index itself
+        changed = [_f for _f, _t in changes if _t != 'D']
+        # Constants are inlined by javac, so the dependents of the classes declaring
+        # some, R included, can't be tracked
+        if [_f for _f in changed if os.path.basename(_f) == 'R.java'] or \
+                index.declares_constants(changed):
+            log.info('Re-compiling every source, a changed class declares constants')
+            return None
+        return index.get_affected(changed)
+
+    def _get_stash_path(self):
+        # Stale classes are kept here while the sources replacing them compile
+        return os.path.join(self.project_path, 'bin', 'javac', 'stale')
+
+    def _restore_stale_classes(self, overwrite=False):
+        # Puts the stashed classes back into obj, returns how many
+        stash = self._get_stash_path()
+        obj = os.path.join(self.project_path, 'obj')
+        restored = 0
+        for _root, _dirs, _files in os.walk(stash):
+            for _f in _files:
+                src = os.path.join(_root, _f)
+                dst = os.path.join(obj, os.path.relpath(src, stash))
+                if overwrite or not os.path.exists(dst):
+                    create_dir(os.path.dirname(dst))
+                    os.rename(src, dst)
+                    restored += 1
+        shutil.rmtree(stash, ignore_errors=True)
+        return restored
+
+    def _compile_without_stale(self, stale, compile_step):
+        def compile_sources():
+            # Stale classes are moved aside while javac runs and put back if it
+            # fails, the next build compiles the same sources again
+            stash = self._get_stash_path()
+            obj = os.path.join(self.project_path, 'obj')
+            for _c in stale:
+                if os.path.exists(_c):
+                    dst = os.path.join(stash, os.path.relpath(_c, obj))
+                    create_dir(os.path.dirname(dst))
+                    os.rename(_c, dst)
+            ok = compile_step()
+            if ok:
+                shutil.rmtree(stash, ignore_errors=True)
             else:
-                log.info('No new/modified sources to re-compile sources')
-                self._compile_java_code_POST()
-        else:
-            log.warn('Missing sources and/or build tools!')
-
-    def _compile_java_code_task(self):
+                self._restore_stale_classes(overwrite=True)
+            return ok
+        return compile_sources
+
+    def _remove_classes(self, classes):
+        def remove_classes():
+            for _c in classes:
+                if os.path.exists(_c):
+                    os.remove(_c)
+            return True
+        return remove_classes
+
+    def _run_javac(self, cmd):
+        def run_javac():
+            return run_command(cmd,
+                               cwd=self.project_path,
+                               os_env=self.os_environ,
+                               timeout=self.javac_timeout) == 0
+        return run_javac
+
+    def _write_argfile(self, name=None, sources=None):
+        # javac reads the sources from "@argfile", a command line can't hold them all
+        argfile = os.path.join(self.project_path, 'bin', 'javac', '%s.args' % (name))
+        create_dir(os.path.dirname(argfile))
+        with open(argfile, 'w') as _f:
+            for _s in sources:
+                _f.write('"%s"\n' % (_s.replace('\\', '\\\\').replace('"', '\\"')))
+        return '@%s' % (argfile)
+
+    def _balance(self, groups):
+        # Packs the groups of a level into shards of similar size, largest groups first
+        size = sum([len(_g) for _g in groups])
+        shards = [[] for _ in range(max(1, min(self.jobs, size / self.shard_size)))]
+        for _group in sorted(groups, key=len, reverse=True):
+            min(shards, key=len).extend(_group)
+        return [sorted(_s) for _s in shards if _s]
+
+    def _get_shards(self, sources=None, index=None):
+        # Returns the shards of every level, None when a single javac does better
+        if self.jobs <= 1 or len(sources) < 2 * self.shard_size or index is None:
+            return None
+        levels = [self._balance(_groups) for _groups in index.get_package_levels(sources)]
+        if max([len(_shards) for _shards in levels]) <= 1:
+            return None
+        return levels
+
+    def _compile_shards(self, cmd, levels):
+        def compile_shards():
+            # Shards of a level are independent, the next level compiles against them
+            for _level, _shards in enumerate(levels):
+                cmds = [cmd + [self._write_argfile('shard-%d-%d' % (_level, _i), _s)]
+                        for _i, _s in enumerate(_shards)]
+                if not run_commands(cmds,
+                                    cwd=self.project_path,
+                                    os_env=self.os_environ,
+                                    timeout=self.javac_timeout,
+                                    jobs=self.jobs):
+                    return False
+            return True
+        return compile_shards
+
+    def _compile_java_code_cmds(self, changes=None):
         # Compile java sources
         cmd = [self.javac_bin,
                 '-d', '%s/obj'%(self.project_path),
                 '-classpath', '%s'%(self.android_jar),
                 '-sourcepath', '%s/src'%(self.project_path)]
-        cmd.extend([_s for _s in self._get_sources()])
-
-        if execute_command(cmd, cwd=self.project_path, os_env=self.os_environ):
-            log.info('Compiled sources')
-        self._compile_java_code_POST()
-
-    def _compile_java_code_POST(self):
-        if self._check_classes():
-            self._create_dex_PRE()
-        else:
-            log.warn('Failed on compiling sources!')
-
-    def _create_dex_PRE(self):
-        if self._check_classes() and \
-                (True if self.dx_bin else False) and \
-                (True if self.project_path else False):
-
-            # Create bin folder if doesn't exist
-            create_dir(os.path.join(self.project_path, 'bin'))
-
-            log.info('Generating DEX executable')
-            if self._need_to_re_compile_java_classes() or \
-                    not self._check_dex():
-                self._create_dex_task()
-            else:
-                log.info('No new/modified classes to re-generate DEX executable')
-                self._create_dex_POST()
-        else:
-            log.warn('Missing compiled classes and/or build tools!')
-
-    def _create_dex_task(self):
-        # Creates Dalvik executable
-        cmd = [self.dx_bin, '--dex',
-               '--output=%s/bin/classes.dex' % (self.project_path),
-               '%s/obj'%(self.project_path),
-               '%s/libs' % (self.project_path)]
-
-        if execute_command(cmd, cwd=self.project_path, os_env=self.os_environ):
-            log.info('Generated DEX executable')
-        self._create_dex_POST()
-
-    def _create_dex_POST(self):
-        if not self._check_dex():
-            log.warn('Failed on generating DEX binary excutable!')
+        # Classes stashed by a build which didn't finish
+        if self._restore_stale_classes() and self.snapshot is not None:
+            self.snapshot.refresh(os.path.join(self.project_path, 'obj'))
+        sources = self._get_sources()
+        index = None
+        if changes or len(sources) >= 2 * self.shard_size:
+            index = self._get_dependency_index()
+        affected = self._get_sources_to_recompile(changes, index)
+        if affected is not None and not affected[0]:
+            # Only sources were removed, nothing to compile
+            log.info('Removing %d classes of deleted sources' % (len(affected[1])))
+            return [self._remove_classes(affected[1])]
+        if affected is not None:
+            log.info('Re-compiling %d of %d sources' % (len(affected[0]),
+                                                        len(sources)))
+            sources = affected[0]
+        levels = self._get_shards(sources, index)
+        if levels is None:
+            if affected is None:
+                return [cmd + [self._write_argfile('sources', sources)]]
+            # Compile against the classes of the unaffected sources
+            cmd[4] = os.pathsep.join([self.android_jar,
+                                      os.path.join(self.project_path, 'obj')])
+            compile_step = self._run_javac(cmd + [self._write_argfile('sources', sources)])
+            return [self._compile_without_stale(affected[1], compile_step)]
+        log.info('Compiling %d sources in %d shards over %d levels' % (
+            len(sources), sum([len(_s) for _s in levels]), len(levels)))
+        # Shards compile against the classes of the others, none is compiled twice
+        cmd[4] = os.pathsep.join([self.android_jar,
+                                  os.path.join(self.project_path, 'obj')])
+        cmd.insert(1, '-implicit:none')
+        if affected is None:
+            return [self._compile_shards(cmd, levels)]
+        return [self._compile_without_stale(affected[1], self._compile_shards(cmd, levels))]
+
+    def _requires_dex(self):
+        return self._check_classes() and \
+            (True if self.dx_bin else False) and \
+            (True if self.project_path else False)
+
+    def _create_dex_cmds(self, changes=None):
+        # Creates Dalvik executable from the pre-dexed libraries
+        # and the changed classes
+        dexer = Dexer(project_path=self.project_path,
+                      dx_bin=self.dx_bin,
+                      java_bin=self.java_bin,
+                      cache_path=self.cache_path,
+                      os_env=self.os_environ,
+                      timeout=self.dx_timeout)
+        return dexer.get_steps(changes, self._get_classes(), self._get_libs())
+
+    def get_nodes(self):
+        """ Returns the stages to compile the project """
+        return [
+            Node('R.java',
+                 inputs=[('res', ['.xml', '.png']), ('', ['AndroidManifest.xml'])],
+                 outputs=[('src', 'R.java')],
+                 requires=self._requires_R_java,
+                 commands=self._create_R_java_cmds,
+                 timeout=self.aapt_timeout,
+                 desc='Generating R.java',
+                 done='Generated R.java',
+                 skip='No new/modified resources to re-generate R.java',
+                 missing='Missing resources and/or build tools!',
+                 failed='Failed on generating R.java!',
+                 cache=True),
+            Node('javac',
+                 deps=['R.java'],
+                 inputs=[('src', ['.java'])],
+                 outputs=[('obj', '.class')],
+                 requires=self._requires_java_code,
+                 commands=self._compile_java_code_cmds,
+                 timeout=self.javac_timeout,
+                 desc='Compiling java source',
+                 done='Compiled sources',
+                 skip='No new/modified sources to re-compile sources',
+                 missing='Missing sources and/or build tools!',
+                 failed='Failed on compiling sources!',
+                 cache=True),
+            Node('dex',
+                 deps=['javac'],
+                 inputs=[('obj', ['.class']), ('libs', ['.jar'])],
+                 outputs=[('bin', 'classes.dex')],
+                 requires=self._requires_dex,
+                 commands=self._create_dex_cmds,
+                 timeout=self.dx_timeout,
+                 desc='Generating DEX executable',
+                 done='Generated DEX executable',
+                 skip='No new/modified classes to re-generate DEX executable',
+                 missing='Missing compiled classes and/or build tools!',
+                 failed='Failed on generating DEX binary excutable!',
+                 cache=True),
+        ]
+
+    def get_graph(self):
+        graph = Graph(project_path=self.project_path,
+                      meta_info_path=self.meta_info_path,
+                      os_env=self.os_environ,
+                      logger=log,
+                      snapshot=self.snapshot,
+                      cache=None if self.dry_run else get_artifact_cache(),
+                      explain=self.explain,
+                      dry_run=self.dry_run)
+        graph.extend(self.get_nodes())
+        return graph
 
     def compile_project(self):
-        self._create_R_java_PRE()
+        if not os.path.exists(self.project_path):
+            log.warn('Project "%s" does not exist in workspace!'%(self.project_name))
+            return False
+        return self.get_graph().run()
 
 def compile_project(*args, **kwargs):
     c = Compile(*args, **kwargs)
-    c.compile_project()
+    return c.compile_project()
 
 if __name__ == '__main__':
     compile_project(name='HelloWorld')
\ No newline at end of file
@@ -27,6 +27,7 @@ class Create():
         self.android_bin = bs.get_android_bin()
         self.target = 'android-%s'%(bs.get_api_ver())
         self.activity_name = bs.get_activity_name()
+        self.android_timeout = bs.get_timeout('android')
         # Local setup
         if not kwargs.has_key('name'):
             log.warn('No project name given!')
@@ -60,7 +61,7 @@ class Create():
                 '--package', self.package_name,
                 '--target', self.target
             ])
-        if execute_command(cmd, cwd=self.project_path):
+        if execute_command(cmd, cwd=self.project_path, timeout=self.android_timeout):
             if cmd[1] == 'update':
                 log.info('Updating project "%s" ALREADY created in "%s"' % (self.project_name,
                                                                       self.project_path))
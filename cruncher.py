@@ -0,0 +1,166 @@
+"""
+Module that crunches the PNGs of the resources into a shared cache and mirrors
+the resources with the crunched images, ready to be packaged without crunching
+"""
+
+import os
+import shutil
+import hashlib
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from fingerprint import get_file_fingerprint, get_stat_signature, parse_fingerprint
+from utils import create_dir, run_command, get_files, \
+    get_stage_record, update_stage_record
+
+# Setting logger
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+fmt = logging.Formatter(datefmt="%H:%M:%S",
+                        fmt='%(asctime)s %(levelname)-8s: %(name)s: %(message)s')
+sh = logging.StreamHandler()
+sh.setFormatter(fmt)
+log.addHandler(sh)
+
+# Stage under which the mirrored resources are recorded, apart from the
+# inputs of the "crunch" stage
+CRUNCH_STAGE = 'crunch mirror'
+
+PNG_EXT = '.png'
+
+# Hard links the file, copies it across file systems
+def link_file(src, dst):
+    if os.path.exists(dst):
+        os.remove(dst)
+    create_dir(os.path.dirname(dst))
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+# Tells whether dst is a hard link to src, or a copy of it with the same size and mtime
+def is_linked(src, dst):
+    try:
+        src_st = os.stat(src)
+        dst_st = os.stat(dst)
+    except OSError:
+        return False
+    if (src_st.st_dev, src_st.st_ino) == (dst_st.st_dev, dst_st.st_ino):
+        return True
+    return src_st.st_size == dst_st.st_size and \
+        abs(src_st.st_mtime - dst_st.st_mtime) < 0.001
+
+class Cruncher():
+    """
+    Class that crunches every new/modified PNG on its own, at most jobs at the same
+    time, keeping the results in a cache addressed by their content, and mirrors
+    res/ into bin/res with the crunched PNGs
+    """
+    def __init__(self, project_path=None, aapt_bin=None, cache_path=None,
+                 meta_info_path=None, snapshot=None, os_env=None, timeout=None,
+                 jobs=None):
+        self.project_path = project_path
+        self.aapt_bin = aapt_bin
+        self.meta_info_path = meta_info_path
+        self.snapshot = snapshot
+        self.os_env = os_env
+        self.timeout = timeout
+        self.jobs = jobs if jobs and jobs > 0 else multiprocessing.cpu_count()
+        self.res_path = os.path.join(project_path, 'res')
+        self.mirror_path = os.path.join(project_path, 'bin', 'res')
+        self.crunch_path = os.path.join(cache_path, 'crunch') if cache_path else None
+
+    def can_crunch(self):
+        return (True if self.crunch_path else False) and \
+            (True if self.aapt_bin and os.path.exists(self.aapt_bin) else False)
+
+    def _get_tool_id(self):
+        # A different aapt may crunch differently
+        return '%s:%s' % (self.aapt_bin, get_stat_signature(self.aapt_bin))
+
+    def _get_cached(self, digest):
+        key = hashlib.sha1('%s\0%s' % (self._get_tool_id(), digest)).hexdigest()
+        return os.path.join(self.crunch_path, key[:2], '%s%s' % (key, PNG_EXT))
+
+    def _crunch(self, job):
+        # Runs in the pool, returns True if the PNG is in the cache
+        src, cached = job
+        create_dir(os.path.dirname(cached))
+        tmp = '%s.%d.tmp%s' % (cached[:-len(PNG_EXT)], os.getpid(), PNG_EXT)
+        cmd = [self.aapt_bin, 'singleCrunch', '-i', src, '-o', tmp]
+        if run_command(cmd, cwd=self.project_path, os_env=self.os_env,
+                       timeout=self.timeout) != 0 or not os.path.exists(tmp):
+            return False
+        os.rename(tmp, cached)
+        return True
+
+    def _crunch_all(self, jobs):
+        if len(jobs) <= 1 or self.jobs <= 1:
+            return [self._crunch(_j) for _j in jobs]
+        pool = ThreadPool(min(self.jobs, len(jobs)))
+        try:
+            return pool.map(self._crunch, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _remove_stale(self, sources):
+        # Files of the mirror whose resource is gone
+        removed = []
+        for _root, _dirs, _files in os.walk(self.mirror_path):
+            for _f in _files:
+                dst = os.path.join(_root, _f)
+                src = os.path.join(self.res_path, os.path.relpath(dst, self.mirror_path))
+                if src not in sources:
+                    os.remove(dst)
+                    removed.append(src)
+        return removed
+
+    def _mirror(self):
+        record = get_stage_record(self.meta_info_path, CRUNCH_STAGE)
+        sources = set(get_files(self.res_path, [''], self.snapshot))
+        deltas = {}
+        copies = []
+        crunches = []
+        for _src in sorted(sources):
+            dst = os.path.join(self.mirror_path, os.path.relpath(_src, self.res_path))
+            fp, modified = get_file_fingerprint(_src, record.get(_src))
+            if _src.endswith(PNG_EXT):
+                # The mirror links to the crunched PNG, unless the cache was pruned
+                cached = self._get_cached(parse_fingerprint(fp)[1])
+                if not modified and os.path.exists(dst) and \
+                        (not os.path.exists(cached) or is_linked(cached, dst)):
+                    continue
+                crunches.append((_src, dst, fp))
+            elif not is_linked(_src, dst):
+                # Replaced resources have a different inode than their mirror
+                copies.append((_src, dst, fp))
+            elif fp != record.get(_src):
+                deltas[_src] = fp
+        for _src, _dst, _fp in copies:
+            link_file(_src, _dst)
+            deltas[_src] = _fp
+        cached = [self._get_cached(parse_fingerprint(_fp)[1]) for _src, _dst, _fp in crunches]
+        # Identical PNGs are crunched once
+        jobs = dict([(_c, _src) for (_src, _dst, _fp), _c in zip(crunches, cached)
+                     if not os.path.exists(_c)])
+        if crunches:
+            log.info('Crunching %d of %d PNGs, the others from the cache' % (len(jobs),
+                                                                            len(crunches)))
+        self._crunch_all([(_src, _c) for _c, _src in sorted(jobs.items())])
+        ok = True
+        for (_src, _dst, _fp), _c in zip(crunches, cached):
+            if not os.path.exists(_c):
+                log.error('Unable to crunch "%s"' % (os.path.relpath(_src, self.project_path)))
+                ok = False
+                continue
+            link_file(_c, _dst)
+            deltas[_src] = _fp
+        removed = self._remove_stale(sources)
+        update_stage_record(self.meta_info_path, CRUNCH_STAGE, deltas, removed)
+        return ok
+
+    def get_steps(self, changes=None):
+        """ Returns the steps to bring bin/res up to date """
+        return [self._mirror]
@@ -0,0 +1,164 @@
+"""
+Module that serves ubs.py commands from a long-lived build daemon
+"""
+
+import os
+import json
+import errno
+import socket
+import logging
+import SocketServer
+from client import get_socket_path, connect
+from workers import stop_workers
+
+# Setting logger
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+fmt = logging.Formatter(datefmt="%H:%M:%S",
+                        fmt='%(asctime)s %(levelname)-8s: %(name)s: %(message)s')
+sh = logging.StreamHandler()
+sh.setFormatter(fmt)
+log.addHandler(sh)
+
+class _ClientStream():
+    """
+    File-like object that relays the log output to the client
+    """
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, s):
+        try:
+            self.wfile.write(json.dumps({'out': s}) + '\n')
+        except socket.error:
+            pass
+
+    def flush(self):
+        pass
+
+# Returns the stream handlers of every logger
+def _get_stream_handlers():
+    handlers = []
+    for _logger in logging.Logger.manager.loggerDict.values():
+        for _h in getattr(_logger, 'handlers', []):
+            if isinstance(_h, logging.StreamHandler) and \
+                    not isinstance(_h, logging.FileHandler):
+                handlers.append(_h)
+    return handlers
+
+def _encode(s):
+    return s.encode('utf-8') if isinstance(s, unicode) else s
+
+# Replaces the environment of the daemon
+def _set_environ(env):
+    env = dict([(_encode(_k), _encode(_v)) for _k, _v in env.items()])
+    for _k in os.environ.keys():
+        if not env.has_key(_k):
+            del os.environ[_k]
+    for _k, _v in env.items():
+        if os.environ.get(_k) != _v:
+            os.environ[_k] = _v
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Class that runs a single ubs.py request
+    """
+    def _reply(self, **kwargs):
+        try:
+            self.wfile.write(json.dumps(kwargs) + '\n')
+        except socket.error:
+            pass
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            self._reply(rc=2)
+            return
+        if request.get('cmd') == 'stop':
+            self.server.stopping = True
+            self._reply(rc=0)
+        elif request.get('cmd') == 'status':
+            self._reply(out='UBS daemon running, pid %d\n' % (os.getpid()), rc=0)
+        elif request.has_key('argv'):
+            self._reply(rc=self._run(request['argv'], request.get('cwd'),
+                                     request.get('env')))
+        else:
+            self._reply(rc=2)
+
+    def _run(self, argv, cwd=None, env=None):
+        from ubs import get_parser, run_cmds
+        stream = _ClientStream(self.wfile)
+        handlers = [(_h, _h.stream) for _h in _get_stream_handlers()]
+        curdir = os.getcwd()
+        environ = os.environ.copy()
+        try:
+            for _h, _s in handlers:
+                _h.stream = stream
+            # The request runs with the environment of the client,
+            # i.e. its UBS_SETUP_FILE, JAVA_HOME and ANDROID_HOME
+            if env is not None:
+                _set_environ(env)
+            if cwd and os.path.isdir(cwd):
+                os.chdir(cwd)
+            return run_cmds(get_parser().parse_args(argv))
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) else 1
+        except Exception:
+            log.exception('Unexpected error serving %s' % (argv))
+            return 1
+        finally:
+            os.chdir(curdir)
+            _set_environ(environ)
+            for _h, _s in handlers:
+                _h.stream = _s
+
+class Daemon(SocketServer.UnixStreamServer):
+    """
+    Class that listens for ubs.py requests on a unix domain socket
+    """
+    def __init__(self, socket_path=None):
+        self.socket_path = socket_path if socket_path else get_socket_path()
+        self.stopping = False
+        SocketServer.UnixStreamServer.__init__(self, self.socket_path,
+                                               RequestHandler)
+
+    def serve(self):
+        log.info('UBS daemon listening on "%s"' % (self.socket_path))
+        try:
+            while not self.stopping:
+                self.handle_request()
+        finally:
+            stop_workers()
+            self.server_close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+        log.info('UBS daemon stopped')
+
+# Starts serving requests, returns False if a daemon is already running
+def start_daemon(socket_path=None):
+    socket_path = socket_path if socket_path else get_socket_path()
+    sock = connect(socket_path)
+    if sock is not None:
+        sock.close()
+        log.warn('UBS daemon already running on "%s"' % (socket_path))
+        return False
+    # Remove stale socket from a daemon that didn't exit cleanly
+    try:
+        os.unlink(socket_path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    # Warm up the setup and the stage modules, they must be imported
+    # before serving so their log output can be relayed to the clients
+    import ubs, create, launch, workspace
+    from utils import BuildSetup
+    from snapshot import keep_snapshots
+    BuildSetup()
+    # Project trees are listed again only where they changed between builds
+    keep_snapshots()
+    Daemon(socket_path).serve()
+    return True
@@ -0,0 +1,127 @@
+"""
+Module that finds the android devices and emulators attached through adb
+"""
+
+import time
+import logging
+import threading
+from utils import get_command_output, get_running_pids, get_process_start_time
+
+# Setting logger
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+fmt = logging.Formatter(datefmt="%H:%M:%S",
+                        fmt='%(asctime)s %(levelname)-8s: %(name)s: %(message)s')
+sh = logging.StreamHandler()
+sh.setFormatter(fmt)
+log.addHandler(sh)
+
+# Selects every attached device
+ALL_DEVICES = 'all'
+
+# State of the devices ready to be used, others are "offline", "unauthorized", ...
+READY_STATE = 'device'
+
+# Seconds between two boot checks, doubled after each one up to BOOT_POLL_MAX
+BOOT_POLL_MIN = 0.25
+BOOT_POLL_MAX = 4.0
+
+# Seconds to wait for a device to boot unless "boot_timeout" is set up
+BOOT_TIMEOUT = 120.0
+
+# Serials adb gives to the emulators, i.e. "emulator-5554"
+EMULATOR_SERIAL_PREFIX = 'emulator-'
+
+# Identities of the devices seen booted in this session, they are not asked again
+_booted = set()
+_booted_lock = threading.Lock()
+
+# Parses the output of "adb devices", returns [(serial, state), ...]
+def parse_devices(output=None):
+    devices = []
+    for _line in (output if output else '').splitlines():
+        fields = _line.split()
+        if len(fields) < 2 or _line.startswith('List of devices') or _line.startswith('*'):
+            continue
+        devices.append((fields[0], fields[1]))
+    return devices
+
+# Returns the serial of every attached device ready to be used
+def get_devices(adb_bin=None, os_env=None, timeout=None):
+    if not adb_bin:
+        return []
+    rc, output = get_command_output([adb_bin, 'devices'],
+                                    os_env=os_env,
+                                    timeout=timeout)
+    if rc != 0:
+        log.error('Unable to list the attached devices')
+        return []
+    devices = []
+    for _serial, _state in parse_devices(output):
+        if _state == READY_STATE:
+            devices.append(_serial)
+        else:
+            log.warn('Ignoring device "%s" (%s)' % (_serial, _state))
+    return devices
+
+# Returns the serials given as "all" or "serial,serial,..."
+def resolve_devices(devices=None, adb_bin=None, os_env=None, timeout=None):
+    if devices == ALL_DEVICES:
+        return get_devices(adb_bin, os_env, timeout)
+    serials = []
+    for _s in (devices if devices else '').split(','):
+        if _s.strip() and _s.strip() not in serials:
+            serials.append(_s.strip())
+    return serials
+
+# Returns the identity of the running emulator processes, which a restarted
+# emulator doesn't share, None when no emulator is running
+def get_emulator_identity(proc_name=None):
+    pids = get_running_pids(proc_name)
+    if not pids:
+        return None
+    return tuple([(_p, get_process_start_time(_p)) for _p in pids])
+
+# Returns the key of a device in the session cache, None when it can't be
+# identified: other devices than emulators may reboot unnoticed
+def get_boot_key(serial=None, emu_proc_name=None):
+    if serial and not serial.startswith(EMULATOR_SERIAL_PREFIX):
+        return None
+    identity = get_emulator_identity(emu_proc_name)
+    if identity is None:
+        return None
+    return (serial if serial else 'emulator', identity)
+
+# Tells whether android finished booting on the device targeted by the adb command
+def is_booted(adb=None, os_env=None, timeout=None):
+    rc, output = get_command_output(adb + ['shell', 'getprop', 'sys.boot_completed'],
+                                    os_env=os_env,
+                                    timeout=timeout)
+    return rc == 0 and output.strip() == '1'
+
+# Waits until the device targeted by the adb command has booted, polling with
+# an exponential backoff until the deadline. key identifies the device in the
+# session cache, it is always asked when None. Returns True once it is ready
+def wait_for_boot(adb=None, key=None, os_env=None, timeout=None, deadline=None):
+    with _booted_lock:
+        if key is not None and key in _booted:
+            return True
+    give_up_at = time.time() + (deadline if deadline else BOOT_TIMEOUT)
+    delay = BOOT_POLL_MIN
+    while True:
+        remaining = give_up_at - time.time()
+        # The last check, after sleeping until the deadline, is still given a second
+        probe_timeout = max(min(timeout, remaining) if timeout else remaining, 1)
+        if is_booted(adb, os_env, probe_timeout):
+            if key is not None:
+                with _booted_lock:
+                    _booted.add(key)
+            return True
+        remaining = give_up_at - time.time()
+        if remaining <= 0:
+            log.error('Device did not finish booting in %d seconds' % (deadline if deadline else BOOT_TIMEOUT))
+            return False
+        log.debug('Waiting %.2fs for the device to boot' % (min(delay, remaining)))
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, BOOT_POLL_MAX)
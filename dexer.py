@@ -0,0 +1,190 @@
+"""
+Module that builds the DEX executable from pre-dexed libraries and per-class pieces
+"""
+
+import os
+import shutil
+import hashlib
+import logging
+from fingerprint import get_content_hash, get_stat_signature
+from utils import create_dir, run_command, run_commands, clean_up
+
+# Setting logger
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+fmt = logging.Formatter(datefmt="%H:%M:%S",
+                        fmt='%(asctime)s %(levelname)-8s: %(name)s: %(message)s')
+sh = logging.StreamHandler()
+sh.setFormatter(fmt)
+log.addHandler(sh)
+
+# Above this number of pieces the classes are dexed again as a whole
+MAX_PIECES = 64
+
+DEX_MERGER = 'com.android.dx.merge.DexMerger'
+
+# Returns the top level class of a class file relative to obj/,
+# i.e. "com/x/Foo$1.class" -> "com/x/Foo"
+def get_top_level_class(rel_path):
+    name = rel_path[:-len('.class')] if rel_path.endswith('.class') else rel_path
+    dirname, basename = os.path.split(name)
+    return os.path.join(dirname, basename.split('$')[0])
+
+class Dexer():
+    """
+    Class that dexes libraries once into a shared cache, dexes the changed classes
+    of the project and merges every piece into classes.dex
+    """
+    def __init__(self, project_path=None, dx_bin=None, java_bin=None,
+                 cache_path=None, os_env=None, timeout=None):
+        self.project_path = project_path
+        self.dx_bin = dx_bin
+        self.java_bin = java_bin
+        self.os_env = os_env
+        self.timeout = timeout
+        self.obj_path = os.path.join(project_path, 'obj')
+        self.libs_path = os.path.join(project_path, 'libs')
+        self.classes_dex = os.path.join(project_path, 'bin', 'classes.dex')
+        self.dex_path = os.path.join(project_path, 'bin', 'dex')
+        self.pieces_path = os.path.join(self.dex_path, 'classes')
+        self.base_dex = os.path.join(self.dex_path, 'base.dex')
+        self.base_list = os.path.join(self.dex_path, 'base.list')
+        self.predex_path = os.path.join(cache_path, 'predex') if cache_path else None
+        self.dx_jar = os.path.join(os.path.dirname(dx_bin), 'lib', 'dx.jar') if dx_bin else None
+
+    def can_merge(self):
+        return (True if self.predex_path else False) and \
+            (True if self.java_bin and os.path.exists(self.java_bin) else False) and \
+            (True if self.dx_jar and os.path.exists(self.dx_jar) else False)
+
+    def _rel(self, class_path):
+        return os.path.relpath(class_path, self.obj_path)
+
+    def _read_base_list(self):
+        if not os.path.exists(self.base_list):
+            return None
+        with open(self.base_list) as _f:
+            return [_l.rstrip('\n') for _l in _f if _l.strip()]
+
+    def _write_base_list(self, classes):
+        def _write():
+            with open(self.base_list, 'w') as _f:
+                for _c in classes:
+                    _f.write('%s\n' % (self._rel(_c)))
+            return True
+        return _write
+
+    def _reset_pieces(self):
+        clean_up(self.pieces_path)
+        create_dir(self.dex_path)
+        create_dir(self.pieces_path)
+        return True
+
+    def _get_piece(self, top_level):
+        return os.path.join(self.pieces_path,
+                            '%s.dex' % (top_level.replace(os.sep, '.')))
+
+    def _get_changed_groups(self, changes, classes):
+        # Groups the changed classes with the rest of classes of their top level class
+        changed = set([get_top_level_class(self._rel(_f)) for _f, _t in changes
+                       if _f.startswith(self.obj_path + os.sep) and _f.endswith('.class')])
+        groups = {}
+        for _c in classes:
+            top_level = get_top_level_class(self._rel(_c))
+            if top_level in changed:
+                groups.setdefault(top_level, []).append(self._rel(_c))
+        return groups
+
+    def _need_full_dex(self, groups, classes):
+        base = self._read_base_list()
+        if base is None or not os.path.exists(self.base_dex):
+            return True
+        # Removed classes would survive in the previous pieces
+        existing = set([self._rel(_c) for _c in classes])
+        if [_c for _c in base if _c not in existing]:
+            return True
+        pieces = os.listdir(self.pieces_path) if os.path.isdir(self.pieces_path) else []
+        top_levels = set([os.path.basename(self._get_piece(get_top_level_class(_c)))
+                          for _c in existing])
+        if [_p for _p in pieces if _p not in top_levels]:
+            return True
+        return len(set(pieces) | set([os.path.basename(self._get_piece(_g)) for _g in groups])) > MAX_PIECES
+
+    def _get_tool_id(self):
+        # A different dx may dex differently, dx.jar being the tool run by dx
+        return '%s:%s:%s' % (self.dx_bin, get_stat_signature(self.dx_bin),
+                             get_stat_signature(self.dx_jar))
+
+    def _predex_libs(self, libs):
+        # Returns the cached DEX of each library and the commands for the missing ones
+        dexes, cmds, renames = [], [], []
+        tool_id = self._get_tool_id()
+        for _jar in libs:
+            key = hashlib.sha1('%s\0%s' % (tool_id, get_content_hash(_jar))).hexdigest()
+            cached = os.path.join(self.predex_path, '%s.dex' % (key))
+            dexes.append(cached)
+            if not os.path.exists(cached):
+                tmp = '%s.%d.tmp.dex' % (cached[:-len('.dex')], os.getpid())
+                cmds.append([self.dx_bin, '--dex', '--output=%s' % (tmp), _jar])
+                renames.append((tmp, cached))
+        def _predex():
+            if cmds:
+                log.info('Pre-dexing %d libraries' % (len(cmds)))
+            create_dir(os.path.dirname(self.predex_path))
+            create_dir(self.predex_path)
+            if not run_commands(cmds, cwd=self.project_path,
+                                os_env=self.os_env, timeout=self.timeout):
+                return False
+            for _tmp, _cached in renames:
+                os.rename(_tmp, _cached)
+            return True
+        return dexes, _predex
+
+    def _dex_groups(self, groups):
+        def _dex():
+            log.info('Dexing %d changed classes' % (len(groups)))
+            cmds = []
+            for _top_level, _classes in sorted(groups.items()):
+                cmds.append([self.dx_bin, '--dex',
+                             '--output=%s' % (self._get_piece(_top_level))] + sorted(_classes))
+            return run_commands(cmds, cwd=self.obj_path,
+                                os_env=self.os_env, timeout=self.timeout)
+        return _dex
+
+    def _merge(self, lib_dexes):
+        def _merge():
+            pieces = [os.path.join(self.pieces_path, _p) for _p in os.listdir(self.pieces_path)]
+            # Latest pieces first, the merger keeps the first definition of a class
+            pieces.sort(key=lambda _p: os.path.getmtime(_p), reverse=True)
+            dexes = pieces + [self.base_dex] + lib_dexes
+            if len(dexes) == 1:
+                shutil.copyfile(self.base_dex, self.classes_dex)
+                return True
+            cmd = [self.java_bin, '-cp', self.dx_jar, DEX_MERGER, self.classes_dex] + dexes
+            return run_command(cmd, cwd=self.project_path,
+                               os_env=self.os_env, timeout=self.timeout) == 0
+        return _merge
+
+    def get_steps(self, changes=None, classes=None, libs=None):
+        """ Returns the steps to (re-)generate classes.dex """
+        classes = classes if classes else []
+        libs = libs if libs else []
+        if not self.can_merge():
+            # Dex everything at once
+            cmd = [self.dx_bin, '--dex',
+                   '--output=%s' % (self.classes_dex),
+                   self.obj_path,
+                   self.libs_path]
+            return [cmd]
+        lib_dexes, predex = self._predex_libs(libs)
+        groups = self._get_changed_groups(changes if changes else [], classes)
+        if self._need_full_dex(groups, classes):
+            steps = [self._reset_pieces,
+                     [self.dx_bin, '--dex', '--output=%s' % (self.base_dex), self.obj_path],
+                     self._write_base_list(classes)]
+        elif groups:
+            steps = [self._dex_groups(groups)]
+        else:
+            steps = []
+        return steps + [predex, self._merge(lib_dexes)]
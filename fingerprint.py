@@ -0,0 +1,73 @@
+"""
+Module that fingerprints files for change detection
+"""
+
+import os
+import hashlib
+
+# Size of the chunks used when hashing file contents
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Separator between the fields of a fingerprint
+FP_SEP = ','
+
+"""
+Fingerprints
+"""
+
+# Returns the cheap stat signature (size, mtime_ns, inode) of a file
+def get_stat_signature(fpath=None):
+    try:
+        st = os.stat(fpath)
+    except (OSError, TypeError):
+        return None
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return (st.st_size, mtime_ns, st.st_ino)
+
+# Returns the content hash from a absolute file path
+def get_content_hash(fpath=None):
+    hasher = hashlib.sha1()
+    try:
+        with open(fpath, 'rb') as _f:
+            while True:
+                buf = _f.read(HASH_CHUNK_SIZE)
+                if not buf:
+                    break
+                hasher.update(buf)
+    except (IOError, TypeError):
+        return ''
+    return hasher.hexdigest()
+
+# Serializes a stat signature and a content hash into a fingerprint string
+def format_fingerprint(signature, digest):
+    return FP_SEP.join(['%d' % (_v) for _v in signature] + [digest])
+
+# Parses a fingerprint string, returns (signature, digest) or (None, None)
+def parse_fingerprint(fingerprint=None):
+    if fingerprint:
+        fields = fingerprint.split(FP_SEP)
+        if len(fields) == 4:
+            try:
+                return tuple([int(_v) for _v in fields[:3]]), fields[3]
+            except ValueError:
+                pass
+    return None, None
+
+# Computes the fingerprint of a file given its previous one.
+# The contents are only hashed when the stat signature differs from
+# the previous one and from the known one, a fingerprint already taken
+# in this build (i.e. by the stage which wrote the file).
+# Returns (fingerprint, modified)
+def get_file_fingerprint(fpath, old_fingerprint=None, known_fingerprint=None):
+    signature = get_stat_signature(fpath)
+    if signature is None:
+        return '', True
+    old_signature, old_digest = parse_fingerprint(old_fingerprint)
+    if old_signature == signature:
+        return old_fingerprint, False
+    known_signature, digest = parse_fingerprint(known_fingerprint)
+    if known_signature != signature:
+        digest = get_content_hash(fpath)
+    return format_fingerprint(signature, digest), digest != old_digest
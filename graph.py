@@ -0,0 +1,423 @@
+"""
+Module that schedules the stages of a build as a dependency graph
+"""
+
+import os
+import time
+import Queue
+import logging
+import threading
+from tracing import span
+from fingerprint import get_file_fingerprint, parse_fingerprint
+from artifacts import unshare_file
+from utils import create_dir, find_file, get_files, run_command, \
+    check_if_new_or_modified_files, record_outputs, \
+    get_stage_record, update_stage_record
+
+# Setting logger
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+fmt = logging.Formatter(datefmt="%H:%M:%S",
+                        fmt='%(asctime)s %(levelname)-8s: %(name)s: %(message)s')
+sh = logging.StreamHandler()
+sh.setFormatter(fmt)
+log.addHandler(sh)
+
+# Node results
+DONE = 'done'
+UP_TO_DATE = 'up-to-date'
+FAILED = 'failed'
+MISSING = 'missing'
+SKIPPED = 'skipped'
+# The stage would run, only on dry runs
+PLANNED = 'planned'
+
+SUCCEEDED = (DONE, UP_TO_DATE, PLANNED)
+
+# Stage under which the fingerprints of the outputs of a stage are recorded
+OUTPUTS_STAGE = '%s outputs'
+
+# Describes the files of an output (dir, filename), i.e. "obj/*.class"
+def _format_output(dir, filename):
+    return os.path.join(dir, '*%s' % (filename)) if dir else '*%s' % (filename)
+
+class Node():
+    """
+    Class that declares a build stage: its dependencies, inputs, outputs and commands
+
+    inputs   -- list of (dir, exts) whose new/modified files trigger the stage
+    outputs  -- list of (dir, filename) that must exist after the stage
+    requires -- callable telling whether tools and inputs are available
+    commands -- callable given the new/modified inputs and returning the steps
+                to run, each step is either a command line (list) or a
+                callable returning True on success
+    always   -- the stage runs on every build (i.e. install/launch)
+    cache    -- the outputs can be taken from the artifact cache when every
+                step is a command line, its inputs being the only ones
+    """
+    def __init__(self, name, deps=None, inputs=None, outputs=None,
+                 requires=None, commands=None, always=False, timeout=None,
+                 desc=None, done=None, skip=None, missing=None, failed=None,
+                 cache=False):
+        self.name = name
+        self.deps = deps if deps else []
+        self.inputs = inputs if inputs else []
+        self.outputs = outputs if outputs else []
+        self.requires = requires
+        self.commands = commands
+        self.always = always
+        self.timeout = timeout
+        self.cache = cache
+        # Log messages
+        self.desc = desc
+        self.done = done
+        self.skip = skip
+        self.missing = missing if missing else 'Missing inputs and/or tools for "%s"!' % (name)
+        self.failed = failed if failed else 'Failed on "%s"!' % (name)
+
+class Graph():
+    """
+    Class that runs the nodes of a build graph, independent nodes run concurrently.
+    With explain the reasons of every stage to run or not are logged, a dry run
+    explains them without running any tool nor storing any fingerprint
+    """
+    def __init__(self, project_path=None, meta_info_path=None,
+                 os_env=None, logger=None, snapshot=None, cache=None,
+                 explain=False, dry_run=False):
+        self.project_path = project_path
+        self.meta_info_path = meta_info_path
+        # Artifact cache shared by the projects, if any
+        self.cache = cache
+        self.os_env = os_env
+        self.snapshot = snapshot
+        self.log = logger if logger else log
+        self.dry_run = dry_run
+        self.explain = explain or dry_run
+        self.nodes = {}
+        self.order = []
+        self.results = {}
+        # {node name: seconds it took}
+        self.times = {}
+        # {node name: whether its outputs changed in this build}
+        self.changed = {}
+        # {output path: fingerprint} taken once the stage writing it is done
+        self.fingerprints = {}
+
+    def add(self, node):
+        if self.nodes.has_key(node.name):
+            raise ValueError('Node "%s" already in graph' % (node.name))
+        self.nodes[node.name] = node
+        self.order.append(node.name)
+        return node
+
+    def extend(self, nodes):
+        for _n in nodes:
+            self.add(_n)
+
+    def _path(self, dir):
+        return os.path.join(self.project_path, dir)
+
+    def _is_unchanged_upstream(self, node, dir, exts, pending=None):
+        # The inputs are outputs of dependencies which ran in this build and
+        # are the same contents the stage consumed the last time it ran
+        producers = [_d for _d in node.deps
+                     if [_e for _e in exts if (dir, _e) in self.nodes[_d].outputs]]
+        for _ext in exts:
+            if not [_d for _d in producers if (dir, _ext) in self.nodes[_d].outputs]:
+                return False
+        if [_d for _d in producers if not self.changed.has_key(_d)]:
+            return False
+        prefix = os.path.join(self._path(dir), '')
+        def in_dir(_f):
+            return _f.startswith(prefix) and [_e for _e in exts if _f.endswith(_e)]
+        produced = {}
+        for _d in producers:
+            for _f, _fp in get_stage_record(self.meta_info_path, OUTPUTS_STAGE % (_d),
+                                            self.dry_run).items():
+                if in_dir(_f):
+                    produced[_f] = _fp
+        consumed = dict([(_f, _fp) for _f, _fp in
+                         get_stage_record(self.meta_info_path, node.name, self.dry_run).items()
+                         if in_dir(_f)])
+        if not produced or sorted(produced.keys()) != sorted(consumed.keys()) or \
+                [_f for _f in produced
+                 if parse_fingerprint(produced[_f])[1] != parse_fingerprint(consumed[_f])[1]]:
+            return False
+        # Same contents, only the stat signatures are brought up to date
+        if pending is not None:
+            pending.update(dict([(_f, _fp) for _f, _fp in produced.items()
+                                 if _fp != consumed[_f]]))
+        return True
+
+    def _get_changes(self, node, pending=None, changed=None, unchecked=None):
+        # pending gets the new fingerprints of the inputs, changed
+        # {path: (old fingerprint, new fingerprint)} of the changes,
+        # unchecked the (dir, exts) left to unchanged dependencies
+        changes = []
+        for _dir, _exts in node.inputs:
+            if self._is_unchanged_upstream(node, _dir, _exts, pending):
+                if unchecked is not None:
+                    unchecked.append((_dir, _exts))
+                continue
+            changes.extend(check_if_new_or_modified_files(self.meta_info_path,
+                                                          self._path(_dir),
+                                                          _exts,
+                                                          stage=node.name,
+                                                          snapshot=self.snapshot,
+                                                          known=self.fingerprints,
+                                                          pending=pending,
+                                                          changed=changed,
+                                                          read_only=self.dry_run))
+        return changes
+
+    def _commit_inputs(self, node, pending):
+        # Fingerprints of the inputs are stored once the stage succeeded,
+        # so a failed stage sees the same changes on the next build
+        if self.dry_run or not pending:
+            return
+        update_stage_record(self.meta_info_path, node.name,
+                            dict([(_f, _fp) for _f, _fp in pending.items() if _fp is not None]),
+                            [_f for _f, _fp in pending.items() if _fp is None])
+
+    def _get_missing_outputs(self, node):
+        return [(_dir, _filename) for _dir, _filename in node.outputs
+                if not find_file(self._path(_dir), _filename, self.snapshot)]
+
+    def _check_outputs(self, node):
+        return len(self._get_missing_outputs(node)) == 0
+
+    def _get_reasons(self, node, changes, planned=None):
+        # Why the stage has to run, none when it is up to date
+        if node.always:
+            return ['the stage always runs']
+        if not node.inputs:
+            return ['the stage has no inputs to check']
+        reasons = []
+        if planned:
+            reasons.append('outputs of %s may change' % (
+                ', '.join(['"%s"' % (_d) for _d in planned])))
+        if changes:
+            reasons.append('%d new/modified inputs' % (len(changes)))
+        for _dir, _filename in self._get_missing_outputs(node):
+            reasons.append('output "%s" is missing' % (_format_output(_dir, _filename)))
+        return reasons
+
+    def _explain(self, node, line):
+        self.log.info('Explain "%s": %s' % (node.name, line))
+
+    def _explain_decision(self, node, reasons, changes, changed, unchecked):
+        if reasons:
+            self._explain(node, '%s: %s' % ('would run' if self.dry_run else 'runs',
+                                            '; '.join(reasons)))
+        else:
+            self._explain(node, 'up to date, no new/modified inputs and no output missing')
+        for _f, _t in changes:
+            old_fp, new_fp = changed.get(_f, (None, None))
+            self._explain(node, '\t%s\t%s\t%s -> %s' % (_t, os.path.relpath(_f, self.project_path),
+                                                         old_fp if old_fp else '(new)',
+                                                         new_fp if new_fp else '(deleted)'))
+        for _dir, _exts in unchecked:
+            producers = [_d for _d in node.deps
+                         if [_e for _e in _exts if (_dir, _e) in self.nodes[_d].outputs]]
+            self._explain(node, '\t%s not checked, same outputs of %s as last consumed' % (
+                ', '.join([_format_output(_dir, _e) for _e in _exts]),
+                ', '.join(['"%s"' % (_d) for _d in producers])))
+
+    def _explain_missing(self, node):
+        # Outputs of the dependencies the stage requires
+        missing = [(_d, _o) for _d in node.deps
+                   for _o in self._get_missing_outputs(self.nodes[_d])]
+        if not missing:
+            self._explain(node, 'missing: its inputs and/or tools are not available')
+        for _dep, (_dir, _filename) in missing:
+            self._explain(node, 'missing: output "%s" of "%s" is missing' % (
+                _format_output(_dir, _filename), _dep))
+
+    def _run_commands(self, node, steps):
+        for _step in steps:
+            if callable(_step):
+                with span(getattr(_step, '__name__', 'step'), 'step', stage=node.name):
+                    ok = _step()
+                if not ok:
+                    return False
+            elif run_command(_step,
+                             cwd=self.project_path,
+                             os_env=self.os_env,
+                             timeout=node.timeout) != 0:
+                return False
+        return True
+
+    def _get_action_key(self, node, steps, pending=None):
+        # None unless the outputs of the stage can come from the artifact cache
+        if self.cache is None or not node.cache or not steps or \
+                [_s for _s in steps if callable(_s)]:
+            return None
+        old_fps = get_stage_record(self.meta_info_path, node.name)
+        inputs = []
+        with span('action key', 'fingerprint', stage=node.name):
+            for _dir, _exts in node.inputs:
+                for _f in get_files(self._path(_dir), _exts, self.snapshot):
+                    known = pending.get(_f) if pending else None
+                    fp, _modified = get_file_fingerprint(_f, old_fps.get(_f),
+                                                         known if known else self.fingerprints.get(_f))
+                    inputs.append((_f, parse_fingerprint(fp)[1]))
+            return self.cache.get_action_key(node.name, steps, self.project_path, inputs)
+
+    def _unshare_outputs(self, node):
+        # Outputs restored from the cache may be hard links to it
+        if self.cache is not None and node.cache:
+            for _f in self._get_outputs(node):
+                unshare_file(_f)
+
+    def _refresh_outputs(self, node):
+        # Only the directories the stage wrote to are re-scanned
+        if self.snapshot is not None:
+            for _dir in set([_d for _d, _f in node.outputs]):
+                self.snapshot.refresh(self._path(_dir))
+
+    def _get_outputs(self, node):
+        files = []
+        for _dir, _filename in node.outputs:
+            files.extend(find_file(self._path(_dir), _filename, self.snapshot))
+        return files
+
+    def _compare_outputs(self, node, files):
+        # Tells whether the contents of the outputs differ from the last build's
+        stage = OUTPUTS_STAGE % (node.name)
+        old_fps = get_stage_record(self.meta_info_path, stage)
+        deltas = {}
+        changed = False
+        with span('compare outputs', 'fingerprint', stage=node.name) as sp:
+            for _f in files:
+                fp, modified = get_file_fingerprint(_f, old_fps.get(_f))
+                self.fingerprints[_f] = fp
+                changed = changed or modified
+                if fp != old_fps.get(_f):
+                    deltas[_f] = fp
+            removed = set(old_fps.keys()) - set(files)
+            sp.set(outputs=len(files), changed=changed, removed=len(removed))
+        update_stage_record(self.meta_info_path, stage, deltas, removed)
+        return changed or len(removed) > 0
+
+    def _run_node(self, node):
+        # Dependencies which would run on a dry run, their outputs are not there yet
+        planned = [_d for _d in node.deps if self.results.get(_d) == PLANNED]
+        if node.requires and not node.requires() and not planned:
+            self.log.warn(node.missing)
+            if self.explain:
+                self._explain_missing(node)
+            return MISSING
+        if not self.dry_run:
+            for _dir, _filename in node.outputs:
+                create_dir(self._path(_dir))
+            if node.desc:
+                self.log.info(node.desc)
+        pending = {}
+        changed = {}
+        unchecked = []
+        with span('check %s' % (node.name), 'check', stage=node.name):
+            changes = self._get_changes(node, pending, changed, unchecked)
+        reasons = self._get_reasons(node, changes, planned)
+        if self.explain:
+            self._explain_decision(node, reasons, changes, changed, unchecked)
+        if not reasons:
+            self._commit_inputs(node, pending)
+            self.changed[node.name] = False
+            if node.skip and not self.dry_run:
+                self.log.info(node.skip)
+            return UP_TO_DATE
+        if self.dry_run:
+            return PLANNED
+        steps = node.commands(changes) if node.commands else []
+        key = self._get_action_key(node, steps, pending)
+        restored = False
+        if key is not None:
+            with span('restore', 'cache', stage=node.name) as sp:
+                restored = self.cache.restore(key, self.project_path)
+                sp.set(hit=restored)
+        if restored:
+            self.log.info('Restored the outputs of "%s" from the artifact cache' % (node.name))
+            ok = True
+        else:
+            self._unshare_outputs(node)
+            ok = self._run_commands(node, steps)
+        self._refresh_outputs(node)
+        if not ok or not self._check_outputs(node):
+            self.log.warn(node.failed)
+            return FAILED
+        outputs = self._get_outputs(node)
+        record_outputs(self.meta_info_path, node.name, outputs)
+        if key is not None and not restored:
+            with span('store', 'cache', stage=node.name):
+                self.cache.store(key, node.name, self.project_path, outputs)
+        self.changed[node.name] = self._compare_outputs(node, outputs)
+        self._commit_inputs(node, pending)
+        if node.done:
+            self.log.info(node.done)
+        if outputs and not self.changed[node.name]:
+            self.log.info('Outputs of "%s" did not change' % (node.name))
+        return DONE
+
+    def _worker(self, node, done_queue):
+        start = time.time()
+        try:
+            with span(node.name, 'stage', project=os.path.basename(self.project_path)) as sp:
+                result = self._run_node(node)
+                sp.set(result=result)
+        except Exception:
+            self.log.exception('Unexpected error on "%s"' % (node.name))
+            result = FAILED
+        self.times[node.name] = time.time() - start
+        done_queue.put((node.name, result))
+
+    def _validate(self):
+        for _name in self.order:
+            for _dep in self.nodes[_name].deps:
+                if not self.nodes.has_key(_dep):
+                    raise ValueError('Node "%s" depends on unknown node "%s"' % (_name, _dep))
+
+    def run(self, jobs=None):
+        """ Runs the graph, returns True if every node succeeded """
+        self._validate()
+        jobs = jobs if jobs and jobs > 0 else len(self.order)
+        self.results = {}
+        self.times = {}
+        self.changed = {}
+        self.fingerprints = {}
+        pending = list(self.order)
+        running = set()
+        done_queue = Queue.Queue()
+        while pending or running:
+            scheduled = True
+            while scheduled:
+                scheduled = False
+                for _name in list(pending):
+                    deps = self.nodes[_name].deps
+                    if not all([self.results.has_key(_d) for _d in deps]):
+                        continue
+                    if not all([self.results[_d] in SUCCEEDED for _d in deps]):
+                        self.results[_name] = SKIPPED
+                    elif len(running) < jobs:
+                        running.add(_name)
+                        t = threading.Thread(target=self._worker,
+                                             args=(self.nodes[_name], done_queue))
+                        t.daemon = True
+                        t.start()
+                    else:
+                        continue
+                    pending.remove(_name)
+                    scheduled = True
+            if not running:
+                if pending:
+                    raise ValueError('Cycle between nodes: %s' % (', '.join(pending)))
+                break
+            name, result = done_queue.get()
+            running.remove(name)
+            self.results[name] = result
+        if self.dry_run:
+            planned = [_n for _n in self.order if self.results.get(_n) == PLANNED]
+            self.log.info('Dry run: %d of %d stages would run%s' % (
+                len(planned), len(self.order),
+                ': %s' % (', '.join(planned)) if planned else ''))
+        return all([_r in SUCCEEDED for _r in self.results.values()])
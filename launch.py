@@ -3,8 +3,19 @@ Module that launches a specific android application on the active simulator
 """
 
 import os
+import re
 import logging
-from utils import BuildSetup, execute_command, find_file, get_num_of_running_procs
+from graph import Graph, Node, SUCCEEDED
+from snapshot import get_snapshot
+from devices import resolve_devices, wait_for_boot, get_boot_key
+from fingerprint import get_file_fingerprint
+from utils import BuildSetup, find_file, get_running_pids, \
+    get_command_output, get_stage_record, update_stage_record, create_file
+
+# Key of the version code in the install records
+VERSION_CODE_KEY = 'versionCode'
+
+_version_code_re = re.compile(r'android:versionCode\s*=\s*"([^"]*)"')
 
 # Setting logger
 log = logging.getLogger(__name__)
@@ -29,6 +40,8 @@ class Launch():
         self.zipped_prefix = bs.get_zipped_prefix()
         self.emu_proc_name  = bs.get_emu_proc_name()
         self.activity_name = bs.get_activity_name()
+        self.adb_timeout = bs.get_timeout('adb')
+        self.boot_timeout = bs.get_timeout('boot')
         # Local setup
         if not kwargs.has_key('name'):
             log.warn('No project name given!')
@@ -36,18 +49,32 @@ class Launch():
         self.project_name = kwargs['name']
         self.project_path = os.path.join(bs.get_workspace_path(),
                                          self.project_name)
+        # Files of the project, scanned once per build
+        self.snapshot = kwargs['snapshot'] if kwargs.has_key('snapshot') else \
+            get_snapshot(self.project_path)
         self.package_name = 'com.%s.%s' % (self.author,
                                            self.project_name)
         self.app_activity = '%s/.%s'%(self.package_name,
                                       self.activity_name)
+        self.app_manifest = os.path.join(self.project_path,
+                                         'AndroidManifest.xml')
+        self.meta_info_path = os.path.join(self.project_path,
+                                           'meta.info')
+        create_file(self.meta_info_path)
+        # "all" or "serial,serial,...", the running emulator when not given
+        self.devices = kwargs['devices'] if kwargs.has_key('devices') else None
+        self.serials = []
+        # Number of adb commands run at the same time
+        self.jobs = kwargs['jobs'] if kwargs.has_key('jobs') else None
 
     def _find_file(self, dir=None, filename=None):
         return find_file(os.path.join(self.project_path,
                                       dir),
-                          filename)
+                          filename,
+                          self.snapshot)
 
     def _check_if_emulator_is_running(self):
-        return get_num_of_running_procs(self.emu_proc_name) > 0
+        return len(get_running_pids(self.emu_proc_name)) > 0
 
     def _check_aligned_apk(self):
         return len(self._find_file('bin','.%s.apk'%(self.zipped_prefix))) > 0
@@ -58,56 +85,197 @@ class Launch():
             return apks.pop()
         return None
 
-    def _install_app_PRE(self):
-        if os.path.exists(self.project_path):
-            if self._check_if_emulator_is_running():
-                if self._check_aligned_apk() and \
-                        (True if self.adb_bin else False):
-                    log.info('Installing application into the emulator')
-                    self._install_app_task()
-                else:
-                    log.warn('Not apk and/or adb tool found!')
-            else:
-                log.warn('Emulator is not running! Please r e-run setup.sh script')
-        else:
-            log.warn('Project "%s" does not exist in workspace!' % (self.project_name))
+    def _requires_install_app(self):
+        return self._check_aligned_apk() and \
+            (True if self.adb_bin else False)
 
-    def _install_app_task(self):
-        # Install the application into emulator
-        cmd = [ self.adb_bin, '-e', 'install', '-r', self._get_aligned_apk() ]
-        if execute_command(cmd, cwd=self.project_path, os_env=self.os_environ):
-            log.info('Installed application "%s.%s.apk" to emulator'%(self.project_name,
-                                                                      self.zipped_prefix))
-        self._install_app_POST()
+    def _get_adb(self, serial=None):
+        # adb targeting the given device, the emulator otherwise
+        if serial:
+            return [ self.adb_bin, '-s', serial ]
+        return [ self.adb_bin, '-e' ]
+
+    def _wait_for_boot_cmds(self, changes=None, serial=None):
+        def wait_for_boot_step():
+            # Identified when the step runs, the emulator may have been restarted
+            return wait_for_boot(self._get_adb(serial),
+                                 get_boot_key(serial, self.emu_proc_name),
+                                 os_env=self.os_environ,
+                                 timeout=self.adb_timeout,
+                                 deadline=self.boot_timeout)
+        return [wait_for_boot_step]
+
+    def _get_version_code(self):
+        try:
+            with open(self.app_manifest) as _f:
+                match = _version_code_re.search(_f.read())
+        except IOError:
+            return None
+        return match.group(1) if match else None
+
+    def _get_install_stage(self, serial=None):
+        # Install records are kept per device
+        return 'installed %s' % (serial if serial else 'emulator')
+
+    def _is_on_device(self, serial=None):
+        rc, output = get_command_output(self._get_adb(serial) + [ 'shell', 'pm', 'path', self.package_name ],
+                                        os_env=self.os_environ,
+                                        timeout=self.adb_timeout)
+        return rc == 0 and 'package:' in output
 
-    def _install_app_POST(self):
-        self._launch_app_PRE()
+    def _is_installed(self, serial=None, apk=None):
+        # The same apk was installed and the device still has the package
+        record = get_stage_record(self.meta_info_path, self._get_install_stage(serial))
+        if not record.has_key(apk) or \
+                record.get(VERSION_CODE_KEY) != self._get_version_code():
+            return False
+        _fp, modified = get_file_fingerprint(apk, record[apk])
+        return not modified and self._is_on_device(serial)
 
-    def _launch_app_PRE(self):
-        if  (True if self.adb_bin else False) and \
+    def _record_install(self, serial=None, apk=None):
+        def _record():
+            fp, _modified = get_file_fingerprint(apk)
+            record = {apk: fp}
+            version_code = self._get_version_code()
+            if version_code:
+                record[VERSION_CODE_KEY] = version_code
+            update_stage_record(self.meta_info_path, self._get_install_stage(serial), record)
+            return True
+        return _record
+
+    def _install_app_cmds(self, changes=None, serial=None):
+        apk = self._get_aligned_apk()
+        if self._is_installed(serial, apk):
+            log.info('"%s" is already installed in %s' % (os.path.basename(apk),
+                                                          '"%s"' % (serial) if serial else 'the emulator'))
+            return []
+        # Install the application into emulator
+        cmd = self._get_adb(serial) + [ 'install', '-r', apk ]
+        return [cmd, self._record_install(serial, apk)]
+
+    def _requires_launch_app(self):
+        return (True if self.adb_bin else False) and \
             (True if self.app_activity else False) and \
-            (True if self.activity_name else False):
-            log.info('Launching the application in the emulator')
-            self._launch_app_task()
-        else:
-            log.warn('Not activity name and/or adb tool found!')
+            (True if self.activity_name else False)
 
-    def _launch_app_task(self):
+    def _launch_app_cmds(self, changes=None, serial=None):
         # Launch the application into emulator
-        cmd = [ self.adb_bin, 'shell',  'am',  'start',  '-n', self.app_activity ]
-        if execute_command(cmd, cwd=self.project_path, os_env=self.os_environ):
-            log.info('Launched the application in the emulator')
-        self._launch_app_POST()
+        cmd = [ self.adb_bin ] + \
+            ([ '-s', serial ] if serial else []) + \
+            [ 'shell',  'am',  'start',  '-n', self.app_activity ]
+        return [cmd]
+
+    def _get_device_nodes(self, serial):
+        return [
+            Node('boot %s' % (serial),
+                 requires=self._requires_install_app,
+                 commands=lambda changes: self._wait_for_boot_cmds(changes, serial),
+                 always=True,
+                 desc='Waiting for "%s" to boot' % (serial),
+                 failed='"%s" is not booted!' % (serial)),
+            Node('install %s' % (serial),
+                 deps=['boot %s' % (serial)],
+                 requires=self._requires_install_app,
+                 commands=lambda changes: self._install_app_cmds(changes, serial),
+                 always=True,
+                 timeout=self.adb_timeout,
+                 desc='Installing application into "%s"' % (serial),
+                 done='Installed application "%s.%s.apk" to "%s"' % (self.project_name,
+                                                                     self.zipped_prefix,
+                                                                     serial),
+                 missing='Not apk and/or adb tool found!',
+                 failed='Failed on installing application into "%s"!' % (serial)),
+            Node('launch %s' % (serial),
+                 deps=['install %s' % (serial)],
+                 requires=self._requires_launch_app,
+                 commands=lambda changes: self._launch_app_cmds(changes, serial),
+                 always=True,
+                 timeout=self.adb_timeout,
+                 desc='Launching the application in "%s"' % (serial),
+                 done='Launched the application in "%s"' % (serial),
+                 missing='Not activity name and/or adb tool found!',
+                 failed='Failed on launching the application in "%s"!' % (serial)),
+        ]
 
-    def _launch_app_POST(self):
-        pass
+    def get_nodes(self):
+        """ Returns the stages to install and launch the application """
+        if self.serials:
+            # Devices are independent, installs run concurrently
+            nodes = []
+            for _serial in self.serials:
+                nodes.extend(self._get_device_nodes(_serial))
+            return nodes
+        return [
+            Node('boot',
+                 requires=self._requires_install_app,
+                 commands=self._wait_for_boot_cmds,
+                 always=True,
+                 desc='Waiting for the emulator to boot',
+                 failed='The emulator is not booted!'),
+            Node('install',
+                 deps=['boot'],
+                 requires=self._requires_install_app,
+                 commands=self._install_app_cmds,
+                 always=True,
+                 timeout=self.adb_timeout,
+                 desc='Installing application into the emulator',
+                 done='Installed application "%s.%s.apk" to emulator'%(self.project_name,
+                                                                       self.zipped_prefix),
+                 missing='Not apk and/or adb tool found!',
+                 failed='Failed on installing application into the emulator!'),
+            Node('launch',
+                 deps=['install'],
+                 requires=self._requires_launch_app,
+                 commands=self._launch_app_cmds,
+                 always=True,
+                 timeout=self.adb_timeout,
+                 desc='Launching the application in the emulator',
+                 done='Launched the application in the emulator',
+                 missing='Not activity name and/or adb tool found!',
+                 failed='Failed on launching the application in the emulator!'),
+        ]
+
+    def get_graph(self):
+        graph = Graph(project_path=self.project_path,
+                      os_env=self.os_environ,
+                      logger=log,
+                      snapshot=self.snapshot)
+        graph.extend(self.get_nodes())
+        return graph
+
+    def _print_summary(self, graph):
+        log.info('Summary of launch:')
+        for _serial in self.serials:
+            install = graph.results.get('install %s' % (_serial))
+            launch = graph.results.get('launch %s' % (_serial))
+            elapsed = sum([graph.times.get('%s %s' % (_stage, _serial), 0)
+                           for _stage in ('boot', 'install', 'launch')])
+            log.info('\t%-8s %7.2fs\t%s\t(install: %s, launch: %s)' % (
+                'OK' if install in SUCCEEDED and launch in SUCCEEDED else 'FAILED',
+                elapsed, _serial, install, launch))
 
     def launch_project(self):
-        self._install_app_PRE()
+        if not os.path.exists(self.project_path):
+            log.warn('Project "%s" does not exist in workspace!' % (self.project_name))
+            return False
+        if self.devices:
+            self.serials = resolve_devices(self.devices, self.adb_bin,
+                                           self.os_environ, self.adb_timeout)
+            if not self.serials:
+                log.warn('No devices to launch the application on!')
+                return False
+        elif not self._check_if_emulator_is_running():
+            log.warn('Emulator is not running! Please r e-run setup.sh script')
+            return False
+        graph = self.get_graph()
+        ok = graph.run(self.jobs)
+        if self.serials:
+            self._print_summary(graph)
+        return ok
 
 def launch_project(*args, **kwargs):
     l = Launch(*args, **kwargs)
-    l.launch_project()
+    return l.launch_project()
 
 if __name__ == '__main__':
     launch_project(name='HelloWorld')
\ No newline at end of file
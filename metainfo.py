@@ -0,0 +1,139 @@
+"""
+Module that stores the fingerprints of meta.info in a base file plus an append-only journal.
+The build index (buildindex.py) only uses it where sqlite3 is not available, and to
+import the fingerprints of an existing meta.info when meta.db is created
+"""
+
+import os
+import threading
+from props import Properties
+from fingerprint import get_stat_signature
+
+# First line of the base file, older meta.info files are java properties
+HEADER = '# ubs fingerprints 1\n'
+
+# Separator between key and fingerprint, neither paths nor fingerprints have tabs
+SEP = '\t'
+
+JOURNAL_SUFFIX = '.journal'
+
+# The journal is compacted into the base file once it has this many entries
+# and at least half as many as the base file
+COMPACT_MIN_ENTRIES = 1024
+
+# {meta info path: FingerprintStore}
+_stores = {}
+_stores_lock = threading.Lock()
+
+# Parses "key<TAB>fingerprint" lines, a torn last line is ignored and
+# an empty fingerprint removes the key
+def _parse_entries(lines, entries):
+    count = 0
+    for _l in lines:
+        if not _l.endswith('\n') or _l.startswith('#'):
+            continue
+        key, sep, fp = _l[:-1].partition(SEP)
+        if sep:
+            if fp:
+                entries[key] = fp
+            else:
+                entries.pop(key, None)
+            count += 1
+    return count
+
+class FingerprintStore():
+    """
+    Class that keeps the fingerprints of a project in memory, appends the
+    changed ones to a journal and compacts the journal into the base file
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.journal_path = path + JOURNAL_SUFFIX
+        self._entries = {}
+        self._journal_entries = 0
+        self._legacy = False
+        self._signature = None
+
+    def _get_signature(self):
+        return (get_stat_signature(self.path), get_stat_signature(self.journal_path))
+
+    def _load_base(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return
+        with open(self.path) as _f:
+            first = _f.readline()
+            if first == HEADER:
+                _parse_entries(_f, self._entries)
+                return
+        # Older meta.info, rewritten in the new format on the next compaction
+        p = Properties()
+        with open(self.path) as _f:
+            p.load(_f)
+        self._entries.update(p.getPropertyDict())
+        self._legacy = True
+
+    def load(self):
+        """ (Re-)loads the fingerprints if another process changed the files """
+        signature = self._get_signature()
+        if signature == self._signature:
+            return
+        self._entries = {}
+        self._journal_entries = 0
+        self._legacy = False
+        self._load_base()
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as _f:
+                self._journal_entries += _parse_entries(_f, self._entries)
+        self._signature = signature
+
+    def get(self, key, default=None):
+        return self._entries.get(key, default)
+
+    def items(self):
+        return self._entries.items()
+
+    def update(self, deltas, removed=None):
+        """ Appends the changed fingerprints and the removed keys to the journal,
+        nothing is written without changes """
+        deltas = dict([(_k, _v) for _k, _v in deltas.items()
+                       if _v and self._entries.get(_k) != _v])
+        deltas.update(dict([(_k, '') for _k in (removed if removed else [])
+                            if self._entries.has_key(_k)]))
+        if not deltas:
+            return
+        for _k, _v in deltas.items():
+            if _v:
+                self._entries[_k] = _v
+            else:
+                del self._entries[_k]
+        with open(self.journal_path, 'a') as _f:
+            _f.write(''.join(['%s%s%s\n' % (_k, SEP, _v) for _k, _v in sorted(deltas.items())]))
+        self._journal_entries += len(deltas)
+        if self._legacy or \
+                (self._journal_entries >= COMPACT_MIN_ENTRIES and \
+                 self._journal_entries * 2 >= len(self._entries)):
+            self.compact()
+        else:
+            self._signature = self._get_signature()
+
+    def compact(self):
+        """ Writes every fingerprint to the base file atomically and empties the journal """
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as _f:
+            _f.write(HEADER)
+            _f.write(''.join(['%s%s%s\n' % (_k, SEP, _v) for _k, _v in sorted(self._entries.items())]))
+        os.rename(tmp_path, self.path)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self._journal_entries = 0
+        self._legacy = False
+        self._signature = self._get_signature()
+
+# Returns the loaded fingerprint store of a meta.info file, shared between stages
+def get_fingerprint_store(meta_info_path):
+    with _stores_lock:
+        if not _stores.has_key(meta_info_path):
+            _stores[meta_info_path] = FingerprintStore(meta_info_path)
+        store = _stores[meta_info_path]
+    store.load()
+    return store
@@ -3,9 +3,18 @@ Module that generates, signs debug and zip aligns a specific android package
 """
 
 import os
+import shutil
 import logging
-from utils import BuildSetup, execute_command, check_files, \
-    get_files, find_file, check_if_new_or_modified_files
+from graph import Graph, Node
+from snapshot import get_snapshot
+from artifacts import get_artifact_cache
+from compile import Compile
+from cruncher import Cruncher
+from apk import write_apk, align_apk
+from signer import SigningApkWriter, SigningError, \
+    load_jks_entry, is_jks_key_store
+from utils import BuildSetup, create_file, check_files, \
+    get_files, find_file
 
 # Setting logger
 log = logging.getLogger(__name__)
@@ -17,6 +26,10 @@ sh = logging.StreamHandler()
 sh.setFormatter(fmt)
 log.addHandler(sh)
 
+# Packaging modes: build tools (aapt, zipalign) or in-process
+TOOLS_PACKAGING = 'tools'
+PYTHON_PACKAGING = 'python'
+
 class Package():
     """
     Class that generates, signs debug and zip aligns a specific android package
@@ -41,6 +54,11 @@ class Package():
         self.unsigned_prefix = bs.get_unsigned_prefix()
         self.signed_prefix = bs.get_signed_prefix()
         self.zipped_prefix = bs.get_zipped_prefix()
+        self.packaging_mode = bs.get_packaging_mode()
+        self.cache_path = bs.get_cache_path()
+        self.aapt_timeout = bs.get_timeout('aapt')
+        self.jarsigner_timeout = bs.get_timeout('jarsigner')
+        self.zipalign_timeout = bs.get_timeout('zipalign')
 
         # Local setup
         if not kwargs.has_key('name'):
@@ -49,26 +67,50 @@ class Package():
         self.project_name = kwargs['name']
         self.project_path = os.path.join(bs.get_workspace_path(),
                                          self.project_name)
+        # Files of the project, scanned once per build
+        self.snapshot = kwargs['snapshot'] if kwargs.has_key('snapshot') else \
+            get_snapshot(self.project_path)
         self.package_name = 'com.%s.%s'%(self.author,
                                          self.project_name)
         self.app_manifest = os.path.join(self.project_path,
                                          'AndroidManifest.xml')
+        # Log why each stage runs or not, without running any on a dry run
+        self.explain = kwargs['explain'] if kwargs.has_key('explain') else False
+        self.dry_run = kwargs['dry_run'] if kwargs.has_key('dry_run') else False
         self.meta_info_path = os.path.join(self.project_path,
                                            'meta.info')
+        # Nothing is written on a dry run
+        if not self.dry_run:
+            create_file(self.meta_info_path)
+        # Number of javac shards and PNG crunches run at the same time
+        self.jobs = kwargs['jobs'] if kwargs.has_key('jobs') else None
+        self.cruncher = Cruncher(project_path=self.project_path,
+                                 aapt_bin=self.aapt_bin,
+                                 cache_path=self.cache_path,
+                                 meta_info_path=self.meta_info_path,
+                                 snapshot=self.snapshot,
+                                 os_env=self.os_environ,
+                                 timeout=self.aapt_timeout,
+                                 jobs=self.jobs)
+        # Resources are packaged from bin/res once their PNGs are crunched
+        self.crunching = False
 
     def _check_files(self, dir, exts):
         return check_files(os.path.join(self.project_path,
                                         dir),
-                           exts)
+                           exts,
+                           self.snapshot)
     def _get_files(self, dir, exts):
         return get_files(os.path.join(self.project_path,
                                         dir),
-                         exts)
+                         exts,
+                         self.snapshot)
 
     def _find_file(self, dir=None, filename=None):
         return find_file(os.path.join(self.project_path,
                                       dir),
-                          filename)
+                          filename,
+                          self.snapshot)
 
     def _check_dex(self):
         return len(self._find_file('bin','.dex')) > 0
@@ -82,156 +124,255 @@ class Package():
     def _check_aligned_apk(self):
         return len(self._find_file('bin','.%s.apk'%(self.zipped_prefix))) > 0
 
-    def _check_if_new_or_modified_files(self, dir=None, exts=None):
-        return check_if_new_or_modified_files(self.meta_info_path,
-                                              os.path.join(self.project_path,
-                                                           dir),
-                                              exts)
-
-    def _need_to_re_create_unsigned_apk(self):
-        return len(self._check_if_new_or_modified_dex()) > 0
-
-    def _need_to_re_sign_apk(self):
-        return len(self._check_if_new_or_modified_unsigned_apk()) > 0
+    def _get_resources_apk(self):
+        return '%s/bin/resources.ap_' % (self.project_path)
 
-    def _need_to_re_align_apk(self):
-        return len(self._check_if_new_or_modified_signed_apk()) > 0
+    def _get_apk(self, prefix):
+        return '%s/bin/%s.%s.apk' % (self.project_path,
+                                     self.project_name,
+                                     prefix)
 
-    def _check_if_new_or_modified_dex(self):
-        return self._check_if_new_or_modified_files('bin', ['.dex'])
+    def _requires_resources(self):
+        return (True if self.aapt_bin else False) and \
+            (True if self.app_manifest else False) and \
+            (True if self.android_jar else False)
 
-    def _check_if_new_or_modified_unsigned_apk(self):
-        return self._check_if_new_or_modified_files('bin', ['.%s.apk'%(self.unsigned_prefix)])
+    def _requires_crunch(self):
+        return self._check_files('res', ['.png']) and \
+            self.cruncher.can_crunch()
 
-    def _check_if_new_or_modified_signed_apk(self):
-        return self._check_if_new_or_modified_files('bin', ['.%s.apk'%(self.signed_prefix)])
+    def _crunch_cmds(self, changes=None):
+        # Crunch the PNGs one by one into the cache, mirror res/ into bin/res
+        return self.cruncher.get_steps(changes)
 
-
-    def _create_unsigned_apk_PRE(self):
-        if os.path.exists(self.project_path):
-            if self._check_dex() and \
-                    (True if self.aapt_bin else False) and \
-                    (True if self.app_manifest else False) and \
-                    (True if self.android_jar else False):
-
-                log.info('Creating application package')
-                if  self._need_to_re_create_unsigned_apk() or \
-                    not self._check_unsigned_apk():
-                    self._create_unsigned_apk_task()
-                else:
-                    log.info('No new/modified binary executable to re-created unsigned apk')
-                    self._create_unsigned_apk_POST()
-            else:
-                log.warn('Missing binary executable and/or build tools!')
-        else:
-            log.warn('Project "%s" does not exist in workspace!'%(self.project_name))
-
-    def _create_unsigned_apk_task(self):
-        # Create unsigned APK
+    def _create_resources_cmds(self, changes=None):
+        # Compile and package resources, independent from sources
         cmd = [ self.aapt_bin,
                 'package', '-f',
                 '-M', '%s'%(self.app_manifest),
                 '-I', '%s'%(self.android_jar),
-                '-F', '%s/bin/%s.%s.apk'%(self.project_path,
-                                          self.project_name,
-                                          self.unsigned_prefix),
                 '-S', '%s/res' % (self.project_path),
-                '%s/bin'%(self.project_path)]
-
-        if execute_command(cmd, cwd=self.project_path, os_env=self.os_environ):
-            log.info('Created %s.%s.apk' % (self.project_name,
-                                            self.unsigned_prefix))
-        self._create_unsigned_apk_POST()
-
-    def _create_unsigned_apk_POST(self):
-        if self._check_unsigned_apk():
-            self._sign_apk_PRE()
-        else:
-            log.warn('Failed on creating apk!')
-
-    def _sign_apk_PRE(self):
-        if self._check_unsigned_apk() and \
-                (True if self.jarsigner_bin else False) and \
+                '-F', self._get_resources_apk()]
+        if self.crunching:
+            # PNGs of bin/res are already crunched
+            cmd[cmd.index('-S') + 1] = self.cruncher.mirror_path
+            cmd.insert(cmd.index('-S'), '--no-crunch')
+        return [cmd]
+
+    def _requires_unsigned_apk(self):
+        return self._check_dex() and \
+            (True if self.aapt_bin else False)
+
+    def _copy_resources_apk(self):
+        shutil.copyfile(self._get_resources_apk(),
+                        self._get_apk(self.unsigned_prefix))
+        return True
+
+    def _write_unsigned_apk(self):
+        return write_apk(self._get_apk(self.unsigned_prefix),
+                         self._get_resources_apk(),
+                         '%s/bin/classes.dex' % (self.project_path))
+
+    def _create_unsigned_apk_cmds(self, changes=None):
+        if self.packaging_mode == PYTHON_PACKAGING:
+            # Write the aligned APK in one pass
+            return [self._write_unsigned_apk]
+        # Create unsigned APK adding the DEX executable to packaged resources
+        cmd = [ self.aapt_bin,
+                'add', '-k',
+                self._get_apk(self.unsigned_prefix),
+                '%s/bin/classes.dex' % (self.project_path)]
+        return [self._copy_resources_apk, cmd]
+
+    def _signs_in_process(self):
+        # JKS keystores are signed while writing the apk, without jarsigner
+        if not (self.packaging_mode == PYTHON_PACKAGING and \
                 (True if self.key_store else False) and \
-                (os.path.exists(self.key_store)) and \
                 (True if self.key_pass else False) and \
                 (True if self.store_pass else False) and \
-                (True if self.key_alias else False):
-
-            log.info('Signing application package')
-            if self._need_to_re_sign_apk() or \
-                    not self._check_signed_apk():
-                self._sign_apk_task()
-            else:
-                log.info('No new/modified unsigned apk to re-sign apk')
-                self._sign_apk_POST()
-        else:
-            log.warn('Missing unsigned apk and/or signing tools!')
-
-    def _sign_apk_task(self):
+                (True if self.key_alias else False)):
+            return False
+        if not is_jks_key_store(self.key_store):
+            # i.e. PKCS12, the default keystore type since Java 9
+            if os.path.isfile(self.key_store):
+                log.info('"%s" is not a JKS keystore, signing with jarsigner' % (self.key_store))
+            return False
+        return True
+
+    def _write_signed_apk(self):
+        try:
+            key_entry = load_jks_entry(self.key_store,
+                                       self.key_alias,
+                                       self.store_pass,
+                                       self.key_pass)
+        except SigningError as e:
+            log.error('%s' % (e))
+            return False
+        return write_apk(self._get_apk(self.zipped_prefix),
+                         self._get_resources_apk(),
+                         '%s/bin/classes.dex' % (self.project_path),
+                         writer_class=SigningApkWriter,
+                         key_entry=key_entry)
+
+    def _create_signed_apk_cmds(self, changes=None):
+        # Write, sign and align the APK in one pass
+        return [self._write_signed_apk]
+
+    def _requires_sign_apk(self):
+        return self._check_unsigned_apk() and \
+            (True if self.jarsigner_bin else False) and \
+            (True if self.key_store else False) and \
+            (os.path.exists(self.key_store)) and \
+            (True if self.key_pass else False) and \
+            (True if self.store_pass else False) and \
+            (True if self.key_alias else False)
+
+    def _sign_apk_cmds(self, changes=None):
         # Sign the apk
         cmd = [ self.jarsigner_bin,
                 '-keystore', self.key_store,
                 '-storepass', self.store_pass,
                 '-keypass', self.key_pass,
-                '-signedjar', '%s/bin/%s.%s.apk'%(self.project_path,
-                                                  self.project_name,
-                                                  self.signed_prefix),
-                '%s/bin/%s.%s.apk'%(self.project_path,
-                                    self.project_name,
-                                    self.unsigned_prefix),
+                '-signedjar', self._get_apk(self.signed_prefix),
+                self._get_apk(self.unsigned_prefix),
                 self.key_alias ]
+        return [cmd]
+
+    def _requires_zip_align_apk(self):
+        return self._check_signed_apk() and \
+            (True if self.zipalign_bin or \
+                 self.packaging_mode == PYTHON_PACKAGING else False)
 
-        if execute_command(cmd, cwd=self.project_path, os_env=self.os_environ):
-            log.info('Signed application "%s.%s.apk"' % (self.project_name,
-                                                         self.signed_prefix))
-        self._sign_apk_POST()
-
-    def _sign_apk_POST(self):
-        if self._check_signed_apk():
-            self._zip_align_apk_PRE()
-        else:
-            log.warn('Failed on signing apk!')
-
-    def _zip_align_apk_PRE(self):
-        if self._check_signed_apk() and \
-                (True if self.zipalign_bin else False):
-
-            log.info('zip aligning application package')
-            if self._need_to_re_align_apk() or \
-                    not self._check_aligned_apk():
-                self._zip_align_apk_task()
-            else:
-                log.info('No new/modified signed apk to re-align apk')
-                self._zip_align_apk_POST()
-        else:
-            log.warn('Missing signed apk and/or zip aligning tools!')
-
-    def _zip_align_apk_task(self):
+    def _align_apk(self):
+        return align_apk(self._get_apk(self.signed_prefix),
+                         self._get_apk(self.zipped_prefix))
+
+    def _zip_align_apk_cmds(self, changes=None):
+        if self.packaging_mode == PYTHON_PACKAGING:
+            return [self._align_apk]
         # Zip align the apk
         cmd = [ self.zipalign_bin,
                 '-f', '4',
-                '%s/bin/%s.%s.apk'%(self.project_path,
-                                    self.project_name,
-                                    self.signed_prefix),
-                '%s/bin/%s.%s.apk'%(self.project_path,
-                                    self.project_name,
-                                    self.zipped_prefix)]
-        if execute_command(cmd, cwd=self.project_path, os_env=self.os_environ):
-            log.info('Zip aligned application "%s.%s.apk"'%(self.project_name,
-                                                            self.zipped_prefix))
-        self._zip_align_apk_POST()
-
-    def _zip_align_apk_POST(self):
-        if not self._check_aligned_apk():
-            log.warn('Failed on zip aligning apk!')
+                self._get_apk(self.signed_prefix),
+                self._get_apk(self.zipped_prefix)]
+        return [cmd]
+
+    def get_nodes(self):
+        """ Returns the stages to package the project, compile stages included """
+        nodes = Compile(name=self.project_name,
+                        snapshot=self.snapshot,
+                        jobs=self.jobs,
+                        explain=self.explain,
+                        dry_run=self.dry_run).get_nodes()
+        self.crunching = self._requires_crunch()
+        if self.crunching:
+            nodes.append(
+                Node('crunch',
+                     inputs=[('res', ['.xml', '.png'])],
+                     outputs=[(os.path.join('bin', 'res'), '')],
+                     requires=self._requires_crunch,
+                     commands=self._crunch_cmds,
+                     timeout=self.aapt_timeout,
+                     desc='Crunching images',
+                     done='Crunched images',
+                     skip='No new/modified resources to re-crunch images',
+                     missing='No images to crunch and/or cache!',
+                     failed='Failed on crunching images!'))
+        nodes.append(
+            Node('resources',
+                 deps=['crunch'] if self.crunching else [],
+                 inputs=[('res', ['.xml', '.png']), ('', ['AndroidManifest.xml'])],
+                 outputs=[('bin', 'resources.ap_')],
+                 requires=self._requires_resources,
+                 commands=self._create_resources_cmds,
+                 timeout=self.aapt_timeout,
+                 desc='Packaging resources',
+                 done='Packaged resources',
+                 skip='No new/modified resources to re-package resources',
+                 missing='Missing resources and/or build tools!',
+                 failed='Failed on packaging resources!',
+                 cache=True))
+        if self._signs_in_process():
+            nodes.append(
+                Node('apk',
+                     deps=['dex', 'resources'],
+                     inputs=[('bin', ['classes.dex', 'resources.ap_'])],
+                     outputs=[('bin', '.%s.apk' % (self.zipped_prefix))],
+                     requires=self._requires_unsigned_apk,
+                     commands=self._create_signed_apk_cmds,
+                     desc='Creating signed application package',
+                     done='Created signed application "%s.%s.apk"' % (self.project_name,
+                                                                     self.zipped_prefix),
+                     skip='No new/modified binary executable to re-create signed apk',
+                     missing='Missing binary executable and/or keystore!',
+                     failed='Failed on creating signed apk!'))
+            return nodes
+        nodes.extend([
+            Node('apk',
+                 deps=['dex', 'resources'],
+                 inputs=[('bin', ['classes.dex', 'resources.ap_'])],
+                 outputs=[('bin', '.%s.apk' % (self.unsigned_prefix))],
+                 requires=self._requires_unsigned_apk,
+                 commands=self._create_unsigned_apk_cmds,
+                 timeout=self.aapt_timeout,
+                 desc='Creating application package',
+                 done='Created %s.%s.apk' % (self.project_name,
+                                            self.unsigned_prefix),
+                 skip='No new/modified binary executable to re-created unsigned apk',
+                 missing='Missing binary executable and/or build tools!',
+                 failed='Failed on creating apk!'),
+            Node('sign',
+                 deps=['apk'],
+                 inputs=[('bin', ['.%s.apk' % (self.unsigned_prefix)])],
+                 outputs=[('bin', '.%s.apk' % (self.signed_prefix))],
+                 requires=self._requires_sign_apk,
+                 commands=self._sign_apk_cmds,
+                 timeout=self.jarsigner_timeout,
+                 desc='Signing application package',
+                 done='Signed application "%s.%s.apk"' % (self.project_name,
+                                                          self.signed_prefix),
+                 skip='No new/modified unsigned apk to re-sign apk',
+                 missing='Missing unsigned apk and/or signing tools!',
+                 failed='Failed on signing apk!',
+                 cache=True),
+            Node('align',
+                 deps=['sign'],
+                 inputs=[('bin', ['.%s.apk' % (self.signed_prefix)])],
+                 outputs=[('bin', '.%s.apk' % (self.zipped_prefix))],
+                 requires=self._requires_zip_align_apk,
+                 commands=self._zip_align_apk_cmds,
+                 timeout=self.zipalign_timeout,
+                 desc='zip aligning application package',
+                 done='Zip aligned application "%s.%s.apk"' % (self.project_name,
+                                                              self.zipped_prefix),
+                 skip='No new/modified signed apk to re-align apk',
+                 missing='Missing signed apk and/or zip aligning tools!',
+                 failed='Failed on zip aligning apk!',
+                 cache=True),
+        ])
+        return nodes
+
+    def get_graph(self):
+        graph = Graph(project_path=self.project_path,
+                      meta_info_path=self.meta_info_path,
+                      os_env=self.os_environ,
+                      logger=log,
+                      snapshot=self.snapshot,
+                      cache=None if self.dry_run else get_artifact_cache(),
+                      explain=self.explain,
+                      dry_run=self.dry_run)
+        graph.extend(self.get_nodes())
+        return graph
 
     def package_project(self):
-        self._create_unsigned_apk_PRE()
+        if not os.path.exists(self.project_path):
+            log.warn('Project "%s" does not exist in workspace!'%(self.project_name))
+            return False
+        return self.get_graph().run()
 
 def package_project(*args, **kwargs):
     p = Package(*args, **kwargs)
-    p.package_project()
+    return p.package_project()
 
 if __name__ == '__main__':
     package_project(name='HelloWorld')
\ No newline at end of file
@@ -8,18 +8,62 @@ Modified by - Juan Cruz <jmcruz1983@gmail.com>
 import re
 import sys
 import time
+import marshal
 import os.path
 
+# {file path: (stat signature, Properties)}
 _propCache = {}
 
-def loadProperties(fileName):
-    if _propCache.has_key(fileName):
-        return _propCache[fileName]
+# Suffix of the parsed snapshot written next to a properties file
+SNAPSHOT_SUFFIX = '.parsed'
+
+# Returns the stat signature (size, mtime, inode) of a file
+def _get_signature(filepath):
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime, st.st_ino)
+
+# Loads the parsed snapshot of a properties file if it still matches the file
+def _load_snapshot(filepath, signature):
+    try:
+        with open(filepath + SNAPSHOT_SUFFIX, 'rb') as f:
+            snapshot = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(snapshot, tuple) or len(snapshot) != 4 or \
+            snapshot[0] != signature:
+        return None
     p = Properties()
-    filepath = os.path.join(os.getcwd(), fileName)
-    p.load(open(filepath))
+    p._props, p._origprops, p._keymap = snapshot[1:]
+    return p
 
-    _propCache[fileName] = p
+# Writes the parsed snapshot of a properties file, ignoring read-only locations
+def _save_snapshot(filepath, signature, p):
+    tmppath = '%s%s.%d.tmp' % (filepath, SNAPSHOT_SUFFIX, os.getpid())
+    try:
+        with open(tmppath, 'wb') as f:
+            marshal.dump((signature, p._props, p._origprops, p._keymap), f)
+        os.rename(tmppath, filepath + SNAPSHOT_SUFFIX)
+    except (IOError, OSError):
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+
+def loadProperties(fileName):
+    filepath = os.path.join(os.getcwd(), fileName)
+    signature = _get_signature(filepath)
+    # Edited files are parsed again
+    if _propCache.has_key(filepath) and _propCache[filepath][0] == signature:
+        return _propCache[filepath][1]
+    p = _load_snapshot(filepath, signature)
+    if p is None:
+        p = Properties()
+        with open(filepath) as f:
+            p.load(f)
+        _save_snapshot(filepath, signature, p)
+
+    _propCache[filepath] = (signature, p)
     return p
 
 class IllegalArgumentException(Exception):
@@ -35,6 +79,16 @@ class IllegalArgumentException(Exception):
 class Properties(object):
     """ A Python replacement for java.util.Properties """
 
+    # Patterns compiled once for every instance and line
+    othercharre = re.compile(r'(?<!\\)(\s*\=)|(?<!\\)(\s*\:)')
+    othercharre2 = re.compile(r'(\s*\=)|(\s*\:)')
+    bspacere = re.compile(r'\\(?!\s$)')
+    # Whitespace separating key and value, when '=' or ':' separates them
+    # too the whitespace right after them doesn't count
+    wspacere = re.compile(r'(?<![\\\=\:])(\s)')
+    # Whitespace separating key and value, '=' and ':' are all escaped
+    wspacere2 = re.compile(r'(?<![\\])(\s)')
+
     def __init__(self, props=None):
         # Dictionary of properties.
         self._props = {}
@@ -47,10 +101,6 @@ class Properties(object):
         # dictionary to pristine dictionary
         self._keymap = {}
 
-        self.othercharre = re.compile(r'(?<!\\)(\s*\=)|(?<!\\)(\s*\:)')
-        self.othercharre2 = re.compile(r'(\s*\=)|(\s*\:)')
-        self.bspacere = re.compile(r'\\(?!\s$)')
-
     def __str__(self):
         s='{'
         for key,value in self._props.items():
@@ -60,7 +110,7 @@ class Properties(object):
         return s
 
     def __parse(self, lines):
-        """ Parse a list of lines and create
+        """ Parse an iterable of lines and create
         an internal property dictionary """
 
         lineno=0
@@ -82,17 +132,15 @@ class Properties(object):
             if m:
                 first, last = m.span()
                 start, end = 0, first
-                wspacere = re.compile(r'(?<![\\\=\:])(\s)')
+                wspacere = self.wspacere
             else:
-                if self.othercharre2.search(line):
-                    # Check if either '=' or ':' is present
-                    # in the line. If they are then it means
-                    # they are preceded by a backslash.
-
-                    # This means, we need to modify the
-                    # wspacere a bit, not to look for
-                    # : or = characters.
-                    wspacere = re.compile(r'(?<![\\])(\s)')
+                # Either there is no '=' or ':' in the line
+                # or they are preceded by a backslash.
+
+                # This means, we need to modify the
+                # wspacere a bit, not to look for
+                # : or = characters.
+                wspacere = self.wspacere2
                 start, end = 0, len(line)
 
             m2 = wspacere.search(line, start, end)
@@ -192,8 +240,8 @@ class Properties(object):
             raise ValueError,'Stream should be opened in read-only mode!'
 
         try:
-            lines = stream.readlines()
-            self.__parse(lines)
+            # Scan the stream line by line
+            self.__parse(stream)
         except IOError:
             raise
 
@@ -105,7 +105,7 @@ if  [ -n $KEYTOOL_BIN ] &&
     [ ! -f $KEY_STORE ]; then
     echo '--> Create Keystore'
     $KEYTOOL_BIN -genkeypair -validity 10000 \
-                -dname "CN=my company, C=SE" -keystore $KEY_STORE \
+                -dname "CN=my company, C=SE" -keystore $KEY_STORE -storetype JKS \
                 -storepass $STORE_PASS -keypass $KEY_PASS \
                 -alias $KEY_ALIAS -keyalg RSA
 fi
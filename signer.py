@@ -0,0 +1,326 @@
+"""
+Module that signs android packages (JAR signing, v1) while they are written
+"""
+
+import os
+import re
+import base64
+import struct
+import hashlib
+import binascii
+import logging
+from apk import ApkWriter
+
+# Setting logger
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+fmt = logging.Formatter(datefmt="%H:%M:%S",
+                        fmt='%(asctime)s %(levelname)-8s: %(name)s: %(message)s')
+sh = logging.StreamHandler()
+sh.setFormatter(fmt)
+log.addHandler(sh)
+
+JKS_MAGIC = 0xFEEDFEED
+JKS_PRIVATE_KEY = 1
+JKS_TRUSTED_CERT = 2
+JKS_INTEGRITY_SALT = 'Mighty Aphrodite'
+
+OID_JKS_KEY_PROTECTOR = '1.3.6.1.4.1.42.2.17.1.1'
+OID_RSA_ENCRYPTION = '1.2.840.113549.1.1.1'
+OID_SHA1 = '1.3.14.3.2.26'
+OID_PKCS7_DATA = '1.2.840.113549.1.7.1'
+OID_PKCS7_SIGNED_DATA = '1.2.840.113549.1.7.2'
+
+# DigestInfo prefix of a SHA-1 hash (PKCS#1 v1.5)
+SHA1_DIGEST_INFO = binascii.unhexlify('3021300906052b0e03021a05000414')
+
+CREATED_BY = '1.0 (Android UBS)'
+
+# Maximum length of a manifest line, continuation lines start with a space
+MANIFEST_LINE_LENGTH = 72
+
+class SigningError(Exception):
+    pass
+
+"""
+DER
+"""
+
+# Returns (tag, start of contents, end of contents) of the DER element at offset
+def der_read(data, offset=0):
+    tag = ord(data[offset])
+    length = ord(data[offset + 1])
+    offset += 2
+    if length & 0x80:
+        num = length & 0x7f
+        length = int(binascii.hexlify(data[offset:offset + num]), 16)
+        offset += num
+    return tag, offset, offset + length
+
+# Returns the elements of a DER constructed value as (tag, start, end)
+def der_children(data, start, end):
+    children = []
+    while start < end:
+        tag, c_start, c_end = der_read(data, start)
+        children.append((tag, c_start, c_end, start))
+        start = c_end
+    return children
+
+def der(tag, contents):
+    length = len(contents)
+    if length < 0x80:
+        header = chr(length)
+    else:
+        encoded = _int_to_bytes(length)
+        header = chr(0x80 | len(encoded)) + encoded
+    return chr(tag) + header + contents
+
+def der_seq(*elements):
+    return der(0x30, ''.join(elements))
+
+def der_set(*elements):
+    return der(0x31, ''.join(elements))
+
+def der_int(value):
+    encoded = _int_to_bytes(value) if value else '\0'
+    if ord(encoded[0]) & 0x80:
+        encoded = '\0' + encoded
+    return der(0x02, encoded)
+
+def der_null():
+    return der(0x05, '')
+
+def der_octets(value):
+    return der(0x04, value)
+
+def der_oid(oid):
+    parts = [int(_p) for _p in oid.split('.')]
+    encoded = chr(40 * parts[0] + parts[1])
+    for _p in parts[2:]:
+        chunk = chr(_p & 0x7f)
+        _p >>= 7
+        while _p:
+            chunk = chr(0x80 | (_p & 0x7f)) + chunk
+            _p >>= 7
+        encoded += chunk
+    return der(0x06, encoded)
+
+def _int_to_bytes(value, length=None):
+    hexed = '%x' % (value)
+    hexed = ('0' * (len(hexed) % 2)) + hexed
+    encoded = binascii.unhexlify(hexed)
+    if length:
+        encoded = '\0' * (length - len(encoded)) + encoded
+    return encoded
+
+def _bytes_to_int(data):
+    return int(binascii.hexlify(data), 16) if data else 0
+
+"""
+Keystore
+"""
+
+class KeyStoreEntry():
+    """
+    Class that holds the RSA private key and certificate chain of a keystore alias
+    """
+    def __init__(self, alias=None, modulus=None, private_exponent=None, certs=None):
+        self.alias = alias
+        self.modulus = modulus
+        self.private_exponent = private_exponent
+        self.certs = certs if certs else []
+
+    def get_issuer_and_serial(self):
+        """ Returns the DER of the issuer and serial number of the signing certificate """
+        cert = self.certs[0]
+        _, start, end = der_read(cert)
+        _, tbs_start, tbs_end = der_read(cert, start)
+        fields = der_children(cert, tbs_start, tbs_end)
+        # Skip the explicit version
+        if fields[0][0] == 0xa0:
+            fields = fields[1:]
+        serial = cert[fields[0][3]:fields[0][2]]
+        issuer = cert[fields[2][3]:fields[2][2]]
+        return issuer, serial
+
+    def sign(self, data):
+        """ Returns the SHA1withRSA (PKCS#1 v1.5) signature of the data """
+        digest_info = SHA1_DIGEST_INFO + hashlib.sha1(data).digest()
+        key_len = (self.modulus.bit_length() + 7) // 8
+        padding = key_len - len(digest_info) - 3
+        if padding < 8:
+            raise SigningError('RSA key is too short')
+        encoded = '\0\1' + '\xff' * padding + '\0' + digest_info
+        signature = pow(_bytes_to_int(encoded), self.private_exponent, self.modulus)
+        return _int_to_bytes(signature, key_len)
+
+def _read_utf(data, offset):
+    length, = struct.unpack_from('>H', data, offset)
+    return data[offset + 2:offset + 2 + length].decode('utf-8'), offset + 2 + length
+
+def _password_bytes(password):
+    return password.decode('utf-8').encode('utf-16-be')
+
+# Decrypts a private key protected by the JKS key protector
+def _decrypt_jks_key(protected, password):
+    _, start, end = der_read(protected)
+    children = der_children(protected, start, end)
+    _, alg_start, alg_end, _ = children[0]
+    _, oid_start, oid_end = der_read(protected, alg_start)
+    if protected[oid_start - 2:oid_end] != der_oid(OID_JKS_KEY_PROTECTOR):
+        raise SigningError('Unsupported private key protection')
+    encrypted = protected[children[1][1]:children[1][2]]
+    salt, cipher, check = encrypted[:20], encrypted[20:-20], encrypted[-20:]
+    passwd = _password_bytes(password)
+    keystream = []
+    digest = salt
+    while len(keystream) * 20 < len(cipher):
+        digest = hashlib.sha1(passwd + digest).digest()
+        keystream.append(digest)
+    keystream = ''.join(keystream)
+    plain = ''.join([chr(ord(_c) ^ ord(_k)) for _c, _k in zip(cipher, keystream)])
+    if hashlib.sha1(passwd + plain).digest() != check:
+        raise SigningError('Wrong key password')
+    return plain
+
+# Returns (modulus, private exponent) from a PKCS#8 RSA private key
+def _parse_rsa_private_key(pkcs8):
+    _, start, end = der_read(pkcs8)
+    children = der_children(pkcs8, start, end)
+    _, alg_start, alg_end, _ = children[1]
+    _, oid_start, oid_end = der_read(pkcs8, alg_start)
+    if pkcs8[oid_start - 2:oid_end] != der_oid(OID_RSA_ENCRYPTION):
+        raise SigningError('Only RSA keys are supported')
+    _, key_start, key_end, _ = children[2]
+    _, rsa_start, rsa_end = der_read(pkcs8, key_start)
+    fields = der_children(pkcs8, rsa_start, rsa_end)
+    modulus = _bytes_to_int(pkcs8[fields[1][1]:fields[1][2]])
+    private_exponent = _bytes_to_int(pkcs8[fields[3][1]:fields[3][2]])
+    return modulus, private_exponent
+
+# Checks if the keystore is a JKS one, other formats are left to jarsigner
+def is_jks_key_store(key_store):
+    if not key_store or not os.path.isfile(key_store):
+        return False
+    with open(key_store, 'rb') as _f:
+        header = _f.read(4)
+    return len(header) == 4 and struct.unpack('>I', header)[0] == JKS_MAGIC
+
+# Loads the private key and certificates of an alias from a JKS keystore
+def load_jks_entry(key_store, alias, store_pass, key_pass):
+    with open(key_store, 'rb') as _f:
+        data = _f.read()
+    if len(data) < 32:
+        raise SigningError('"%s" is not a JKS keystore' % (key_store))
+    magic, version, count = struct.unpack_from('>III', data, 0)
+    if magic != JKS_MAGIC or version not in (1, 2):
+        raise SigningError('"%s" is not a JKS keystore' % (key_store))
+    expected = hashlib.sha1(_password_bytes(store_pass) + JKS_INTEGRITY_SALT + data[:-20]).digest()
+    if expected != data[-20:]:
+        raise SigningError('Keystore was tampered with, or store password was incorrect')
+    offset = 12
+    for _ in xrange(count):
+        tag, = struct.unpack_from('>I', data, offset)
+        entry_alias, offset = _read_utf(data, offset + 4)
+        offset += 8
+        if tag == JKS_PRIVATE_KEY:
+            key_len, = struct.unpack_from('>I', data, offset)
+            protected = data[offset + 4:offset + 4 + key_len]
+            offset += 4 + key_len
+            num_certs, = struct.unpack_from('>I', data, offset)
+            offset += 4
+            certs = []
+            for _ in xrange(num_certs):
+                if version == 2:
+                    _, offset = _read_utf(data, offset)
+                cert_len, = struct.unpack_from('>I', data, offset)
+                certs.append(data[offset + 4:offset + 4 + cert_len])
+                offset += 4 + cert_len
+            if entry_alias.lower() == alias.lower():
+                modulus, private_exponent = _parse_rsa_private_key(
+                    _decrypt_jks_key(protected, key_pass))
+                return KeyStoreEntry(alias, modulus, private_exponent, certs)
+        elif tag == JKS_TRUSTED_CERT:
+            if version == 2:
+                _, offset = _read_utf(data, offset)
+            cert_len, = struct.unpack_from('>I', data, offset)
+            offset += 4 + cert_len
+        else:
+            raise SigningError('Unknown keystore entry %d' % (tag))
+    raise SigningError('Alias "%s" not found in "%s"' % (alias, key_store))
+
+"""
+Signature files
+"""
+
+# Returns a manifest attribute, wrapping lines longer than 72 bytes
+def manifest_line(name, value):
+    line = '%s: %s' % (name, value)
+    lines = [line[:MANIFEST_LINE_LENGTH]]
+    line = line[MANIFEST_LINE_LENGTH:]
+    while line:
+        lines.append(' ' + line[:MANIFEST_LINE_LENGTH - 1])
+        line = line[MANIFEST_LINE_LENGTH - 1:]
+    return ''.join(['%s\r\n' % (_l) for _l in lines])
+
+# Returns the name of the signature files for an alias, like jarsigner
+def get_signature_name(alias):
+    return re.sub(r'[^A-Z0-9_\-]', '_', alias.upper()[:8])
+
+def create_signature_block(entry, signature_file):
+    sha1 = der_seq(der_oid(OID_SHA1), der_null())
+    issuer, serial = entry.get_issuer_and_serial()
+    signer_info = der_seq(der_int(1),
+                          der_seq(issuer, serial),
+                          sha1,
+                          der_seq(der_oid(OID_RSA_ENCRYPTION), der_null()),
+                          der_octets(entry.sign(signature_file)))
+    signed_data = der_seq(der_int(1),
+                          der_set(sha1),
+                          der_seq(der_oid(OID_PKCS7_DATA)),
+                          der(0xa0, ''.join(entry.certs)),
+                          der_set(signer_info))
+    return der_seq(der_oid(OID_PKCS7_SIGNED_DATA),
+                   der(0xa0, signed_data))
+
+class SigningApkWriter(ApkWriter):
+    """
+    Class that writes an aligned android package and signs it on the fly:
+    entry digests are computed as entries are written and the signature
+    files are appended before the central directory
+    """
+    def __init__(self, path=None, key_entry=None, **kwargs):
+        ApkWriter.__init__(self, path, **kwargs)
+        self.key_entry = key_entry
+        self.digests = []
+
+    def on_entry(self, zinfo, data):
+        if zinfo.filename.startswith('META-INF/'):
+            return
+        self.digests.append((zinfo.filename, base64.b64encode(hashlib.sha1(data).digest())))
+
+    def on_close(self):
+        manifest = [manifest_line('Manifest-Version', '1.0'),
+                    manifest_line('Created-By', CREATED_BY),
+                    '\r\n']
+        signature_file = []
+        for _name, _digest in self.digests:
+            section = manifest_line('Name', _name) + \
+                manifest_line('SHA1-Digest', _digest) + '\r\n'
+            manifest.append(section)
+            signature_file.append(manifest_line('Name', _name) +
+                                  manifest_line('SHA1-Digest',
+                                                base64.b64encode(hashlib.sha1(section).digest())) +
+                                  '\r\n')
+        manifest = ''.join(manifest)
+        signature_file = ''.join([manifest_line('Signature-Version', '1.0'),
+                                  manifest_line('Created-By', CREATED_BY),
+                                  manifest_line('SHA1-Digest-Manifest',
+                                                base64.b64encode(hashlib.sha1(manifest).digest())),
+                                  '\r\n'] + signature_file)
+        name = get_signature_name(self.key_entry.alias)
+        self.add('META-INF/MANIFEST.MF', manifest)
+        self.add('META-INF/%s.SF' % (name), signature_file)
+        self.add('META-INF/%s.RSA' % (name),
+                 create_signature_block(self.key_entry, signature_file))
@@ -0,0 +1,221 @@
+"""
+Module that keeps an indexed snapshot of the files of a project
+"""
+
+import os
+import time
+import threading
+from tracing import span
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Seconds within which a directory modified while listed may still change
+# unnoticed, its mtime having the same value
+RACY_MTIME = 2.0
+
+# {root: Snapshot} kept between builds, see keep_snapshots()
+_kept = None
+_kept_lock = threading.Lock()
+
+# Returns the extension used to index a file name or a searched suffix,
+# i.e. "R$attr.class" -> ".class", ".unsigned.apk" -> ".apk"
+def get_ext_key(name):
+    idx = name.rfind('.')
+    return name[idx:] if idx != -1 else ''
+
+# Lists a directory, returns (subdirs, filenames) like os.walk would
+def _list_dir(dirpath):
+    subdirs, filenames = [], []
+    if scandir is not None:
+        for _e in scandir(dirpath):
+            if _e.is_dir():
+                if not _e.is_symlink():
+                    subdirs.append(_e.path)
+            else:
+                filenames.append(_e.name)
+    else:
+        for _name in os.listdir(dirpath):
+            _path = os.path.join(dirpath, _name)
+            if os.path.isdir(_path):
+                if not os.path.islink(_path):
+                    subdirs.append(_path)
+            else:
+                filenames.append(_name)
+    return subdirs, filenames
+
+# Returns the mtime of a directory, None if it is gone
+def _get_mtime(dirpath):
+    try:
+        return os.stat(dirpath).st_mtime
+    except OSError:
+        return None
+
+class Snapshot():
+    """
+    Class that scans a project tree once and indexes its files by directory and extension
+    """
+    def __init__(self, root=None):
+        self.root = os.path.abspath(root) if root else None
+        # {dirpath: {ext: [filepath, ...]}}
+        self._dirs = {}
+        # {dirpath: mtime when listed}, None when it may change unnoticed
+        self._mtimes = {}
+        self._scanned = False
+        self._lock = threading.RLock()
+        # Dirs whose files are known to be unchanged unless refreshed since
+        self._trusted = []
+        self._refreshed = set()
+
+    def _scan(self, dirpath):
+        with span('scan', 'scan', dir=dirpath):
+            self._scan_tree(dirpath)
+
+    def _list(self, dirpath):
+        # Indexes the files of a single directory, returns its subdirs
+        listed_at = time.time()
+        mtime = _get_mtime(dirpath)
+        subdirs, filenames = _list_dir(dirpath)
+        index = {}
+        for _name in filenames:
+            index.setdefault(get_ext_key(_name), []).append(os.path.join(dirpath, _name))
+        for _files in index.values():
+            _files.sort()
+        self._dirs[dirpath] = index
+        self._mtimes[dirpath] = mtime if mtime is not None and \
+            mtime < listed_at - RACY_MTIME else None
+        return subdirs
+
+    def _scan_tree(self, dirpath):
+        pending = [dirpath]
+        while pending:
+            _dir = pending.pop()
+            try:
+                pending.extend(self._list(_dir))
+            except OSError:
+                continue
+
+    def _ensure_scanned(self):
+        if not self._scanned:
+            if self.root:
+                self._scan(self.root)
+            self._scanned = True
+
+    def _in_tree(self, dirpath, top):
+        return dirpath == top or dirpath.startswith(top + os.sep)
+
+    def _forget(self, dirpath):
+        for _dir in self._dirs.keys():
+            if self._in_tree(_dir, dirpath):
+                del self._dirs[_dir]
+                self._mtimes.pop(_dir, None)
+
+    def refresh(self, dirpath=None):
+        """ Re-scans the given directory tree, i.e. after a stage wrote to it """
+        with self._lock:
+            if not self._scanned:
+                return
+            dirpath = os.path.abspath(dirpath) if dirpath else self.root
+            self._refreshed.add(dirpath)
+            self._forget(dirpath)
+            if os.path.isdir(dirpath):
+                self._scan(dirpath)
+
+    def revalidate(self):
+        """ Lists again the directories whose entries changed since they were listed,
+        i.e. for a snapshot kept between builds """
+        with self._lock:
+            if not self._scanned:
+                return
+            with span('revalidate', 'scan', dir=self.root) as sp:
+                listed = 0
+                for _dir in sorted(self._dirs.keys()):
+                    if not self._dirs.has_key(_dir):
+                        # Below a directory which is gone
+                        continue
+                    mtime = _get_mtime(_dir)
+                    if mtime is not None and mtime == self._mtimes.get(_dir):
+                        continue
+                    known = [_d for _d in self._dirs.keys() if os.path.dirname(_d) == _dir]
+                    self._forget_dir(_dir)
+                    try:
+                        subdirs = self._list(_dir) if mtime is not None else []
+                    except OSError:
+                        subdirs = []
+                    listed += 1
+                    for _d in set(known) - set(subdirs):
+                        self._forget(_d)
+                    for _d in set(subdirs) - set(known):
+                        self._scan_tree(_d)
+                sp.set(listed=listed)
+
+    def _forget_dir(self, dirpath):
+        self._dirs.pop(dirpath, None)
+        self._mtimes.pop(dirpath, None)
+
+    def trust(self, dirpaths=None):
+        """ Files under the directories are taken as unchanged until their directory is
+        refreshed, i.e. while a file watcher refreshes every directory it sees changing """
+        with self._lock:
+            self._trusted = [os.path.abspath(_d) for _d in dirpaths] if dirpaths else []
+            self._refreshed = set()
+
+    def is_unchanged(self, fpath=None):
+        """ Checks if a file is known to be unchanged without looking at it """
+        with self._lock:
+            if not [_t for _t in self._trusted if self._in_tree(fpath, _t)]:
+                return False
+            return not [_d for _d in self._refreshed if self._in_tree(fpath, _d)]
+
+    def get_files(self, dirpath=None, exts=None):
+        """ Returns the files under the directory ending with any of the extensions """
+        list_fs = []
+        if not dirpath or not exts:
+            return list_fs
+        seen = set()
+        dirpath = os.path.abspath(dirpath)
+        with self._lock:
+            self._ensure_scanned()
+            if not self.root or not self._in_tree(dirpath, self.root):
+                # Outside of the project, scan it on demand
+                self._scan(dirpath)
+            for _dir in sorted(self._dirs.keys()):
+                if not self._in_tree(_dir, dirpath):
+                    continue
+                index = self._dirs[_dir]
+                for _ext in exts:
+                    key = get_ext_key(_ext)
+                    if key:
+                        candidates = index.get(key, [])
+                    else:
+                        candidates = sorted([_f for _fs in index.values() for _f in _fs])
+                    for _f in candidates:
+                        if _f.endswith(_ext) and _f not in seen:
+                            seen.add(_f)
+                            list_fs.append(_f)
+        return list_fs
+
+# Snapshots are kept between builds from now on, i.e. by the build daemon
+def keep_snapshots():
+    global _kept
+    with _kept_lock:
+        if _kept is None:
+            _kept = {}
+
+# Returns a snapshot of the project tree, the kept one brought up to date if any
+def get_snapshot(root=None):
+    with _kept_lock:
+        if _kept is None or not root:
+            return Snapshot(root)
+        root = os.path.abspath(root)
+        snapshot = _kept.get(root)
+        if snapshot is None:
+            snapshot = _kept[root] = Snapshot(root)
+        else:
+            snapshot.revalidate()
+        return snapshot
@@ -0,0 +1,137 @@
+"""
+Tests of the artifact cache shared by the projects of the workspace
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from artifacts import ArtifactCache, restore_file, unshare_file
+
+class ArtifactsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='ubs-test-')
+        self.caches = []
+        self.project = os.path.join(self.root, 'checkout1', 'Project')
+        self.other_project = os.path.join(self.root, 'checkout2', 'Project')
+        self.tool = os.path.join(self.root, 'tools', 'dx')
+        self._write(self.tool, '#!/bin/sh\n')
+
+    def tearDown(self):
+        for _c in self.caches:
+            _c._db.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _write(self, fpath, data):
+        if not os.path.isdir(os.path.dirname(fpath)):
+            os.makedirs(os.path.dirname(fpath))
+        with open(fpath, 'wb') as _f:
+            _f.write(data)
+        return fpath
+
+    def _read(self, fpath):
+        with open(fpath, 'rb') as _f:
+            return _f.read()
+
+    def _cache(self, max_bytes=None):
+        cache = ArtifactCache(os.path.join(self.root, 'cache'), max_bytes)
+        self.caches.append(cache)
+        return cache
+
+    def _get_key(self, cache, project, digest='d1'):
+        steps = [[self.tool, '--dex', '--output=%s' % (os.path.join(project, 'bin', 'classes.dex')),
+                  os.path.join(project, 'obj')]]
+        return cache.get_action_key('dex', steps, project,
+                                    [(os.path.join(project, 'obj', 'A.class'), digest)])
+
+    def _store(self, cache, key, size, name='out.bin'):
+        output = self._write(os.path.join(self.project, 'bin', name), 'x' * size)
+        self.assertTrue(cache.store(key, 'stage', self.project, [output]))
+
+    def _set_used_at(self, cache, key, used_at):
+        with cache._db:
+            cache._db.execute('UPDATE entries SET used_at = ? WHERE key = ?', (used_at, key))
+
+    def _get_keys(self, cache):
+        return sorted([_r[0] for _r in cache._db.execute('SELECT key FROM entries')])
+
+    def test_project_placeholder(self):
+        cache = self._cache()
+        key = self._get_key(cache, self.project)
+        # Another checkout of the project shares the entry
+        self.assertEqual(self._get_key(cache, self.other_project), key)
+        self.assertNotEqual(self._get_key(cache, self.project, 'd2'), key)
+        # A tool changing under the same path makes another key
+        self._write(self.tool, '#!/bin/sh\n# upgraded\n')
+        self.assertNotEqual(self._get_key(cache, self.project), key)
+
+    def test_store_and_restore(self):
+        cache = self._cache()
+        key = self._get_key(cache, self.project)
+        dex = self._write(os.path.join(self.project, 'bin', 'classes.dex'), 'dex')
+        self.assertFalse(cache.restore(key, self.other_project))
+        self.assertTrue(cache.store(key, 'dex', self.project, [dex]))
+        self.assertTrue(cache.restore(key, self.other_project))
+        self.assertEqual(self._read(os.path.join(self.other_project, 'bin', 'classes.dex')), 'dex')
+        stats, stages = cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['stores']), (1, 1, 1))
+        self.assertEqual(stages, [('dex', 1, 3, 1)])
+
+    def test_lru_eviction(self):
+        cache = self._cache(max_bytes=300)
+        for _i, _key in enumerate(['a' * 40, 'b' * 40, 'c' * 40]):
+            self._store(cache, _key, 100, '%d.bin' % (_i))
+            self._set_used_at(cache, _key, 1000 + _i)
+        # The oldest entry is used again, the next oldest one goes first
+        self.assertTrue(cache.restore('a' * 40, self.other_project))
+        self._store(cache, 'd' * 40, 100, '3.bin')
+        self.assertEqual(self._get_keys(cache), ['a' * 40, 'c' * 40, 'd' * 40])
+        self.assertFalse(os.path.exists(cache._get_entry_path('b' * 40)))
+        self.assertFalse(cache.restore('b' * 40, self.other_project))
+        # As many as needed to fit in the budget
+        self.assertEqual(cache.evict(150), 2)
+        self.assertEqual(self._get_keys(cache), ['d' * 40])
+        self.assertEqual(cache.get_stats()[0]['evictions'], 3)
+
+    def test_byte_budget(self):
+        cache = self._cache(max_bytes=100)
+        # Larger than the whole budget
+        output = self._write(os.path.join(self.project, 'bin', 'big.bin'), 'x' * 101)
+        self.assertFalse(cache.store('e' * 40, 'stage', self.project, [output]))
+        self.assertEqual(self._get_keys(cache), [])
+        self._store(cache, 'f' * 40, 60)
+        self._store(cache, 'g' * 40, 60)
+        stats = cache.get_stats()[0]
+        self.assertEqual((stats['entries'], stats['bytes']), (1, 60))
+
+    def test_missing_entry_files(self):
+        cache = self._cache()
+        self._store(cache, 'h' * 40, 10)
+        # Removed meanwhile, i.e. by the eviction of another build
+        shutil.rmtree(cache._get_entry_path('h' * 40))
+        self.assertFalse(cache.restore('h' * 40, self.other_project))
+
+    def test_unshare_restored_file(self):
+        cached = self._write(os.path.join(self.root, 'cache', 'entry', 'classes.dex'), 'cached')
+        restored = os.path.join(self.project, 'bin', 'classes.dex')
+        restore_file(cached, restored)
+        self.assertEqual(self._read(restored), 'cached')
+        # Hard linked where reflinks aren't supported
+        os.remove(restored)
+        os.link(cached, restored)
+        unshare_file(restored)
+        self.assertEqual(os.stat(restored).st_nlink, 1)
+        self.assertEqual(self._read(restored), 'cached')
+        # A tool rewriting its output in place leaves the cache alone
+        with open(restored, 'r+b') as _f:
+            _f.write('change')
+        self.assertEqual(self._read(cached), 'cached')
+
+if __name__ == '__main__':
+    unittest.main()
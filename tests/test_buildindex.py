@@ -0,0 +1,115 @@
+"""
+Tests of the build index of the fingerprints and outputs of every stage
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import metainfo
+import buildindex
+from metainfo import get_fingerprint_store
+from buildindex import BuildIndex, JournalIndex, get_build_index, close_indexes, \
+    INDEX_FILENAME
+
+class BuildIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='ubs-test-')
+        self.meta_info = os.path.join(self.root, 'meta.info')
+        self.meta_db = os.path.join(self.root, INDEX_FILENAME)
+        self.sqlite3 = buildindex.sqlite3
+        self.indexes = []
+
+    def tearDown(self):
+        buildindex.sqlite3 = self.sqlite3
+        for _i in self.indexes:
+            _i._db.close()
+        close_indexes()
+        metainfo._stores.clear()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _open(self):
+        index = BuildIndex(self.meta_db, self.meta_info)
+        self.indexes.append(index)
+        return index
+
+    def _check_stages(self, index):
+        src = os.path.join(self.root, 'src', 'A.java')
+        index.update_fingerprints('javac', {src: '1,1,1,aaa'})
+        index.update_fingerprints('dex', {src: '1,1,1,bbb'})
+        index.update_fingerprints(None, {src: '1,1,1,ccc'})
+        # Every stage keeps what it last consumed
+        self.assertEqual(index.get_fingerprints('javac'), {src: '1,1,1,aaa'})
+        self.assertEqual(index.get_fingerprints('dex'), {src: '1,1,1,bbb'})
+        self.assertEqual(index.get_fingerprints(), {src: '1,1,1,ccc'})
+        self.assertEqual(index.get_fingerprints('apk'), {})
+        index.update_fingerprints('javac', removed=[src])
+        self.assertEqual(index.get_fingerprints('javac'), {})
+        self.assertEqual(index.get_fingerprints('dex'), {src: '1,1,1,bbb'})
+
+    def _check_outputs(self, index):
+        dex = os.path.join(self.root, 'bin', 'classes.dex')
+        classes = [os.path.join(self.root, 'obj', '%s.class' % (_n)) for _n in 'BA']
+        index.record_outputs('javac', classes)
+        index.record_outputs('dex', [dex])
+        self.assertEqual(index.get_producer(dex), 'dex')
+        self.assertEqual(index.get_producer(classes[0]), 'javac')
+        self.assertEqual(index.get_producer(os.path.join(self.root, 'src', 'A.java')), None)
+        self.assertEqual(index.get_outputs('javac'), sorted(classes))
+        # Produced by another stage from now on
+        index.record_outputs('merge', [dex])
+        self.assertEqual(index.get_producer(dex), 'merge')
+        self.assertEqual(index.get_outputs('dex'), [])
+
+    def test_stages(self):
+        self._check_stages(self._open())
+
+    def test_outputs(self):
+        self._check_outputs(self._open())
+
+    def test_other_connection(self):
+        index = self._open()
+        index.update_fingerprints('javac', {'/p/A.java': '1,1,1,aaa'})
+        self.assertEqual(index.get_fingerprints('javac'), {'/p/A.java': '1,1,1,aaa'})
+        # i.e. a build of another process, the fingerprints read are forgotten
+        self._open().update_fingerprints('javac', {'/p/A.java': '2,2,2,bbb'})
+        self.assertEqual(index.get_fingerprints('javac'), {'/p/A.java': '2,2,2,bbb'})
+
+    def test_import_meta_info(self):
+        get_fingerprint_store(self.meta_info).update({'javac|/p/A.java': '1,1,1,aaa',
+                                                      '/p/res/main.xml': '1,1,1,bbb',
+                                                      '>|/p/obj/A.class': 'javac'})
+        index = self._open()
+        self.assertEqual(index.get_fingerprints('javac'), {'/p/A.java': '1,1,1,aaa'})
+        self.assertEqual(index.get_fingerprints(), {'/p/res/main.xml': '1,1,1,bbb'})
+
+    def test_journal_index(self):
+        buildindex.sqlite3 = None
+        index = get_build_index(self.meta_info)
+        self.assertTrue(isinstance(index, JournalIndex))
+        self._check_stages(index)
+        self._check_outputs(index)
+        self.assertFalse(os.path.exists(self.meta_db))
+        # Kept in the meta.info journal
+        metainfo._stores.clear()
+        self.assertEqual(get_build_index(self.meta_info).get_fingerprints('dex'),
+                         {os.path.join(self.root, 'src', 'A.java'): '1,1,1,bbb'})
+
+    def test_read_only(self):
+        get_fingerprint_store(self.meta_info).update({'javac|/p/A.java': '1,1,1,aaa'})
+        # Nothing is created, meta.info is read instead
+        index = get_build_index(self.meta_info, read_only=True)
+        self.assertTrue(isinstance(index, JournalIndex))
+        self.assertEqual(index.get_fingerprints('javac'), {'/p/A.java': '1,1,1,aaa'})
+        self.assertFalse(os.path.exists(self.meta_db))
+        self.assertTrue(isinstance(get_build_index(self.meta_info), BuildIndex))
+        self.assertTrue(isinstance(get_build_index(self.meta_info, read_only=True), BuildIndex))
+
+if __name__ == '__main__':
+    unittest.main()
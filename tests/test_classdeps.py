@@ -0,0 +1,138 @@
+"""
+Tests of the dependencies extracted from compiled classes
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+from stubtool import make_class
+from classdeps import parse_class_file, ClassFormatError, DependencyIndex, \
+    get_strong_components
+
+class ClassDepsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='ubs-test-')
+        self.src_dir = os.path.join(self.root, 'src')
+        self.obj_dir = os.path.join(self.root, 'obj')
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _write_class(self, name, refs=(), constants=()):
+        # Compiled class and its (empty) source following the package layout
+        path = os.path.join(self.obj_dir, name + '.class')
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        source_file = os.path.basename(name).split('$')[0] + '.java'
+        with open(path, 'wb') as _f:
+            _f.write(make_class(name, refs, source_file, constants))
+        source = os.path.join(self.src_dir, os.path.dirname(name), source_file)
+        if not os.path.isdir(os.path.dirname(source)):
+            os.makedirs(os.path.dirname(source))
+        open(source, 'a').close()
+        return path
+
+    def _source(self, name):
+        return os.path.join(self.src_dir, name + '.java')
+
+    def _index(self):
+        index = DependencyIndex(self.src_dir)
+        class_files = []
+        for _root, _dirs, _files in os.walk(self.obj_dir):
+            class_files.extend([os.path.join(_root, _f) for _f in _files])
+        self.assertTrue(index.build(sorted(class_files)))
+        return index
+
+    def test_parse_class_file(self):
+        path = self._write_class('com/a/Foo', ['com/a/Bar', '[Lcom/b/Baz;', 'java/util/List'])
+        info = parse_class_file(path)
+        self.assertEqual(info.name, 'com/a/Foo')
+        self.assertEqual(info.source_file, 'Foo.java')
+        self.assertEqual(info.get_source_path(self.src_dir), self._source('com/a/Foo'))
+        # Array classes reference their element class
+        self.assertEqual(info.refs, set(['com/a/Bar', 'com/b/Baz',
+                                         'java/util/List', 'java/lang/Object']))
+        self.assertFalse(info.constants)
+
+    def test_parse_constants(self):
+        info = parse_class_file(self._write_class('com/a/Limits', constants=[('MAX', 3)]))
+        self.assertTrue(info.constants)
+
+    def test_parse_invalid_class_file(self):
+        path = os.path.join(self.root, 'Broken.class')
+        with open(path, 'wb') as _f:
+            _f.write(make_class('Broken', [], 'Broken.java')[:20])
+        self.assertRaises(ClassFormatError, parse_class_file, path)
+        with open(path, 'wb') as _f:
+            _f.write('not a class file')
+        self.assertRaises(ClassFormatError, parse_class_file, path)
+
+    def test_affected_sources(self):
+        self._write_class('com/a/A')
+        self._write_class('com/a/B', ['com/a/A'])
+        self._write_class('com/a/C', ['com/a/B'])
+        self._write_class('com/a/D')
+        # Inner classes belong to the source of their outer class
+        self._write_class('com/a/D$Inner', ['com/a/A'])
+        index = self._index()
+        sources, stale = index.get_affected([self._source('com/a/B')])
+        self.assertEqual(sources, [self._source('com/a/B'), self._source('com/a/C')])
+        self.assertEqual(stale, [os.path.join(self.obj_dir, 'com/a/B.class'),
+                                 os.path.join(self.obj_dir, 'com/a/C.class')])
+        sources, stale = index.get_affected([self._source('com/a/A')])
+        self.assertEqual(sources, sorted([self._source('com/a/%s' % (_n)) for _n in 'ABCD']))
+        self.assertEqual(stale, [os.path.join(self.obj_dir, 'com/a/%s.class' % (_n))
+                                 for _n in ['A', 'B', 'C', 'D$Inner']])
+
+    def test_removed_sources(self):
+        self._write_class('com/a/A')
+        self._write_class('com/a/B', ['com/a/A'])
+        index = self._index()
+        os.remove(self._source('com/a/A'))
+        sources, stale = index.get_affected([])
+        # Classes of the removed source go, the ones using it are recompiled
+        self.assertEqual(sources, [self._source('com/a/B')])
+        self.assertEqual(stale, [os.path.join(self.obj_dir, 'com/a/A.class'),
+                                 os.path.join(self.obj_dir, 'com/a/B.class')])
+
+    def test_declares_constants(self):
+        self._write_class('com/a/A', constants=[('SIZE', 1)])
+        self._write_class('com/a/B', ['com/a/A'])
+        index = self._index()
+        self.assertTrue(index.declares_constants([self._source('com/a/A')]))
+        self.assertFalse(index.declares_constants([self._source('com/a/B')]))
+
+    def test_package_levels(self):
+        self._write_class('com/a/A')
+        self._write_class('com/b/B', ['com/a/A'])
+        self._write_class('com/c/C', ['com/d/D'])
+        self._write_class('com/d/D', ['com/c/C', 'com/a/A'])
+        self._write_class('com/e/E', ['com/b/B'])
+        index = self._index()
+        levels = index.get_package_levels([self._source(_n) for _n in
+                                           ['com/a/A', 'com/b/B', 'com/c/C', 'com/d/D',
+                                            'com/e/E']])
+        self.assertEqual(levels, [[[self._source('com/a/A')]],
+                                  [[self._source('com/b/B')],
+                                   [self._source('com/c/C'), self._source('com/d/D')]],
+                                  [[self._source('com/e/E')]]])
+
+    def test_strong_components(self):
+        graph = {'a': set(['b']), 'b': set(['c']), 'c': set(['a']), 'd': set(['a']), 'e': set()}
+        components = get_strong_components(graph)
+        self.assertEqual(sorted([sorted(_c) for _c in components]),
+                         [['a', 'b', 'c'], ['d'], ['e']])
+        # Components come after the ones they reach
+        order = [_n for _c in components for _n in _c]
+        self.assertTrue(order.index('d') > order.index('a'))
+
+if __name__ == '__main__':
+    unittest.main()
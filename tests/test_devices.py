@@ -0,0 +1,69 @@
+"""
+Tests of the wait for the devices to finish booting
+"""
+
+import os
+import sys
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import devices
+from devices import wait_for_boot, get_boot_key, parse_devices
+
+class DevicesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.is_booted = devices.is_booted
+        self.get_emulator_identity = devices.get_emulator_identity
+        self.probes = []
+        self.booted_after = None
+        devices.is_booted = self._is_booted
+        devices._booted.clear()
+
+    def tearDown(self):
+        devices.is_booted = self.is_booted
+        devices.get_emulator_identity = self.get_emulator_identity
+        devices._booted.clear()
+
+    def _is_booted(self, adb=None, os_env=None, timeout=None):
+        self.probes.append((time.time(), timeout))
+        return self.booted_after is not None and len(self.probes) > self.booted_after
+
+    def test_parse_devices(self):
+        output = ('* daemon started successfully *\nList of devices attached\n'
+                  'emulator-5554\tdevice\n0123456789ABCDEF\tunauthorized\n\n')
+        self.assertEqual(parse_devices(output), [('emulator-5554', 'device'),
+                                                 ('0123456789ABCDEF', 'unauthorized')])
+
+    def test_booted(self):
+        self.booted_after = 2
+        self.assertTrue(wait_for_boot(['adb'], ('emulator-5554', 1), timeout=30, deadline=10))
+        self.assertEqual(len(self.probes), 3)
+        # Known booted in this session
+        self.assertTrue(wait_for_boot(['adb'], ('emulator-5554', 1), timeout=30, deadline=10))
+        self.assertEqual(len(self.probes), 3)
+        # Devices without a key are always asked
+        self.assertTrue(wait_for_boot(['adb'], None, timeout=30, deadline=10))
+        self.assertEqual(len(self.probes), 4)
+
+    def test_deadline(self):
+        start = time.time()
+        self.assertFalse(wait_for_boot(['adb'], None, timeout=30, deadline=0.6))
+        # No probe is given less than a second, none starts long after the deadline
+        self.assertEqual([_t for _s, _t in self.probes if _t < 1], [])
+        self.assertTrue(self.probes[-1][0] - start < 0.6 + devices.BOOT_POLL_MIN)
+
+    def test_boot_key(self):
+        devices.get_emulator_identity = lambda proc_name=None: ((1234, 5678),)
+        self.assertEqual(get_boot_key('emulator-5554', 'emulator64-x86'),
+                         ('emulator-5554', ((1234, 5678),)))
+        # Physical devices may reboot unnoticed
+        self.assertEqual(get_boot_key('0123456789ABCDEF', 'emulator64-x86'), None)
+        devices.get_emulator_identity = lambda proc_name=None: None
+        self.assertEqual(get_boot_key('emulator-5554', 'emulator64-x86'), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+"""
+Tests of the pre-dexed libraries shared in the cache
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from dexer import Dexer
+
+class DexerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='ubs-test-')
+        self.dx_bin = os.path.join(self.root, 'build-tools', 'dx')
+        os.makedirs(os.path.join(self.root, 'build-tools', 'lib'))
+        self._write(self.dx_bin, '#!/bin/sh\n')
+        self._write(os.path.join(self.root, 'build-tools', 'lib', 'dx.jar'), 'dx 1')
+        self.jar = os.path.join(self.root, 'lib.jar')
+        self._write(self.jar, 'classes')
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _write(self, fpath, data):
+        with open(fpath, 'wb') as _f:
+            _f.write(data)
+
+    def _get_predexed(self, jar):
+        dexer = Dexer(os.path.join(self.root, 'project'), self.dx_bin,
+                      cache_path=os.path.join(self.root, 'cache'))
+        return dexer._predex_libs([jar])[0][0]
+
+    def test_predexed_key(self):
+        predexed = self._get_predexed(self.jar)
+        # Keyed on the contents of the library, not on its path
+        other = os.path.join(self.root, 'other.jar')
+        shutil.copyfile(self.jar, other)
+        self.assertEqual(self._get_predexed(other), predexed)
+        self._write(other, 'other classes')
+        self.assertNotEqual(self._get_predexed(other), predexed)
+
+    def test_upgraded_dx(self):
+        predexed = self._get_predexed(self.jar)
+        self._write(os.path.join(self.root, 'build-tools', 'lib', 'dx.jar'), 'dx 2.0')
+        self.assertNotEqual(self._get_predexed(self.jar), predexed)
+
+if __name__ == '__main__':
+    unittest.main()
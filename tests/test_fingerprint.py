@@ -0,0 +1,88 @@
+"""
+Tests of the content-based fingerprints used to detect changed files
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import metainfo
+from buildindex import close_indexes
+from utils import check_if_new_or_modified_files
+from fingerprint import get_file_fingerprint, get_content_hash, get_stat_signature, \
+    format_fingerprint, parse_fingerprint
+
+class FingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='ubs-test-')
+        self.src = os.path.join(self.root, 'src')
+        os.makedirs(self.src)
+        self.source = self._write('A.java', 'class A {}\n', 1000)
+        self.meta_info = os.path.join(self.root, 'meta.info')
+
+    def tearDown(self):
+        close_indexes()
+        metainfo._stores.clear()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _write(self, name, data, mtime):
+        fpath = os.path.join(self.src, name)
+        with open(fpath, 'w') as _f:
+            _f.write(data)
+        os.utime(fpath, (mtime, mtime))
+        return fpath
+
+    def _check(self):
+        return sorted(check_if_new_or_modified_files(self.meta_info, self.src, ['.java']))
+
+    def test_fingerprint(self):
+        fp = format_fingerprint(get_stat_signature(self.source), get_content_hash(self.source))
+        self.assertEqual(get_file_fingerprint(self.source), (fp, True))
+        self.assertEqual(parse_fingerprint(fp), (get_stat_signature(self.source),
+                                                 get_content_hash(self.source)))
+        self.assertEqual(parse_fingerprint('not,a,fingerprint'), (None, None))
+        self.assertEqual(get_file_fingerprint(os.path.join(self.src, 'Missing.java'), fp),
+                         ('', True))
+
+    def test_same_signature(self):
+        # The contents are not read again while the stat signature is the same
+        old_fp = format_fingerprint(get_stat_signature(self.source), 'cached digest')
+        self.assertEqual(get_file_fingerprint(self.source, old_fp), (old_fp, False))
+
+    def test_identical_rewrite(self):
+        old_fp, _ = get_file_fingerprint(self.source)
+        self._write('A.java', 'class A {}\n', 2000)
+        fp, modified = get_file_fingerprint(self.source, old_fp)
+        self.assertFalse(modified)
+        self.assertEqual(parse_fingerprint(fp)[1], parse_fingerprint(old_fp)[1])
+        self._write('A.java', 'class A { int a; }\n', 3000)
+        self.assertTrue(get_file_fingerprint(self.source, fp)[1])
+
+    def test_known_fingerprint(self):
+        # Taken in this build already, i.e. by the stage which wrote the file
+        old_fp, _ = get_file_fingerprint(self.source)
+        self._write('A.java', 'class A { int a; }\n', 2000)
+        known = format_fingerprint(get_stat_signature(self.source), 'known digest')
+        fp, modified = get_file_fingerprint(self.source, old_fp, known)
+        self.assertEqual((fp, modified), (known, True))
+
+    def test_changed_files(self):
+        self.assertEqual(self._check(), [(self.source, 'A')])
+        self.assertEqual(self._check(), [])
+        # Saved again without changes, i.e. by an editor or a checkout
+        self._write('A.java', 'class A {}\n', 2000)
+        self.assertEqual(self._check(), [])
+        self._write('A.java', 'class A { int a; }\n', 3000)
+        b_source = self._write('B.java', 'class B {}\n', 3000)
+        self.assertEqual(self._check(), [(self.source, 'M'), (b_source, 'A')])
+        os.remove(b_source)
+        self.assertEqual(self._check(), [(b_source, 'D')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+"""
+Tests of incremental builds of a generated project built with the stub toolchain of bench/
+"""
+
+import os
+import sys
+import shutil
+import zipfile
+import tempfile
+import unittest
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+from generate import generate_workspace
+from classdeps import parse_class_file
+
+UBS = os.path.join(ROOT, 'ubs.py')
+
+PROJECT = 'Bench0'
+
+# Classes Class0 to Class5 of one package, each using the previous one
+SOURCES = 6
+
+# Along with MainActivity and R.java
+ALL_SOURCES = SOURCES + 2
+
+JAVA_PACKAGE = os.path.join('com', 'bench', 'bench0', 'p0')
+
+class IncrementalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='ubs-test-')
+        self.setup_file = generate_workspace(self.root, 1, SOURCES, 4, 1)
+        self.project_path = os.path.join(self.root, 'workspace', PROJECT)
+        self.env = os.environ.copy()
+        self.env['UBS_SETUP_FILE'] = self.setup_file
+        self.env['JAVA_HOME'] = os.path.join(self.root, 'tools')
+        self.env['ANDROID_HOME'] = os.path.join(self.root, 'tools')
+        self.env.pop('UBS_STUB_LATENCY', None)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _ubs(self, *args, **kwargs):
+        """ Returns (exit status, output) of ubs.py """
+        env = self.env.copy()
+        env.update(kwargs.get('env', {}))
+        process = subprocess.Popen([sys.executable, UBS, '--no-daemon'] + list(args),
+                                   env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        return process.returncode, output
+
+    def _build(self, action='--package'):
+        rc, output = self._ubs(action, PROJECT)
+        self.assertEqual(rc, 0, output)
+        return output
+
+    def _path(self, *names):
+        return os.path.join(self.project_path, *names)
+
+    def _source(self, idx):
+        return self._path('src', JAVA_PACKAGE, 'Class%d.java' % (idx))
+
+    def _class(self, idx):
+        return self._path('obj', JAVA_PACKAGE, 'Class%d.class' % (idx))
+
+    def _read(self, fpath):
+        with open(fpath, 'rb') as _f:
+            return _f.read()
+
+    def _read_apk_entry(self, name):
+        with zipfile.ZipFile(self._path('bin', '%s.zipped.apk' % (PROJECT))) as zf:
+            return zf.read(name)
+
+    def _use(self, idx, used):
+        # Edit which changes the compiled class, it references one more class
+        with open(self._source(idx), 'a') as _f:
+            _f.write('// uses Class%d\n' % (used))
+
+    def _get_refs(self, idx):
+        return parse_class_file(self._class(idx)).refs
+
+    def _list_files(self):
+        files = {}
+        for _root, _dirs, _files in os.walk(os.path.dirname(self.project_path)):
+            for _name in _files:
+                fpath = os.path.join(_root, _name)
+                files[fpath] = os.stat(fpath).st_mtime
+        return files
+
+    def test_replaced_resource(self):
+        self._build()
+        layout = self._path('res', 'layout', 'layout_0.xml')
+        data = self._read(layout).replace('layout 0', 'replaced layout')
+        # Saved to a new file renamed over the old one, like editors do
+        with open(layout + '.tmp', 'w') as _f:
+            _f.write(data)
+        os.rename(layout + '.tmp', layout)
+        self._build()
+        self.assertEqual(self._read(self._path('bin', 'res', 'layout', 'layout_0.xml')), data)
+        self.assertEqual(self._read_apk_entry('res/layout/layout_0.xml'), data)
+
+    def test_added_drawable(self):
+        self._build()
+        image = self._path('res', 'drawable', 'image_1.png')
+        shutil.copyfile(image, self._path('res', 'drawable', 'added_image.png'))
+        output = self._build('--compile')
+        # Its id is in R.java for the sources using it
+        self.assertTrue('Generated R.java' in output, output)
+        r_java = self._read(self._path('src', 'com', 'bench', 'bench0', 'R.java'))
+        self.assertTrue('added_image' in r_java, r_java)
+        os.remove(self._path('res', 'drawable', 'added_image.png'))
+        self._build('--compile')
+        r_java = self._read(self._path('src', 'com', 'bench', 'bench0', 'R.java'))
+        self.assertFalse('added_image' in r_java, r_java)
+
+    def test_failed_compile(self):
+        self._build()
+        classes = [self._class(_i) for _i in xrange(SOURCES)]
+        self._use(3, 0)
+        with open(self.setup_file, 'a') as _f:
+            _f.write('javac_timeout=1\n')
+        rc, output = self._ubs('--compile', PROJECT, env={'UBS_STUB_JAVAC_LATENCY': '3'})
+        self.assertNotEqual(rc, 0, output)
+        # The classes of the sources to recompile are kept until javac succeeds
+        self.assertEqual([_c for _c in classes if not os.path.exists(_c)], [])
+        output = self._build('--compile')
+        self.assertTrue('Re-compiling 3 of %d sources' % (ALL_SOURCES) in output, output)
+        self.assertTrue('com/bench/bench0/p0/Class0' in self._get_refs(3))
+
+    def test_compile_then_package(self):
+        self._build()
+        self._use(4, 1)
+        self._build('--compile')
+        output = self._build()
+        self.assertTrue('Created %s.unsigned.apk' % (PROJECT) in output, output)
+        self.assertEqual(self._read_apk_entry('classes.dex'),
+                         self._read(self._path('bin', 'classes.dex')))
+
+    def test_deleted_source(self):
+        self._build()
+        dex = self._read(self._path('bin', 'classes.dex'))
+        os.remove(self._source(SOURCES - 1))
+        output = self._build()
+        self.assertTrue('Removing 1 classes of deleted sources' in output, output)
+        self.assertFalse(os.path.exists(self._class(SOURCES - 1)))
+        self.assertNotEqual(self._read(self._path('bin', 'classes.dex')), dex)
+        self.assertEqual(self._read_apk_entry('classes.dex'),
+                         self._read(self._path('bin', 'classes.dex')))
+        rc, output = self._ubs('--package', PROJECT, '--dry-run')
+        self.assertTrue('Dry run: 0 of' in output, output)
+
+    def test_dry_run(self):
+        # Nothing is written in the workspace, not even the build index of a project never built
+        files = self._list_files()
+        rc, output = self._ubs('--package', PROJECT, '--dry-run')
+        self.assertEqual(rc, 0, output)
+        self.assertTrue('Dry run: ' in output, output)
+        self.assertEqual(self._list_files(), files)
+        self._build()
+        self._use(2, 0)
+        files = self._list_files()
+        rc, output = self._ubs('--package', PROJECT, '--dry-run')
+        self.assertEqual(rc, 0, output)
+        self.assertTrue('Class2.java' in output, output)
+        self.assertEqual(self._list_files(), files)
+
+    def test_changed_constant(self):
+        self._build()
+        source = self._read(self._source(0))
+        declaration = 'public class Class0 {\n'
+        with open(self._source(0), 'w') as _f:
+            _f.write(source.replace(declaration,
+                                    declaration + '    public static final int LIMIT = 1;\n'))
+        output = self._build('--compile')
+        self.assertTrue('Re-compiling %d of %d sources' % (SOURCES, ALL_SOURCES) in output, output)
+        # javac inlines the value where it is used, without a reference to Class0
+        main_activity = self._path('obj', 'com', 'bench', 'bench0', 'MainActivity.class')
+        mtime = os.stat(main_activity).st_mtime
+        with open(self._source(0), 'w') as _f:
+            _f.write(source.replace(declaration,
+                                    declaration + '    public static final int LIMIT = 2;\n'))
+        output = self._build('--compile')
+        self.assertTrue('Re-compiling every source' in output, output)
+        self.assertNotEqual(os.stat(main_activity).st_mtime, mtime)
+
+    def test_pkcs12_key_store(self):
+        self.setup_file = generate_workspace(self.root, 1, SOURCES, 4, 1, 'python')
+        # DER sequence of a PKCS12 keystore, i.e. written by keytool since Java 9
+        with open(os.path.join(self.root, 'tools', 'bench.keystore'), 'wb') as _f:
+            _f.write('\x30\x82\x0a\x00\x02\x01\x03')
+        output = self._build()
+        self.assertTrue('is not a JKS keystore, signing with jarsigner' in output, output)
+        self.assertTrue(os.path.isfile(self._path('bin', '%s.zipped.apk' % (PROJECT))))
+
+if __name__ == '__main__':
+    unittest.main()
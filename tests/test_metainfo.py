@@ -0,0 +1,94 @@
+"""
+Tests of the meta.info fingerprints kept in a base file plus a journal
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import metainfo
+from metainfo import FingerprintStore, HEADER, JOURNAL_SUFFIX
+
+class MetaInfoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='ubs-test-')
+        self.path = os.path.join(self.root, 'meta.info')
+        self.journal = self.path + JOURNAL_SUFFIX
+        self.compact_min_entries = metainfo.COMPACT_MIN_ENTRIES
+
+    def tearDown(self):
+        metainfo.COMPACT_MIN_ENTRIES = self.compact_min_entries
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _read(self, fpath):
+        with open(fpath) as _f:
+            return _f.read()
+
+    def _load(self):
+        store = FingerprintStore(self.path)
+        store.load()
+        return store
+
+    def test_journal(self):
+        store = self._load()
+        store.update({'/p/A.java': 'a1', '/p/B.java': 'b1'})
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(self._read(self.journal), '/p/A.java\ta1\n/p/B.java\tb1\n')
+        # Unchanged fingerprints are not written again
+        store.update({'/p/A.java': 'a1'})
+        store.update({'/p/A.java': 'a2'}, ['/p/B.java', '/p/C.java'])
+        self.assertEqual(self._read(self.journal).splitlines()[2:],
+                         ['/p/A.java\ta2', '/p/B.java\t'])
+        self.assertEqual(dict(self._load().items()), {'/p/A.java': 'a2'})
+
+    def test_torn_journal(self):
+        self._load().update({'/p/A.java': 'a1'})
+        # A build killed while appending
+        with open(self.journal, 'a') as _f:
+            _f.write('/p/B.java\tb')
+        self.assertEqual(dict(self._load().items()), {'/p/A.java': 'a1'})
+
+    def test_compaction(self):
+        metainfo.COMPACT_MIN_ENTRIES = 4
+        store = self._load()
+        store.update(dict([('/p/%d.java' % (_i), 'f%d' % (_i)) for _i in xrange(3)]))
+        self.assertFalse(os.path.exists(self.path))
+        store.update({'/p/0.java': 'g0'}, ['/p/1.java'])
+        # Compacted into the base file once the journal grew enough
+        self.assertFalse(os.path.exists(self.journal))
+        self.assertEqual(self._read(self.path), HEADER + '/p/0.java\tg0\n/p/2.java\tf2\n')
+        # Not before the journal has half as many entries as the base file
+        store.update(dict([('/p/%d.java' % (_i), 'h%d' % (_i)) for _i in xrange(3, 20)]))
+        store.compact()
+        store.update(dict([('/p/%d.java' % (_i), 'i%d' % (_i)) for _i in xrange(3, 8)]))
+        self.assertTrue(os.path.exists(self.journal))
+        store.update(dict([('/p/%d.java' % (_i), 'i%d' % (_i)) for _i in xrange(8, 13)]))
+        self.assertFalse(os.path.exists(self.journal))
+        self.assertEqual(dict(self._load().items()), dict(store.items()))
+
+    def test_other_process(self):
+        store = self._load()
+        store.update({'/p/A.java': 'a1'})
+        self._load().update({'/p/A.java': 'a2'})
+        store.load()
+        self.assertEqual(store.get('/p/A.java'), 'a2')
+
+    def test_legacy_meta_info(self):
+        # Java properties written by older versions
+        with open(self.path, 'w') as _f:
+            _f.write('#comment\n/p/A.java=a1\n')
+        store = self._load()
+        self.assertEqual(store.get('/p/A.java'), 'a1')
+        # Rewritten in the new format on the first change
+        store.update({'/p/B.java': 'b1'})
+        self.assertEqual(self._read(self.path), HEADER + '/p/A.java\ta1\n/p/B.java\tb1\n')
+        self.assertFalse(os.path.exists(self.journal))
+
+if __name__ == '__main__':
+    unittest.main()
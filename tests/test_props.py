@@ -0,0 +1,119 @@
+"""
+Tests of the properties parser and of the parsed snapshots of setup files
+"""
+
+import os
+import sys
+import shutil
+import marshal
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import props
+from props import Properties, loadProperties, SNAPSHOT_SUFFIX
+
+# (file contents, parsed properties, pristine properties) as the parser always read them
+CASES = [
+    ('key=value', {'key': 'value'}, {'key': 'value'}),
+    ('key = value', {'key': 'value'}, {'key': 'value'}),
+    ('key:value', {'key': 'value'}, {'key': 'value'}),
+    ('key : value', {'key': 'value'}, {'key': 'value'}),
+    ('key value', {'key': 'value'}, {'key': 'value'}),
+    ('key\tvalue', {'key': 'value'}, {'key': 'value'}),
+    ('  indented.key=  spaced value  ', {'indented.key': 'spaced value'},
+     {'indented.key': 'spaced value'}),
+    ('space key=v', {'space': 'key=v'}, {'space': 'key=v'}),
+    ('eq=a=b:c', {'eq': 'a=b:c'}, {'eq': 'a=b:c'}),
+    ('colon:a=b', {'colon': 'a=b'}, {'colon': 'a=b'}),
+    ('empty=', {'empty': ''}, {'empty': ''}),
+    ('lonely', {'lonely': ''}, {'lonely': ''}),
+    ('# comment=x\n\n', {}, {}),
+    # Escapes
+    ('path=C\\:\\\\sdk', {'path': 'C:\\\\sdk'}, {'path': 'C:\\\\sdk'}),
+    ('url=http\\://host\\:8080/a\\=b', {'url': 'http://host:8080/a=b'},
+     {'url': 'http://host:8080/a=b'}),
+    ('a\\=b=c', {'a=b': 'c'}, {'a\\=b': 'c'}),
+    ('a\\:b:c', {'a:b': 'c'}, {'a\\:b': 'c'}),
+    ('key\\ with\\ spaces=v', {'key with spaces': 'v'}, {'key\\ with\\ spaces': 'v'}),
+    # Continuation lines
+    ('long=first \\\n   second \\\n   third', {'long': 'first second third'},
+     {'long': 'first second third'}),
+    ('a=1\\\n2\nb=3', {'a': '12', 'b': '3'}, {'a': '12', 'b': '3'}),
+]
+
+class PropsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='ubs-test-')
+        self.path = os.path.join(self.root, 'setup.properties')
+        props._propCache.clear()
+
+    def tearDown(self):
+        props._propCache.clear()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _write(self, data, mtime=None):
+        with open(self.path, 'w') as _f:
+            _f.write(data)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def _parse(self, data):
+        self._write(data + '\n')
+        p = Properties()
+        with open(self.path) as _f:
+            p.load(_f)
+        return p
+
+    def test_parse(self):
+        for _data, _props, _origprops in CASES:
+            p = self._parse(_data)
+            self.assertEqual(p.getPropertyDict(), _props, _data)
+            self.assertEqual(p._origprops, _origprops, _data)
+
+    def test_parse_file(self):
+        # Lines without '=' nor ':' don't depend on the lines before them
+        p = self._parse('\n'.join([_c[0] for _c in CASES]))
+        self.assertEqual(p['key'], 'value')
+        self.assertEqual(p['lonely'], '')
+        self.assertEqual(p['a:b'], 'c')
+        self.assertEqual(p['long'], 'first second third')
+
+    def test_snapshot(self):
+        self._write('java_home=/opt/jdk\nkey_alias=debug\n')
+        p = loadProperties(self.path)
+        self.assertEqual(p['java_home'], '/opt/jdk')
+        self.assertTrue(os.path.exists(self.path + SNAPSHOT_SUFFIX))
+        # Another process reads the snapshot instead of parsing the file
+        with open(self.path + SNAPSHOT_SUFFIX, 'rb') as _f:
+            snapshot = marshal.load(_f)
+        snapshot[1]['java_home'] = '/from/snapshot'
+        with open(self.path + SNAPSHOT_SUFFIX, 'wb') as _f:
+            marshal.dump(snapshot, _f)
+        props._propCache.clear()
+        self.assertEqual(loadProperties(self.path)['java_home'], '/from/snapshot')
+
+    def test_edited_file(self):
+        self._write('java_home=/opt/jdk7\n', mtime=1000)
+        self.assertEqual(loadProperties(self.path)['java_home'], '/opt/jdk7')
+        # Same size, only the contents and mtime differ
+        self._write('java_home=/opt/jdk8\n', mtime=2000)
+        self.assertEqual(loadProperties(self.path)['java_home'], '/opt/jdk8')
+        # Nor does a new process read the stale snapshot
+        self._write('java_home=/opt/jdk9\n', mtime=3000)
+        props._propCache.clear()
+        self.assertEqual(loadProperties(self.path)['java_home'], '/opt/jdk9')
+        props._propCache.clear()
+        self.assertEqual(loadProperties(self.path)['java_home'], '/opt/jdk9')
+
+    def test_corrupt_snapshot(self):
+        self._write('author=me\n')
+        with open(self.path + SNAPSHOT_SUFFIX, 'wb') as _f:
+            _f.write('not marshalled')
+        self.assertEqual(loadProperties(self.path)['author'], 'me')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,253 @@
+"""
+Tests of the APKs signed while they are written
+"""
+
+import os
+import sys
+import base64
+import random
+import shutil
+import struct
+import hashlib
+import zipfile
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from apk import write_apk, ALIGNMENT, LOCAL_HEADER_SIZE
+from signer import SigningApkWriter, SigningError, load_jks_entry, is_jks_key_store, \
+    der, der_seq, der_set, der_int, der_null, der_octets, der_oid, der_read, der_children, \
+    JKS_MAGIC, JKS_PRIVATE_KEY, JKS_INTEGRITY_SALT, OID_JKS_KEY_PROTECTOR, \
+    OID_RSA_ENCRYPTION, SHA1_DIGEST_INFO
+
+ALIAS = 'androiddebugkey'
+STORE_PASS = 'android'
+KEY_PASS = 'keypass'
+
+def _is_prime(n):
+    if n % 2 == 0:
+        return n == 2
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d, s = d // 2, s + 1
+    for _a in [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41]:
+        x = pow(_a, d, n)
+        if x in (1, n - 1):
+            continue
+        for _ in xrange(s - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+def _get_prime(rng, bits):
+    n = rng.getrandbits(bits) | (3 << (bits - 2)) | 1
+    while not _is_prime(n):
+        n += 2
+    return n
+
+def _inverse(a, m):
+    # Extended Euclid
+    x0, x1, r0, r1 = 1, 0, a, m
+    while r1:
+        q = r0 // r1
+        x0, x1, r0, r1 = x1, x0 - q * x1, r1, r0 - q * r1
+    return x0 % m
+
+# Returns (n, e, d, p, q) of a fixed 1024 bits RSA key
+def make_rsa_key(seed=16):
+    rng = random.Random(seed)
+    e = 65537
+    while True:
+        p, q = _get_prime(rng, 512), _get_prime(rng, 512)
+        phi = (p - 1) * (q - 1)
+        if p != q and phi % e:
+            return p * q, e, _inverse(e, phi), p, q
+
+def _bit_string(data):
+    return der(0x03, '\0' + data)
+
+def _name(common_name):
+    return der_seq(der_set(der_seq(der_oid('2.5.4.3'), der(0x0c, common_name))))
+
+# Returns a self-signed looking X.509 certificate of the public key
+def make_certificate(n, e, serial=0x1234):
+    rsa = der_seq(der_oid(OID_RSA_ENCRYPTION), der_null())
+    sha1_rsa = der_seq(der_oid('1.2.840.113549.1.1.5'), der_null())
+    tbs = der_seq(der(0xa0, der_int(2)),
+                  der_int(serial),
+                  sha1_rsa,
+                  _name('Android Debug'),
+                  der_seq(der(0x17, '700101000000Z'), der(0x17, '491231235959Z')),
+                  _name('Android Debug'),
+                  der_seq(rsa, _bit_string(der_seq(der_int(n), der_int(e)))))
+    return der_seq(tbs, sha1_rsa, _bit_string('\0' * 128))
+
+def _utf(value):
+    return struct.pack('>H', len(value)) + value
+
+def _password_bytes(password):
+    return password.decode('utf-8').encode('utf-16-be')
+
+# Protects a PKCS#8 private key like the JKS key protector
+def _protect_key(plain, password, salt='s' * 20):
+    passwd = _password_bytes(password)
+    keystream = []
+    digest = salt
+    while len(keystream) * 20 < len(plain):
+        digest = hashlib.sha1(passwd + digest).digest()
+        keystream.append(digest)
+    cipher = ''.join([chr(ord(_c) ^ ord(_k)) for _c, _k in zip(plain, ''.join(keystream))])
+    encrypted = salt + cipher + hashlib.sha1(passwd + plain).digest()
+    return der_seq(der_seq(der_oid(OID_JKS_KEY_PROTECTOR), der_null()),
+                   der_octets(encrypted))
+
+# Writes a JKS keystore holding the RSA key and its certificate
+def make_key_store(path, key, cert):
+    n, e, d, p, q = key
+    rsa_key = der_seq(der_int(0), der_int(n), der_int(e), der_int(d), der_int(p), der_int(q),
+                      der_int(d % (p - 1)), der_int(d % (q - 1)), der_int(_inverse(q, p)))
+    pkcs8 = der_seq(der_int(0), der_seq(der_oid(OID_RSA_ENCRYPTION), der_null()),
+                    der_octets(rsa_key))
+    protected = _protect_key(pkcs8, KEY_PASS)
+    data = struct.pack('>III', JKS_MAGIC, 2, 1)
+    data += struct.pack('>I', JKS_PRIVATE_KEY) + _utf(ALIAS) + struct.pack('>Q', 0)
+    data += struct.pack('>I', len(protected)) + protected
+    data += struct.pack('>I', 1) + _utf('X.509') + struct.pack('>I', len(cert)) + cert
+    data += hashlib.sha1(_password_bytes(STORE_PASS) + JKS_INTEGRITY_SALT + data).digest()
+    with open(path, 'wb') as _f:
+        _f.write(data)
+
+# Parses the sections of a manifest or signature file, unwrapping continuation lines
+def parse_manifest(data):
+    sections = []
+    for _section in data.split('\r\n\r\n'):
+        if not _section:
+            continue
+        attrs = {}
+        key = None
+        for _line in _section.split('\r\n'):
+            if _line.startswith(' '):
+                attrs[key] += _line[1:]
+            else:
+                key, value = _line.split(': ', 1)
+                attrs[key] = value
+        sections.append(attrs)
+    return sections
+
+def _sha1(data):
+    return base64.b64encode(hashlib.sha1(data).digest())
+
+def _bytes_to_int(data):
+    return int(data.encode('hex'), 16)
+
+class SignerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.key = make_rsa_key()
+        cls.cert = make_certificate(cls.key[0], cls.key[1])
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='ubs-test-')
+        self.key_store = os.path.join(self.root, 'debug.keystore')
+        make_key_store(self.key_store, self.key, self.cert)
+        # Packaged resources, one stored image and compressed xml
+        self.resources = os.path.join(self.root, 'resources.ap_')
+        with zipfile.ZipFile(self.resources, 'w') as zf:
+            zf.writestr('AndroidManifest.xml', '<manifest/>', zipfile.ZIP_DEFLATED)
+            zf.writestr('res/drawable/icon.png', '\x89PNG' + 'x' * 101, zipfile.ZIP_STORED)
+            zf.writestr('res/layout/a_layout_with_a_name_long_enough_to_wrap_the_manifest_line.xml',
+                        '<LinearLayout/>', zipfile.ZIP_DEFLATED)
+            zf.writestr('resources.arsc', 'r' * 33, zipfile.ZIP_STORED)
+        self.dex = os.path.join(self.root, 'classes.dex')
+        with open(self.dex, 'wb') as _f:
+            _f.write('dex\n035\0' + 'd' * 200)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _write_apk(self, name='app.apk'):
+        apk = os.path.join(self.root, name)
+        entry = load_jks_entry(self.key_store, ALIAS, STORE_PASS, KEY_PASS)
+        self.assertTrue(write_apk(apk, self.resources, self.dex,
+                                  writer_class=SigningApkWriter, key_entry=entry))
+        return apk
+
+    def test_load_key_store(self):
+        self.assertTrue(is_jks_key_store(self.key_store))
+        entry = load_jks_entry(self.key_store, ALIAS.upper(), STORE_PASS, KEY_PASS)
+        self.assertEqual(entry.modulus, self.key[0])
+        self.assertEqual(entry.private_exponent, self.key[2])
+        self.assertEqual(entry.certs, [self.cert])
+        self.assertRaises(SigningError, load_jks_entry, self.key_store, ALIAS, 'wrong', KEY_PASS)
+        self.assertRaises(SigningError, load_jks_entry, self.key_store, ALIAS, STORE_PASS, 'wrong')
+        self.assertRaises(SigningError, load_jks_entry, self.key_store, 'other', STORE_PASS, KEY_PASS)
+
+    def test_signature(self):
+        apk = self._write_apk()
+        with zipfile.ZipFile(apk) as zf:
+            self.assertEqual(zf.testzip(), None)
+            names = [_n for _n in zf.namelist() if not _n.startswith('META-INF/')]
+            self.assertEqual(sorted(names), sorted(['AndroidManifest.xml', 'classes.dex',
+                                                    'res/drawable/icon.png', 'resources.arsc',
+                                                    'res/layout/a_layout_with_a_name_long_enough'
+                                                    '_to_wrap_the_manifest_line.xml']))
+            manifest = zf.read('META-INF/MANIFEST.MF')
+            signature_file = zf.read('META-INF/ANDROIDD.SF')
+            block = zf.read('META-INF/ANDROIDD.RSA')
+            # Every entry is digested in the manifest
+            sections = parse_manifest(manifest)
+            self.assertEqual(sections[0]['Manifest-Version'], '1.0')
+            digests = dict([(_s['Name'], _s['SHA1-Digest']) for _s in sections[1:]])
+            self.assertEqual(sorted(digests.keys()), sorted(names))
+            for _name in names:
+                self.assertEqual(digests[_name], _sha1(zf.read(_name)))
+        # The signature file digests the manifest and each of its sections
+        sections = parse_manifest(signature_file)
+        self.assertEqual(sections[0]['SHA1-Digest-Manifest'], _sha1(manifest))
+        manifest_sections = dict([(parse_manifest(_s + '\r\n\r\n')[0]['Name'], _s + '\r\n\r\n')
+                                  for _s in manifest.split('\r\n\r\n')[1:] if _s])
+        for _section in sections[1:]:
+            self.assertEqual(_section['SHA1-Digest'], _sha1(manifest_sections[_section['Name']]))
+        # PKCS#7 signed data: the signer is the certificate, the signature verifies
+        _, start, end = der_read(block)
+        _, content_start, _, _ = der_children(block, start, end)[1]
+        _, sd_start, sd_end = der_read(block, content_start)
+        signed_data = der_children(block, sd_start, sd_end)
+        self.assertEqual(block[signed_data[3][1]:signed_data[3][2]], self.cert)
+        _, si_start, si_end = der_read(block, signed_data[4][1])
+        signer_info = der_children(block, si_start, si_end)
+        issuer_and_serial = block[signer_info[1][3]:signer_info[1][2]]
+        self.assertTrue(der_int(0x1234) in issuer_and_serial)
+        signature = block[signer_info[4][1]:signer_info[4][2]]
+        n, e = self.key[0], self.key[1]
+        self.assertEqual(len(signature), 128)
+        encoded = '\0\1' + '\xff' * (128 - 3 - len(SHA1_DIGEST_INFO) - 20) + '\0' + \
+            SHA1_DIGEST_INFO + hashlib.sha1(signature_file).digest()
+        self.assertEqual(pow(_bytes_to_int(signature), e, n), _bytes_to_int(encoded))
+
+    def test_alignment(self):
+        apk = self._write_apk()
+        with open(apk, 'rb') as _f:
+            data = _f.read()
+        with zipfile.ZipFile(apk) as zf:
+            for _info in zf.infolist():
+                if _info.compress_type != zipfile.ZIP_STORED:
+                    continue
+                name_len, extra_len = struct.unpack_from('<HH', data, _info.header_offset + 26)
+                offset = _info.header_offset + LOCAL_HEADER_SIZE + name_len + extra_len
+                self.assertEqual(offset % ALIGNMENT, 0, _info.filename)
+
+    def test_same_contents_same_apk(self):
+        with open(self._write_apk('a.apk'), 'rb') as _f:
+            first = _f.read()
+        with open(self._write_apk('b.apk'), 'rb') as _f:
+            self.assertEqual(_f.read(), first)
+
+if __name__ == '__main__':
+    unittest.main()
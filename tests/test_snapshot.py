@@ -0,0 +1,122 @@
+"""
+Tests of the indexed snapshot of the files of a project
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import snapshot
+from snapshot import Snapshot, keep_snapshots, get_snapshot, RACY_MTIME
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='ubs-test-')
+        for _f in ['src/com/a/A.java', 'src/com/a/B.java', 'res/layout/main.xml',
+                   'res/drawable/icon.png', 'bin/Test.unsigned.apk', 'bin/resources.ap_']:
+            self._write(_f)
+        # Listed long after their last change
+        self._set_old_mtimes()
+
+    def tearDown(self):
+        snapshot._kept = None
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _path(self, name):
+        return os.path.join(self.root, *name.split('/'))
+
+    def _write(self, name, same_dir_mtime=False):
+        fpath = self._path(name)
+        if not os.path.isdir(os.path.dirname(fpath)):
+            os.makedirs(os.path.dirname(fpath))
+        dir_mtime = os.stat(os.path.dirname(fpath)).st_mtime
+        with open(fpath, 'w') as _f:
+            _f.write(name)
+        if same_dir_mtime:
+            # The directory keeps its mtime, i.e. changed within its granularity
+            os.utime(os.path.dirname(fpath), (dir_mtime, dir_mtime))
+        return fpath
+
+    def _set_old_mtimes(self):
+        # Whole seconds, given back exactly by os.stat
+        old = int(time.time() - 10 * RACY_MTIME)
+        for _root, _dirs, _files in os.walk(self.root):
+            os.utime(_root, (old, old))
+
+    def _names(self, files):
+        return [os.path.relpath(_f, self.root).replace(os.sep, '/') for _f in files]
+
+    def test_get_files(self):
+        snap = Snapshot(self.root)
+        self.assertEqual(self._names(snap.get_files(self._path('src'), ['.java'])),
+                         ['src/com/a/A.java', 'src/com/a/B.java'])
+        self.assertEqual(self._names(snap.get_files(self._path('res'), ['.xml', '.png'])),
+                         ['res/drawable/icon.png', 'res/layout/main.xml'])
+        self.assertEqual(self._names(snap.get_files(self._path('bin'), ['.unsigned.apk'])),
+                         ['bin/Test.unsigned.apk'])
+        self.assertEqual(self._names(snap.get_files(self._path('bin'), ['.ap_', '.apk'])),
+                         ['bin/resources.ap_', 'bin/Test.unsigned.apk'])
+
+    def test_refresh(self):
+        snap = Snapshot(self.root)
+        snap.get_files(self.root, ['.class'])
+        self._write('obj/com/a/A.class')
+        self._write('src/com/a/C.java')
+        # Only the directories a stage wrote to are scanned again
+        snap.refresh(self._path('obj'))
+        self.assertEqual(self._names(snap.get_files(self._path('obj'), ['.class'])),
+                         ['obj/com/a/A.class'])
+        self.assertEqual(len(snap.get_files(self._path('src'), ['.java'])), 2)
+        snap.refresh(self._path('src'))
+        self.assertEqual(len(snap.get_files(self._path('src'), ['.java'])), 3)
+
+    def test_revalidate(self):
+        snap = Snapshot(self.root)
+        snap.get_files(self.root, ['.java'])
+        self._write('src/com/a/C.java')
+        os.makedirs(self._path('src/com/b'))
+        self._write('src/com/b/D.java')
+        shutil.rmtree(self._path('res/drawable'))
+        snap.revalidate()
+        self.assertEqual(self._names(snap.get_files(self._path('src'), ['.java'])),
+                         ['src/com/a/A.java', 'src/com/a/B.java', 'src/com/a/C.java',
+                          'src/com/b/D.java'])
+        self.assertEqual(self._names(snap.get_files(self._path('res'), ['.png', '.xml'])),
+                         ['res/layout/main.xml'])
+
+    def test_revalidate_unchanged_dirs(self):
+        snap = Snapshot(self.root)
+        snap.get_files(self.root, ['.java'])
+        # Directories whose mtime didn't change are not listed again
+        self._write('src/com/a/C.java', same_dir_mtime=True)
+        snap.revalidate()
+        self.assertEqual(len(snap.get_files(self._path('src'), ['.java'])), 2)
+
+    def test_revalidate_racy_dirs(self):
+        # Changed right before being listed, the same mtime proves nothing
+        self._write('src/com/a/C.java')
+        snap = Snapshot(self.root)
+        snap.get_files(self.root, ['.java'])
+        self._write('src/com/a/D.java', same_dir_mtime=True)
+        snap.revalidate()
+        self.assertEqual(len(snap.get_files(self._path('src'), ['.java'])), 4)
+
+    def test_kept_snapshots(self):
+        self.assertFalse(get_snapshot(self.root) is get_snapshot(self.root))
+        keep_snapshots()
+        snap = get_snapshot(self.root)
+        snap.get_files(self.root, ['.java'])
+        self._write('src/com/a/C.java')
+        # The same snapshot, brought up to date
+        self.assertTrue(get_snapshot(self.root) is snap)
+        self.assertEqual(len(snap.get_files(self._path('src'), ['.java'])), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+"""
+Tests of the workers running tools with the stub worker of bench/
+"""
+
+import os
+import sys
+import time
+import shutil
+import signal
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+import workers
+from generate import generate_tools
+from workers import Worker, WorkerPool, WorkerError
+from utils import run_command
+
+class WorkersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='ubs-test-')
+        self.tools = generate_tools(os.path.join(self.root, 'tools'))
+        self.jarsigner = os.path.join(self.tools, 'jarsigner')
+        self.env = os.environ.copy()
+        for _var in ['UBS_STUB_LATENCY', 'UBS_STUB_JARSIGNER_LATENCY', 'UBS_STUB_WORKER_EXIT']:
+            self.env.pop(_var, None)
+        self.unsigned = os.path.join(self.root, 'app.unsigned.apk')
+        with open(self.unsigned, 'wb') as _f:
+            _f.write('apk')
+        self.pools = []
+
+    def tearDown(self):
+        for _p in self.pools:
+            _p.stop()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _pool(self, max_requests=None):
+        pool = WorkerPool({self.jarsigner: ('jarsigner', [self.jarsigner, '--worker'])},
+                          max_requests)
+        self.pools.append(pool)
+        return pool
+
+    def _command(self, name='app.signed.apk'):
+        # What jarsigner is run with, the stub copies the unsigned apk
+        return [self.jarsigner, '-signedjar', os.path.join(self.root, name),
+                self.unsigned, 'alias']
+
+    def _get_idle_pids(self, pool):
+        return [_w.proc.pid for _w in pool._idle]
+
+    def test_round_trip(self):
+        worker = Worker('javac', [os.path.join(self.tools, 'javac'), '--worker'],
+                        self.root, self.env)
+        try:
+            source = os.path.join(self.root, 'src', 'A.java')
+            os.makedirs(os.path.dirname(source))
+            with open(source, 'w') as _f:
+                _f.write('package a;\npublic class A {}\n')
+            obj = os.path.join(self.root, 'obj')
+            self.assertEqual(worker.run(['-d', obj, source]), (0, 'compiled 1 sources\n', ''))
+            self.assertTrue(os.path.exists(os.path.join(obj, 'a', 'A.class')))
+            # Failures come back as the exit status and error output of the tool
+            status, out, err = worker.run(['-d', obj, os.path.join(self.root, 'B.java')])
+            self.assertEqual(status, 1)
+            self.assertTrue(err)
+            self.assertEqual(worker.requests, 2)
+        finally:
+            worker.stop()
+
+    def test_failed_handshake(self):
+        # The tool itself doesn't speak the protocol
+        self.assertRaises(WorkerError, Worker, 'jarsigner', [self.jarsigner], self.root, self.env)
+        pool = WorkerPool({self.jarsigner: ('jarsigner', [self.jarsigner])})
+        self.assertEqual(pool.run(self._command(), self.root, self.env), None)
+        # Not tried again
+        self.assertTrue('jarsigner' in pool._broken)
+
+    def test_recycling(self):
+        pool = self._pool(max_requests=2)
+        self.assertEqual(pool.run(self._command('a.apk'), self.root, self.env), (0, '', ''))
+        pids = self._get_idle_pids(pool)
+        self.assertEqual(len(pids), 1)
+        self.assertEqual(pool.run(self._command('b.apk'), self.root, self.env), (0, '', ''))
+        # Stopped after its second request
+        self.assertEqual(self._get_idle_pids(pool), [])
+        self.assertEqual(pool.run(self._command('c.apk'), self.root, self.env), (0, '', ''))
+        self.assertNotEqual(self._get_idle_pids(pool), pids)
+        for _name in ['a.apk', 'b.apk', 'c.apk']:
+            self.assertTrue(os.path.exists(os.path.join(self.root, _name)))
+
+    def test_worker_died(self):
+        self.env['UBS_STUB_WORKER_EXIT'] = '1'
+        pool = self._pool()
+        self.assertEqual(pool.run(self._command(), self.root, self.env), None)
+        self.assertEqual(pool._idle, [])
+        self.assertFalse('jarsigner' in pool._broken)
+        # run_command runs the tool on its own instead
+        workers.stop_workers()
+        workers._pool, workers._pool_pid = pool, os.getpid()
+        try:
+            self.assertEqual(run_command(self._command(), self.root, self.env), 0)
+        finally:
+            workers._pool, workers._pool_pid = None, None
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'app.signed.apk')))
+
+    def test_timeout(self):
+        self.env['UBS_STUB_JARSIGNER_LATENCY'] = '5'
+        pool = self._pool()
+        start = time.time()
+        self.assertEqual(pool.run(self._command(), self.root, self.env, timeout=0.5),
+                         (-signal.SIGKILL, '', ''))
+        self.assertTrue(time.time() - start < 4)
+        # The killed worker isn't used again
+        self.assertEqual(pool._idle, [])
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'app.signed.apk')))
+
+if __name__ == '__main__':
+    unittest.main()
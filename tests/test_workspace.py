@@ -0,0 +1,42 @@
+"""
+Tests of the projects built concurrently
+"""
+
+import os
+import sys
+import unittest
+import multiprocessing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import workspace
+from workspace import build_projects
+
+# Forked builds report the jobs they were given through their result
+def _check_jobs(name=None, jobs=None, explain=None):
+    return jobs == int(name.split(':')[1]) and explain
+
+class WorkspaceTest(unittest.TestCase):
+
+    def setUp(self):
+        workspace.ACTIONS['check'] = _check_jobs
+
+    def tearDown(self):
+        del workspace.ACTIONS['check']
+
+    def _build(self, projects, jobs, budget):
+        names = ['Project%d:%d' % (_i, budget) for _i in xrange(projects)]
+        results = build_projects('check', names, jobs, {'explain': True})
+        self.assertEqual([(_r[0], _r[1]) for _r in results], [(_n, True) for _n in names])
+
+    def test_jobs_per_project(self):
+        cpus = multiprocessing.cpu_count()
+        # One project at a time, each uses every CPU
+        self._build(3, 1, cpus)
+        self._build(2, 2, max(1, cpus // 2))
+        # Never more projects at the same time than projects
+        self._build(2, 8, max(1, cpus // 2))
+
+if __name__ == '__main__':
+    unittest.main()
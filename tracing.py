@@ -0,0 +1,154 @@
+"""
+Module that records the spans of a build as Chrome trace events
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import resource
+import threading
+
+# CPU time of the calling thread where the system tells it, of the process otherwise
+if hasattr(resource, 'RUSAGE_THREAD'):
+    RUSAGE_WHO = resource.RUSAGE_THREAD
+elif sys.platform.startswith('linux'):
+    RUSAGE_WHO = 1
+else:
+    RUSAGE_WHO = resource.RUSAGE_SELF
+
+# Suffix of the events recorded by forked workers, merged on save
+PART_SUFFIX = '.part'
+
+# Tracer of this build, None when not tracing
+_tracer = None
+
+def _cpu_time():
+    usage = resource.getrusage(RUSAGE_WHO)
+    return usage.ru_utime + usage.ru_stime
+
+def _us(seconds):
+    return int(seconds * 1000000)
+
+class Tracer():
+    """
+    Class that collects complete ("X") trace events, from every thread and forked worker
+    """
+    def __init__(self, path=None):
+        self.path = os.path.abspath(path)
+        self.pid = os.getpid()
+        self.events = []
+        self._threads = set()
+        self._lock = threading.Lock()
+
+    def _part_path(self):
+        return '%s.%d%s' % (self.path, os.getpid(), PART_SUFFIX)
+
+    def add(self, name, cat, start, end, args=None):
+        thread = threading.current_thread()
+        event = {'name': name, 'cat': cat, 'ph': 'X',
+                 'ts': _us(start), 'dur': _us(end - start),
+                 'pid': os.getpid(), 'tid': thread.ident}
+        if args:
+            event['args'] = args
+        with self._lock:
+            if (event['pid'], thread.ident) not in self._threads:
+                self._threads.add((event['pid'], thread.ident))
+                self.events.append({'name': 'thread_name', 'ph': 'M',
+                                    'pid': event['pid'], 'tid': thread.ident,
+                                    'args': {'name': thread.name}})
+            self.events.append(event)
+
+    def flush(self):
+        """ Saves the events of a forked worker for the main process to merge them """
+        if os.getpid() == self.pid:
+            return
+        with self._lock:
+            events, self.events = self.events, []
+        if events:
+            with open(self._part_path(), 'a') as _f:
+                for _e in events:
+                    _f.write('%s\n' % (json.dumps(_e)))
+
+    def save(self):
+        events = list(self.events)
+        for _part in glob.glob('%s.*%s' % (self.path, PART_SUFFIX)):
+            with open(_part) as _f:
+                events.extend([json.loads(_l) for _l in _f if _l.strip()])
+            os.remove(_part)
+        with open(self.path, 'w') as _f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, _f)
+        return len(events)
+
+class _Span():
+    """
+    Class that records the wall and CPU time of a block into the tracer
+    """
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        self.cpu = _cpu_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        end = time.time()
+        if _tracer is not None:
+            self.args['cpu_ms'] = round((_cpu_time() - self.cpu) * 1000, 3)
+            if exc_type is not None:
+                self.args['error'] = exc_type.__name__
+            _tracer.add(self.name, self.cat, self.start, end, self.args)
+        return False
+
+    def set(self, **args):
+        """ Adds arguments known once the block ran """
+        self.args.update(args)
+
+class _NoSpan():
+    """
+    Class that stands for a span while not tracing
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+    def set(self, **args):
+        pass
+
+_NO_SPAN = _NoSpan()
+
+# Returns a context manager recording the block as a span when tracing
+def span(name, cat='ubs', **args):
+    if _tracer is None:
+        return _NO_SPAN
+    return _Span(name, cat, args)
+
+# Records a span measured by the caller, i.e. a child process
+def add_span(name, cat, start, end, **args):
+    if _tracer is not None:
+        _tracer.add(name, cat, start, end, args)
+
+def is_tracing():
+    return _tracer is not None
+
+def start_tracing(path):
+    global _tracer
+    _tracer = Tracer(path)
+    return _tracer
+
+# Saves the events of a forked worker, no-op in the main process
+def flush_tracing():
+    if _tracer is not None:
+        _tracer.flush()
+
+# Writes the trace file, returns the number of events
+def stop_tracing():
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer.save() if tracer is not None else 0
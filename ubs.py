@@ -1,11 +1,9 @@
 #! /usr/bin/env python
 
+import sys
 import logging
 import argparse
-from create import create_project
-from compile import compile_project
-from package import package_project
-from launch import launch_project
+from client import send_request, run_on_daemon
 
 # Setting logger
 log = logging.getLogger(__name__)
@@ -18,24 +16,117 @@ sh.setFormatter(fmt)
 log.addHandler(sh)
 
 
-def parse_cmds():
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--create", help="Creates an Android project with given name")
-    parser.add_argument("--compile", help="Compiles a specific Android project")
-    parser.add_argument("--package", help="Generates an Android application for the given project")
+    parser.add_argument("--compile", nargs='*', metavar='COMPILE',
+                        help="Compiles the given Android projects")
+    parser.add_argument("--package", nargs='*', metavar='PACKAGE',
+                        help="Generates an Android application for the given projects")
     parser.add_argument("--launch", help="Launches an Android application on an active simulator")
-    args = parser.parse_args()
+    parser.add_argument("--devices", metavar='all|SERIAL,...',
+                        help="Devices to launch on: every attached one or the given serials (default: the emulator)")
+    parser.add_argument("--watch", metavar='PROJECT',
+                        help="Rebuilds the given Android project whenever it changes")
+    parser.add_argument("--watch-action", choices=['compile', 'package'], default='package',
+                        help="What --watch does on every change (default: package)")
+    parser.add_argument("--watch-launch", action='store_true',
+                        help="Launches the application after every --watch rebuild")
+    parser.add_argument("--all", action='store_true',
+                        help="Compiles/packages every project in the workspace")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="Number of projects built, javac shards compiled or devices launched on concurrently (default: number of CPUs, every device)")
+    parser.add_argument("--explain", action='store_true',
+                        help="Logs why each stage of --compile/--package runs or is up to date, with the inputs triggering it")
+    parser.add_argument("--dry-run", action='store_true',
+                        help="Explains what --compile/--package would run without running any tool nor storing fingerprints")
+    parser.add_argument("--cache-stats", action='store_true',
+                        help="Reports the usage of the artifact cache shared by the workspace")
+    parser.add_argument("--trace", metavar='FILE',
+                        help="Writes a Chrome trace (trace-event JSON) of the build to FILE")
+    parser.add_argument("--daemon", choices=['start', 'stop', 'status'],
+                        help="Starts, stops or queries the UBS build daemon")
+    parser.add_argument("--no-daemon", action='store_true',
+                        help="Runs in this process even if the UBS daemon is running")
+    return parser
+
+# Runs the parsed command line in this process, returns the exit status
+def run_cmds(args):
+    # Stage modules are imported here so daemon clients don't pay for them
+    from utils import BuildSetup
+    from create import create_project
+    from launch import launch_project
+    from workspace import ACTIONS, get_workspace_projects, \
+        build_projects, print_summary
 
     if args.create:
         create_project(name=args.create)
-    elif args.compile:
-        compile_project(name=args.compile)
-    elif args.package:
-        package_project(name=args.package)
+    elif args.compile is not None or args.package is not None:
+        action = 'compile' if args.compile is not None else 'package'
+        names = args.compile if args.compile is not None else args.package
+        if args.all:
+            names = get_workspace_projects(BuildSetup().get_workspace_path())
+        if not names:
+            log.warn('No projects to %s!' % (action))
+            return 1
+        options = {'explain': args.explain, 'dry_run': args.dry_run}
+        if len(names) == 1:
+            return 0 if ACTIONS[action](name=names[0], jobs=args.jobs, **options) else 1
+        results = build_projects(action, names, args.jobs, options)
+        return 0 if print_summary(action, results) else 1
     elif args.launch:
-        launch_project(name=args.launch)
-    else:
+        return 0 if launch_project(name=args.launch,
+                                   devices=args.devices,
+                                   jobs=args.jobs) else 1
+    elif args.watch:
+        from watcher import watch_project
+        return 0 if watch_project(name=args.watch,
+                                  action=args.watch_action,
+                                  launch=args.watch_launch) else 1
+    elif args.cache_stats:
+        from artifacts import print_cache_stats
+        return 0 if print_cache_stats() else 1
+    return 0
+
+# Runs the parsed command line recording a trace of the build
+def run_traced_cmds(args):
+    from tracing import span, start_tracing, stop_tracing
+    start_tracing(args.trace)
+    try:
+        with span('ubs', 'ubs', argv=' '.join(sys.argv[1:])):
+            rc = run_cmds(args)
+    finally:
+        log.info('Trace with %d events written to "%s"' % (stop_tracing(), args.trace))
+    return rc
+
+def parse_cmds():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    if args.daemon == 'start':
+        from daemon import start_daemon
+        return 0 if start_daemon() else 1
+    elif args.daemon:
+        rc = send_request({'cmd': args.daemon})
+        if rc is None:
+            log.info('UBS daemon is not running')
+            return 1 if args.daemon == 'status' else 0
+        return rc
+    if not (args.create or args.launch or args.watch or args.cache_stats or
+            args.compile is not None or args.package is not None):
         parser.print_help()
+        return 0
+    names = args.compile if args.compile is not None else args.package
+    if names is not None and not (names or args.all):
+        parser.error('--compile/--package require project names or --all')
+    # Watching is long running and traces are per process, both stay in this process
+    if not args.no_daemon and not args.watch and not args.trace:
+        rc = run_on_daemon(sys.argv[1:])
+        if rc is not None:
+            return rc
+    if args.trace:
+        return run_traced_cmds(args)
+    return run_cmds(args)
 
 if __name__ == '__main__':
-    parse_cmds()
\ No newline at end of file
+    sys.exit(parse_cmds())
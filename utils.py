@@ -3,15 +3,27 @@ Module that setups paths and environment variables
 """
 
 import os
+import sys
 import time
+import errno
 import shutil
 import hashlib
 import logging
+import threading
 import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from props import loadProperties
+from buildindex import get_build_index
+from fingerprint import get_file_fingerprint
+from tracing import span, add_span
+from workers import run_on_worker
 
 DEBUG=False
 
+# Serializes the read-modify-write of meta.info between concurrent stages
+_meta_info_lock = threading.RLock()
+
 # Setting logger
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
@@ -26,21 +38,67 @@ log.addHandler(sh)
 Utils
 """
 
+# Length kept by the kernel of a process name in /proc/<pid>/comm
+PROC_COMM_LEN = 15
+
+def _read_proc_file(fpath):
+    try:
+        with open(fpath, 'rb') as _f:
+            return _f.read()
+    except (IOError, OSError):
+        # The process exited meanwhile
+        return ''
+
+# Returns the pids of the processes named as given, scanning /proc where available
+def get_running_pids(proc_name=None):
+    if not proc_name:
+        return []
+    if not os.path.isdir('/proc/self'):
+        return _get_running_pids_from_ps(proc_name)
+    pids = []
+    for _pid in os.listdir('/proc'):
+        if not _pid.isdigit():
+            continue
+        comm = _read_proc_file('/proc/%s/comm' % (_pid)).strip()
+        argv0 = _read_proc_file('/proc/%s/cmdline' % (_pid)).split('\0')[0]
+        if comm == proc_name[:PROC_COMM_LEN] or os.path.basename(argv0) == proc_name:
+            pids.append(int(_pid))
+    return sorted(pids)
+
+# Returns when a process started in clock ticks since boot, None if unknown,
+# so a reused pid is told apart from the process that had it
+def get_process_start_time(pid=None):
+    stat = _read_proc_file('/proc/%s/stat' % (pid))
+    # Fields after the command name, which may contain spaces
+    fields = stat[stat.rfind(')') + 2:].split()
+    return int(fields[19]) if len(fields) > 19 and fields[19].isdigit() else None
+
+def _get_running_pids_from_ps(proc_name):
+    pids = []
+    try:
+        output = subprocess.Popen(['ps', '-Ao', 'pid=,comm='],
+                                  stdout=subprocess.PIPE).communicate()[0]
+    except OSError:
+        return pids
+    for _line in output.splitlines():
+        fields = _line.split(None, 1)
+        if len(fields) == 2 and os.path.basename(fields[1].strip()) == proc_name:
+            pids.append(int(fields[0]))
+    return sorted(pids)
+
 # get the number of running process for a given process name
 def get_num_of_running_procs(proc_name=None):
-    count = 0
-    if proc_name:
-        try:
-            tmp = os.popen("ps -Af").read()
-            count = tmp.count(proc_name)
-        except Exception:
-            pass
-    return count
+    return len(get_running_pids(proc_name))
 
 # Creates dir recursively
 def create_dir(dirpath=None):
     if dirpath and not os.path.exists(dirpath):
-        os.mkdir(dirpath)
+        try:
+            os.makedirs(dirpath)
+        except OSError:
+            # Created meanwhile by a concurrent stage
+            if not os.path.isdir(dirpath):
+                raise
 
 # Creates empty file
 def create_file(fpath=None):
@@ -60,41 +118,175 @@ def get_file_hash(fpath):
             hasher.update(buf)
         return hasher.hexdigest()
 
-# Hashing based on tt of modified file
-def get_file_hash2(fpath):
-    if os.path.exists(fpath):
-        return time.ctime(os.path.getmtime(fpath))
-    return ''
-
 def clean_up(dirpath=None):
     if dirpath and os.path.exists(dirpath):
         shutil.rmtree(dirpath)
 
-def execute_command(command, cwd=None, os_env=None):
-    if DEBUG:
-        print " ".join(command)
-    curdir = cwd if os.path.exists(cwd) else os.path.abspath(os.path.curdir)
+# Drains a pipe of the child process line by line into the logger
+def _stream_output(pipe, log_func, prefix):
+    try:
+        for line in iter(pipe.readline, ''):
+            log_func('%s: %s', prefix, line.rstrip('\r\n'))
+    finally:
+        pipe.close()
+
+# Waits for the child process, returns (exit status, resource usage or None)
+def _wait_child(cmd_run):
+    if not hasattr(os, 'wait4'):
+        return cmd_run.wait(), None
+    while True:
+        try:
+            pid, status, rusage = os.wait4(cmd_run.pid, 0)
+            break
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            # Already reaped
+            return cmd_run.wait(), None
+    if os.WIFSIGNALED(status):
+        cmd_run.returncode = -os.WTERMSIG(status)
+    else:
+        cmd_run.returncode = os.WEXITSTATUS(status)
+    return cmd_run.returncode, rusage
+
+# Runs a command, streaming its output to the logger as it arrives.
+# Blocks on the child (no busy polling) and kills it once timeout
+# (in seconds) expires. Returns the exit status of the command
+def run_command(command, cwd=None, os_env=None, timeout=None):
+    curdir = cwd if cwd and os.path.exists(cwd) else os.path.abspath(os.path.curdir)
     os_env = os_env if os_env else os.environ.copy()
+    tool = os.path.basename(command[0])
     if DEBUG:
         log.debug('executing command=%s', command)
-    cmd_run = subprocess.Popen(command,
-                               cwd=curdir,
-                               stdout=subprocess.PIPE,
-                               env=os_env)
-    while cmd_run.poll() is None:
-        if DEBUG:
-            if cmd_run.stdout:
-                for line in cmd_run.stdout.readlines():
-                    log.info('cmd: %s', line[:-1])
-            if cmd_run.returncode:
-                log.info("cmd returned: %d", cmd_run.returncode)
-                if cmd_run.returncode != 0:
-                   raise Exception("Executing command {} failed".format(command))
-        else:
-            pass
-    return cmd_run.returncode == 0 if cmd_run.returncode else True
-
-def get_files(dir, exts):
+    # javac, dx and jarsigner may run on a long-lived worker
+    returncode = run_on_worker(command, curdir, os_env, timeout)
+    if returncode is not None:
+        return returncode
+    start = time.time()
+    try:
+        cmd_run = subprocess.Popen(command,
+                                   cwd=curdir,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   env=os_env)
+    except OSError as e:
+        log.error('Unable to execute "%s": %s', tool, e)
+        return 127
+    readers = [threading.Thread(target=_stream_output,
+                                args=(cmd_run.stdout, log.debug, tool)),
+               threading.Thread(target=_stream_output,
+                                args=(cmd_run.stderr, log.warn, tool))]
+    for _r in readers:
+        _r.daemon = True
+        _r.start()
+    timed_out = []
+    timer = None
+    if timeout:
+        def _kill():
+            timed_out.append(True)
+            try:
+                cmd_run.kill()
+            except OSError:
+                pass
+        timer = threading.Timer(timeout, _kill)
+        timer.daemon = True
+        timer.start()
+    try:
+        returncode, rusage = _wait_child(cmd_run)
+    finally:
+        if timer:
+            timer.cancel()
+    for _r in readers:
+        _r.join()
+    if rusage is not None:
+        # Time and peak memory of the tool itself, apart from UBS bookkeeping
+        add_span(tool, 'command', start, time.time(),
+                 argv=' '.join(command),
+                 exit=returncode,
+                 user_ms=round(rusage.ru_utime * 1000, 3),
+                 sys_ms=round(rusage.ru_stime * 1000, 3),
+                 maxrss_kb=rusage.ru_maxrss / 1024 if sys.platform == 'darwin' \
+                     else rusage.ru_maxrss)
+    else:
+        add_span(tool, 'command', start, time.time(),
+                 argv=' '.join(command),
+                 exit=returncode)
+    if timed_out:
+        log.error('"%s" timed out after %s seconds', tool, timeout)
+    elif returncode != 0:
+        log.error('"%s" returned exit status %d', tool, returncode)
+    return returncode
+
+# Runs a command capturing its standard output, which is not logged.
+# Returns (exit status, output)
+def get_command_output(command, cwd=None, os_env=None, timeout=None):
+    curdir = cwd if cwd and os.path.exists(cwd) else os.path.abspath(os.path.curdir)
+    os_env = os_env if os_env else os.environ.copy()
+    tool = os.path.basename(command[0])
+    start = time.time()
+    try:
+        cmd_run = subprocess.Popen(command,
+                                   cwd=curdir,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   env=os_env)
+    except OSError as e:
+        log.error('Unable to execute "%s": %s', tool, e)
+        return 127, ''
+    timed_out = []
+    timer = None
+    if timeout:
+        def _kill():
+            timed_out.append(True)
+            try:
+                cmd_run.kill()
+            except OSError:
+                pass
+        timer = threading.Timer(timeout, _kill)
+        timer.daemon = True
+        timer.start()
+    try:
+        output, errors = cmd_run.communicate()
+    finally:
+        if timer:
+            timer.cancel()
+    if timed_out:
+        log.error('"%s" timed out after %s seconds', tool, timeout)
+    for _line in errors.splitlines():
+        log.warn('%s: %s', tool, _line)
+    add_span(tool, 'command', start, time.time(),
+             argv=' '.join(command),
+             exit=cmd_run.returncode)
+    return cmd_run.returncode, output
+
+# Runs a command, returns True if it exited successfully
+def execute_command(command, cwd=None, os_env=None, timeout=None):
+    return run_command(command,
+                       cwd=cwd,
+                       os_env=os_env,
+                       timeout=timeout) == 0
+
+# Runs several commands concurrently, at most jobs at the same time.
+# Returns True if every command exited successfully
+def run_commands(commands, cwd=None, os_env=None, timeout=None, jobs=None):
+    commands = list(commands)
+    jobs = jobs if jobs and jobs > 0 else multiprocessing.cpu_count()
+    if jobs <= 1 or len(commands) <= 1:
+        return all([run_command(_c, cwd, os_env, timeout) == 0 for _c in commands])
+    pool = ThreadPool(min(jobs, len(commands)))
+    try:
+        results = pool.map(lambda _c: run_command(_c, cwd, os_env, timeout),
+                           commands)
+    finally:
+        pool.close()
+        pool.join()
+    return all([_r == 0 for _r in results])
+
+# Returns the files under dir ending with any of the extensions,
+# answered from the snapshot when one is given
+def get_files(dir, exts, snapshot=None):
+    if snapshot is not None:
+        return snapshot.get_files(dir, exts)
     list_fs = []
     if dir and exts:
         for root, directories, filenames in os.walk(dir):
@@ -107,10 +299,12 @@ def get_files(dir, exts):
     return list_fs
 
 
-def check_files(dir=None, exts=None):
-    return True if len(get_files(dir, exts)) > 0 else False
+def check_files(dir=None, exts=None, snapshot=None):
+    return True if len(get_files(dir, exts, snapshot)) > 0 else False
 
-def find_file(dir=None, filename=None):
+def find_file(dir=None, filename=None, snapshot=None):
+    if snapshot is not None:
+        return snapshot.get_files(dir, [filename])
     found_files = []
     f_name, f_ext = os.path.splitext(filename)
     for _f in get_files(dir, [f_ext]):
@@ -118,29 +312,94 @@ def find_file(dir=None, filename=None):
             found_files.append(_f)
     return found_files
 
-# check if there is new or modified files in the given folder
-def check_if_new_or_modified_files(meta_info_path=None, dir=None, exts=None):
+# check if there is new or modified files in the given folder.
+# Fingerprints are kept per stage so stages don't update one another's state,
+# known ones ({path: fingerprint}) are taken in this build and spare hashing again.
+# Given pending ({path: fingerprint}), the new fingerprints are put in it rather
+# than stored, the removed inputs with None, so the stage stores them once it
+# succeeded. changed gets {path: (old fingerprint, new fingerprint)} of the
+# new/modified files, removed files are reported too with a None fingerprint
+def check_if_new_or_modified_files(meta_info_path=None, dir=None, exts=None, stage=None,
+                                   snapshot=None, known=None, pending=None, changed=None,
+                                   read_only=False):
     new_or_modified_files = []
     if meta_info_path and dir and exts:
-        list_files = get_files(dir, exts)
-        meta_info = loadProperties(meta_info_path)
-        for _fpath in list_files:
-            _f_hash = get_file_hash2(_fpath)
-            if (meta_info.has_key(_fpath) and meta_info[_fpath] != _f_hash) or \
-                    not meta_info.has_key(_fpath):
-                new_or_modified_files.append((_fpath,
-                                              'A' if not meta_info.has_key(_fpath) else 'M'))
-                # Update hash
-                meta_info[_fpath] = _f_hash
-        # save metadata to file
-        with open(meta_info_path, 'w') as _fmi:
-            meta_info.store(_fmi)
+        with _meta_info_lock:
+            with span('list files', 'scan', dir=dir) as sp:
+                list_files = get_files(dir, exts, snapshot)
+                sp.set(files=len(list_files))
+            index = get_build_index(meta_info_path, read_only)
+            with span('load fingerprints', 'meta', stage=stage):
+                old_fps = index.get_fingerprints(stage)
+            deltas = {}
+            with span('fingerprint', 'fingerprint', stage=stage, dir=dir) as sp:
+                checked = 0
+                for _fpath in list_files:
+                    _old_fp = old_fps.get(_fpath)
+                    if _old_fp is not None and snapshot is not None and \
+                            snapshot.is_unchanged(_fpath):
+                        continue
+                    checked += 1
+                    _f_fp, _modified = get_file_fingerprint(_fpath, _old_fp,
+                                                            known.get(_fpath) if known else None)
+                    if _modified:
+                        new_or_modified_files.append((_fpath,
+                                                      'A' if _old_fp is None else 'M'))
+                        if changed is not None:
+                            changed[_fpath] = (_old_fp, _f_fp)
+                    if _f_fp != _old_fp:
+                        # Update fingerprint
+                        deltas[_fpath] = _f_fp
+                sp.set(checked=checked, changed=len(new_or_modified_files))
+            # Inputs of this dir and extensions which are gone
+            prefix = os.path.join(dir, '')
+            removed = set([_f for _f in old_fps.keys()
+                           if _f.startswith(prefix) and
+                           [_e for _e in exts if _f.endswith(_e)]]) - set(list_files)
+            for _f in sorted(removed):
+                new_or_modified_files.append((_f, 'D'))
+                if changed is not None:
+                    changed[_f] = (old_fps[_f], None)
+            # store the changed fingerprints only
+            if pending is not None:
+                pending.update(deltas)
+                pending.update(dict([(_f, None) for _f in removed]))
+            else:
+                with span('store fingerprints', 'meta', stage=stage,
+                          updated=len(deltas), removed=len(removed)):
+                    index.update_fingerprints(stage, deltas, removed)
     print_new_modified_files(new_or_modified_files)
     return new_or_modified_files
 
+# Records the files produced by a stage
+def record_outputs(meta_info_path=None, stage=None, files=None):
+    if meta_info_path and files:
+        with _meta_info_lock:
+            get_build_index(meta_info_path).record_outputs(stage, files)
+
+# Returns the fingerprints recorded for a stage, i.e. what it last did
+def get_stage_record(meta_info_path=None, stage=None, read_only=False):
+    if meta_info_path and stage:
+        with _meta_info_lock:
+            return get_build_index(meta_info_path, read_only).get_fingerprints(stage)
+    return {}
+
+# Records fingerprints for a stage once it succeeded, forgetting the removed paths
+def update_stage_record(meta_info_path=None, stage=None, record=None, removed=None):
+    if meta_info_path and stage and (record or removed):
+        with _meta_info_lock:
+            get_build_index(meta_info_path).update_fingerprints(stage, record, removed)
+
+# Returns the stage that last produced the given file
+def get_producer(meta_info_path=None, fpath=None):
+    if meta_info_path and fpath:
+        with _meta_info_lock:
+            return get_build_index(meta_info_path).get_producer(fpath)
+    return None
+
 def print_new_modified_files(new_or_modified_files):
     if len(new_or_modified_files) > 0:
-        log.info('Following files are (A)dded or (M)odified:')
+        log.info('Following files are (A)dded, (M)odified or (D)eleted:')
         for _f, _t in new_or_modified_files:
             log.info('\t%s\t%s' % (_t, _f.split('/')[-1]))
 
@@ -150,8 +409,10 @@ class BuildSetup():
     """
     def __init__(self, *args, **kwargs):
         self.os_environ = os.environ.copy()
-        self._prop_file = os.path.join(os.path.dirname(__file__),
-                                       'setup.properties')
+        # UBS_SETUP_FILE points to another setup, i.e. a benchmark toolchain
+        self._prop_file = self.os_environ.get('UBS_SETUP_FILE') or \
+            os.path.join(os.path.dirname(__file__),
+                         'setup.properties')
         self._props = {}
         self._read_props()
 
@@ -168,7 +429,8 @@ class BuildSetup():
             log.warn('Build setup file not found! Running setup.sh script first')
             self._run_setup()
         if os.path.exists(self._prop_file):
-            self._props = loadProperties(self._prop_file)
+            with span('load setup', 'meta'):
+                self._props = loadProperties(self._prop_file)
 
     def save_key(self, key, value):
         if not self._props.has_key(key):
@@ -191,6 +453,60 @@ class BuildSetup():
     def get_workspace_path(self):
         return  self._get_key('workspace_path')
 
+    def get_cache_path(self):
+        # Cache shared by all projects of the workspace
+        cache_path = self._get_key('cache_path')
+        if not cache_path and self.get_workspace_path():
+            cache_path = os.path.join(self.get_workspace_path(), '.ubs-cache')
+        return cache_path
+
+    def get_artifact_cache_size(self):
+        # Byte budget of the artifact cache, i.e. "artifact_cache_size=512M", 0 disables it
+        size = self._get_key('artifact_cache_size')
+        if not size:
+            return None
+        units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+        try:
+            if size[-1].upper() in units:
+                return int(float(size[:-1]) * units[size[-1].upper()])
+            return int(size)
+        except ValueError:
+            log.warn('Invalid artifact cache size "%s", ignoring it' % (size))
+            return None
+
+    def get_workers(self):
+        # "workers=on" runs javac, dx and jarsigner on long-lived workers
+        return (self._get_key('workers') or '').lower() in ('on', 'true', 'yes', '1')
+
+    def get_worker_command(self, tool=None):
+        # Worker of a tool other than the Java one, i.e. "javac_worker=/path/to/worker javac"
+        return self._get_key('%s_worker' % (tool))
+
+    def get_worker_max_requests(self):
+        return self._get_int('worker_max_requests')
+
+    def get_worker_max_rss_growth(self):
+        # In MB
+        return self._get_int('worker_max_rss_growth')
+
+    def get_javac_shard_size(self):
+        # Fewest sources worth a javac of their own when compiling in shards
+        return self._get_int('javac_shard_size')
+
+    def _get_int(self, key):
+        value = self._get_key(key)
+        try:
+            return int(value) if value else None
+        except ValueError:
+            log.warn('Invalid %s "%s", ignoring it' % (key, value))
+            return None
+
+    def get_java_bin(self):
+        java_bin = self._get_key('java_bin')
+        if not java_bin and self._get_key('java_home'):
+            java_bin = os.path.join(self._get_key('java_home'), 'bin', 'java')
+        return java_bin
+
     def get_android_bin(self):
         return  self._get_key('android_bin')
 
@@ -251,6 +567,11 @@ class BuildSetup():
     def get_zipped_prefix(self):
         return self._get_key('zipped_prefix')
 
+    def get_packaging_mode(self):
+        # "tools" (aapt, jarsigner, zipalign) or "python" (in-process)
+        mode = self._get_key('packaging_mode')
+        return mode if mode else 'tools'
+
     def get_emulator_bin(self):
         return self._get_key('emulator_bin')
 
@@ -263,6 +584,15 @@ class BuildSetup():
     def get_activity_name(self):
         return self._get_key('activity_name')
 
+    def get_timeout(self, tool=None):
+        # Per-tool timeout in seconds, i.e. "javac_timeout=300"
+        timeout = self._get_key('%s_timeout' % (tool))
+        try:
+            return float(timeout) if timeout else None
+        except ValueError:
+            log.warn('Invalid timeout "%s" for %s, ignoring it' % (timeout, tool))
+            return None
+
 def setup():
     bs = BuildSetup()
 
@@ -0,0 +1,219 @@
+"""
+Module that watches a project with inotify and rebuilds it on every change
+"""
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+from snapshot import Snapshot
+from utils import BuildSetup
+
+# Setting logger
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+fmt = logging.Formatter(datefmt="%H:%M:%S",
+                        fmt='%(asctime)s %(levelname)-8s: %(name)s: %(message)s')
+sh = logging.StreamHandler()
+sh.setFormatter(fmt)
+log.addHandler(sh)
+
+# inotify events, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+IN_NONBLOCK = 0x00000800
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT_HEADER = struct.Struct('iIII')
+
+# Project dirs whose changes trigger a rebuild, and files at the project root
+WATCHED_DIRS = ['src', 'res', 'libs']
+WATCHED_FILES = ['AndroidManifest.xml']
+
+# A rebuild starts once no events arrived for this long (seconds)
+DEBOUNCE = 0.05
+
+class InotifyError(Exception):
+    pass
+
+class Inotify():
+    """
+    Class that wraps the inotify API of the linux kernel through ctypes
+    """
+    def __init__(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+        except (OSError, AttributeError):
+            raise InotifyError('inotify is not available on this system')
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            raise InotifyError(os.strerror(ctypes.get_errno()))
+        # {watch descriptor: watched path}
+        self.watches = {}
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            # Removed meanwhile
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            raise InotifyError('Can not watch "%s": %s' % (path, os.strerror(err)))
+        self.watches[wd] = path
+        return wd
+
+    def add_tree(self, dirpath):
+        """ Watches a directory and its subdirectories """
+        for _root, _dirs, _files in os.walk(dirpath):
+            self.add_watch(_root, WATCH_MASK | IN_ONLYDIR)
+
+    def wait(self, timeout=None):
+        """ Waits until events can be read, returns False on timeout """
+        return len(select.select([self.fd], [], [], timeout)[0]) > 0
+
+    def read_events(self):
+        """ Returns the pending events as (path, mask) """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return events
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip('\0')
+                offset += length
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                path = self.watches.get(wd)
+                if mask & IN_Q_OVERFLOW or path is None:
+                    events.append((None, mask))
+                else:
+                    events.append((os.path.join(path, name) if name else path, mask))
+
+    def close(self):
+        os.close(self.fd)
+
+class ProjectWatcher():
+    """
+    Class that rebuilds a project whenever its sources, resources, libraries or
+    manifest change, keeping the snapshot of the project between builds
+    """
+    def __init__(self, name=None, action=None, launch=False, debounce=DEBOUNCE):
+        self.project_name = name
+        self.action = action
+        self.launch = launch
+        self.debounce = debounce
+        self.project_path = os.path.join(BuildSetup().get_workspace_path(), name)
+        self.watched_dirs = [os.path.join(self.project_path, _d) for _d in WATCHED_DIRS]
+        self.watched_files = [os.path.join(self.project_path, _f) for _f in WATCHED_FILES]
+        self.snapshot = Snapshot(self.project_path)
+        self.inotify = None
+
+    def _start_watching(self):
+        self.inotify = Inotify()
+        # The project dir itself is watched for the manifest and new watched dirs
+        self.inotify.add_watch(self.project_path, WATCH_MASK | IN_ONLYDIR)
+        for _dir in self.watched_dirs:
+            if os.path.isdir(_dir):
+                self.inotify.add_tree(_dir)
+
+    def _is_watched(self, path):
+        return path in self.watched_files or \
+            [_d for _d in self.watched_dirs if path == _d or path.startswith(_d + os.sep)]
+
+    def _collect_changes(self):
+        """ Waits for a burst of events to settle, returns the changed paths or None if
+        the events were lost and everything must be checked """
+        changed = set()
+        self.inotify.wait()
+        while True:
+            for _path, _mask in self.inotify.read_events():
+                if _path is None:
+                    return None
+                if not self._is_watched(_path):
+                    continue
+                if _mask & IN_ISDIR and _mask & (IN_CREATE | IN_MOVED_TO):
+                    self.inotify.add_tree(_path)
+                changed.add(_path)
+            if not self.inotify.wait(self.debounce):
+                return changed
+
+    def _refresh(self, changed):
+        if changed is None:
+            self.snapshot.refresh()
+            return
+        for _dir in set([os.path.dirname(_p) for _p in changed]):
+            self.snapshot.refresh(_dir)
+
+    def _build(self):
+        # Imported here as workspace imports every stage
+        from workspace import ACTIONS
+        from launch import launch_project
+        start = time.time()
+        ok = ACTIONS[self.action](name=self.project_name, snapshot=self.snapshot)
+        if ok and self.launch:
+            ok = launch_project(name=self.project_name, snapshot=self.snapshot)
+        log.info('%s "%s" in %.2fs, waiting for changes...' % (
+            'Built' if ok else 'Failed to build', self.project_name, time.time() - start))
+        # Every change from now on is reported by inotify
+        self.snapshot.trust(self.watched_dirs)
+        return ok
+
+    def watch(self):
+        if not os.path.exists(self.project_path):
+            log.warn('Project "%s" does not exist in workspace!' % (self.project_name))
+            return False
+        try:
+            self._start_watching()
+        except InotifyError as e:
+            log.error('%s' % (e))
+            return False
+        log.info('Watching project "%s", press Ctrl+C to stop' % (self.project_name))
+        try:
+            self._build()
+            while True:
+                changed = self._collect_changes()
+                if changed is None:
+                    log.warn('Lost file events, checking the whole project')
+                elif not changed:
+                    continue
+                else:
+                    log.info('%d files changed' % (len(changed)))
+                self._refresh(changed)
+                self._build()
+        except KeyboardInterrupt:
+            log.info('Stopped watching project "%s"' % (self.project_name))
+        finally:
+            self.inotify.close()
+        return True
+
+def watch_project(*args, **kwargs):
+    w = ProjectWatcher(*args, **kwargs)
+    return w.watch()
@@ -0,0 +1,189 @@
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.EOFException;
+import java.io.IOException;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.io.PrintWriter;
+import java.lang.reflect.Field;
+import java.lang.reflect.Method;
+
+/**
+ * Long-lived worker running the requests of UBS for one tool (javac, dx or
+ * jarsigner) in the same JVM, sparing its startup and JIT warm-up.
+ *
+ * Every integer is a 32 bits big-endian one, every string UTF-8 bytes
+ * preceded by their length.
+ *
+ *   Handshake: int 0 once the tool is loaded (the worker exits otherwise)
+ *   Request:   int argc, argc strings (the arguments of the tool)
+ *   Response:  int exit status, string stdout, string stderr
+ *
+ * The worker exits when stdin is closed. Relative paths are resolved against
+ * the directory the worker was started in.
+ */
+public class UbsWorker {
+
+    interface Tool {
+        int run(String[] args, PrintStream out, PrintStream err) throws Exception;
+    }
+
+    // java.util.spi.ToolProvider (Java 9+), looked up by name through reflection
+    static Tool findToolProvider(String name) {
+        try {
+            Class<?> providers = Class.forName("java.util.spi.ToolProvider");
+            Object found = providers.getMethod("findFirst", String.class).invoke(null, name);
+            final Object provider = found.getClass().getMethod("orElse", Object.class).invoke(found, (Object) null);
+            if (provider == null) {
+                return null;
+            }
+            final Method run = providers.getMethod("run", PrintStream.class, PrintStream.class, String[].class);
+            return new Tool() {
+                public int run(String[] args, PrintStream out, PrintStream err) throws Exception {
+                    return (Integer) run.invoke(provider, out, err, args);
+                }
+            };
+        } catch (Exception e) {
+            return null;
+        }
+    }
+
+    static Tool javac() throws Exception {
+        Tool tool = findToolProvider("javac");
+        if (tool != null) {
+            return tool;
+        }
+        final javax.tools.JavaCompiler compiler = javax.tools.ToolProvider.getSystemJavaCompiler();
+        if (compiler == null) {
+            throw new IllegalStateException("No system java compiler");
+        }
+        return new Tool() {
+            public int run(String[] args, PrintStream out, PrintStream err) {
+                return compiler.run(null, out, err, args);
+            }
+        };
+    }
+
+    static Tool dx() throws Exception {
+        // Same as "dx --dex ...", without the System.exit() of its main
+        final Class<?> main = Class.forName("com.android.dx.command.dexer.Main");
+        final Class<?> arguments = Class.forName("com.android.dx.command.dexer.Main$Arguments");
+        final Method parse = arguments.getMethod("parse", String[].class);
+        final Method run = main.getMethod("run", arguments);
+        return new Tool() {
+            public int run(String[] args, PrintStream out, PrintStream err) throws Exception {
+                if (args.length == 0 || !"--dex".equals(args[0])) {
+                    throw new IllegalArgumentException("Only \"--dex\" is supported");
+                }
+                String[] rest = new String[args.length - 1];
+                System.arraycopy(args, 1, rest, 0, rest.length);
+                setConsole(out, err);
+                Object parsed = arguments.newInstance();
+                parse.invoke(parsed, (Object) rest);
+                return (Integer) run.invoke(null, parsed);
+            }
+        };
+    }
+
+    // dx keeps its own references to the console streams
+    static void setConsole(PrintStream out, PrintStream err) {
+        try {
+            Class<?> console = Class.forName("com.android.dx.command.DxConsole");
+            for (Field field : new Field[] { console.getField("out"), console.getField("err") }) {
+                field.set(null, field.getName().equals("out") ? out : err);
+            }
+        } catch (Exception e) {
+            // Newer dx versions have no DxConsole
+        }
+    }
+
+    static Tool jarsigner() throws Exception {
+        Tool tool = findToolProvider("jarsigner");
+        if (tool != null) {
+            return tool;
+        }
+        final Class<?> main = Class.forName("sun.security.tools.jarsigner.Main");
+        final Method run = main.getMethod("run", String[].class);
+        return new Tool() {
+            public int run(String[] args, PrintStream out, PrintStream err) throws Exception {
+                // Exits on failures, UBS then runs the request again on its own
+                run.invoke(main.newInstance(), (Object) args);
+                return 0;
+            }
+        };
+    }
+
+    static Tool load(String name) throws Exception {
+        if ("javac".equals(name)) {
+            return javac();
+        } else if ("dx".equals(name)) {
+            return dx();
+        } else if ("jarsigner".equals(name)) {
+            return jarsigner();
+        }
+        throw new IllegalArgumentException("Unknown tool \"" + name + "\"");
+    }
+
+    static String readString(DataInputStream in) throws IOException {
+        byte[] data = new byte[in.readInt()];
+        in.readFully(data);
+        return new String(data, "UTF-8");
+    }
+
+    static void writeBytes(DataOutputStream out, byte[] data) throws IOException {
+        out.writeInt(data.length);
+        out.write(data);
+    }
+
+    public static void main(String[] argv) throws Exception {
+        if (argv.length != 1) {
+            System.err.println("usage: UbsWorker javac|dx|jarsigner");
+            System.exit(2);
+        }
+        Tool tool = load(argv[0]);
+        DataInputStream in = new DataInputStream(System.in);
+        DataOutputStream out = new DataOutputStream(System.out);
+        // Nothing but responses goes to the real stdout
+        System.setOut(new PrintStream(new OutputStream() {
+            public void write(int b) {
+            }
+        }));
+        out.writeInt(0);
+        out.flush();
+        while (true) {
+            String[] args;
+            try {
+                args = new String[in.readInt()];
+            } catch (EOFException e) {
+                break;
+            }
+            for (int i = 0; i < args.length; i++) {
+                args[i] = readString(in);
+            }
+            ByteArrayOutputStream stdout = new ByteArrayOutputStream();
+            ByteArrayOutputStream stderr = new ByteArrayOutputStream();
+            PrintStream toolOut = new PrintStream(stdout, true, "UTF-8");
+            PrintStream toolErr = new PrintStream(stderr, true, "UTF-8");
+            PrintStream systemErr = System.err;
+            System.setOut(toolOut);
+            System.setErr(toolErr);
+            int status;
+            try {
+                status = tool.run(args, toolOut, toolErr);
+            } catch (Throwable t) {
+                Throwable cause = t.getCause() != null ? t.getCause() : t;
+                cause.printStackTrace(new PrintWriter(toolErr, true));
+                status = 1;
+            } finally {
+                System.setErr(systemErr);
+            }
+            toolOut.flush();
+            toolErr.flush();
+            out.writeInt(status);
+            writeBytes(out, stdout.toByteArray());
+            writeBytes(out, stderr.toByteArray());
+            out.flush();
+        }
+    }
+}
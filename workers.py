@@ -0,0 +1,378 @@
+"""
+Module that runs javac, dx and jarsigner on long-lived workers, sparing a JVM
+startup per command
+"""
+
+import os
+import time
+import shlex
+import atexit
+import signal
+import struct
+import hashlib
+import logging
+import threading
+import subprocess
+from tracing import add_span
+
+# Setting logger
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+fmt = logging.Formatter(datefmt="%H:%M:%S",
+                        fmt='%(asctime)s %(levelname)-8s: %(name)s: %(message)s')
+sh = logging.StreamHandler()
+sh.setFormatter(fmt)
+log.addHandler(sh)
+
+# Tools able to run on a worker
+WORKER_TOOLS = ['javac', 'dx', 'jarsigner']
+
+# Source of the Java worker, compiled on first use into the cache
+WORKER_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'worker', 'UbsWorker.java')
+WORKER_CLASS = 'UbsWorker'
+
+# A worker is recycled after this many requests...
+DEFAULT_MAX_REQUESTS = 100
+
+# ... or once its memory grew by this many MB since its first request
+DEFAULT_MAX_RSS_GROWTH = 512
+
+# Idle workers kept, the least recently used ones are stopped first
+MAX_IDLE_WORKERS = 8
+
+# Seconds a worker is given to start up
+STARTUP_TIMEOUT = 60
+
+_int = struct.Struct('>i')
+
+class WorkerError(Exception):
+    """
+    Class of the errors of a worker: it didn't start, died or broke the protocol
+    """
+    pass
+
+class WorkerTimeout(WorkerError):
+    """
+    Class of the error of a request which took longer than its timeout
+    """
+    pass
+
+def _read_exactly(stream, size):
+    data = ''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise WorkerError('Worker closed its output')
+        data += chunk
+    return data
+
+def _read_int(stream):
+    return _int.unpack(_read_exactly(stream, _int.size))[0]
+
+def _read_string(stream):
+    return _read_exactly(stream, _read_int(stream))
+
+# Returns the resident memory of a process in KB, None where unknown
+def get_rss_kb(pid):
+    try:
+        with open('/proc/%d/status' % (pid)) as _f:
+            for _line in _f:
+                if _line.startswith('VmRSS:'):
+                    return int(_line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+class Worker():
+    """
+    Class that speaks the framed protocol of worker/UbsWorker.java to a worker process:
+
+      handshake: int 0 once the tool is loaded
+      request:   int argc, argc strings
+      response:  int exit status, string stdout, string stderr
+
+    integers are 32 bits big-endian, strings UTF-8 bytes preceded by their length
+    """
+    def __init__(self, tool=None, command=None, cwd=None, os_env=None):
+        self.tool = tool
+        self.cwd = cwd
+        self.requests = 0
+        self.base_rss = None
+        self.used_at = time.time()
+        try:
+            self.proc = subprocess.Popen(command,
+                                         cwd=cwd,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE,
+                                         env=os_env)
+        except OSError as e:
+            raise WorkerError('Unable to start the %s worker: %s' % (tool, e))
+        # JVM warnings and the like
+        self._stderr = threading.Thread(target=self._drain_stderr)
+        self._stderr.daemon = True
+        self._stderr.start()
+        if self._call(lambda: _read_int(self.proc.stdout), STARTUP_TIMEOUT) != 0:
+            self.stop()
+            raise WorkerError('The %s worker failed its handshake' % (tool))
+
+    def _drain_stderr(self):
+        for _line in iter(self.proc.stderr.readline, ''):
+            log.debug('%s worker: %s', self.tool, _line.rstrip('\r\n'))
+
+    def _call(self, func, timeout=None):
+        # Runs func killing the worker once timeout expires
+        timed_out = []
+        timer = None
+        if timeout:
+            def _kill():
+                timed_out.append(True)
+                self.kill()
+            timer = threading.Timer(timeout, _kill)
+            timer.daemon = True
+            timer.start()
+        try:
+            return func()
+        except (IOError, OSError, WorkerError) as e:
+            if timed_out:
+                raise WorkerTimeout('The %s worker timed out after %s seconds' % (self.tool, timeout))
+            raise WorkerError('The %s worker died: %s' % (self.tool, e))
+        finally:
+            if timer:
+                timer.cancel()
+
+    def _request(self, args):
+        frame = [_int.pack(len(args))]
+        for _a in args:
+            data = _a.encode('utf-8') if isinstance(_a, unicode) else _a
+            frame.append(_int.pack(len(data)) + data)
+        self.proc.stdin.write(''.join(frame))
+        self.proc.stdin.flush()
+        return (_read_int(self.proc.stdout),
+                _read_string(self.proc.stdout),
+                _read_string(self.proc.stdout))
+
+    def run(self, args=None, timeout=None):
+        """ Runs the tool with the given arguments, returns (exit status, stdout, stderr) """
+        result = self._call(lambda: self._request(args), timeout)
+        self.requests += 1
+        self.used_at = time.time()
+        if self.base_rss is None:
+            # Measured once the tool is warmed up
+            self.base_rss = get_rss_kb(self.proc.pid)
+        return result
+
+    def get_rss_growth_kb(self):
+        rss = get_rss_kb(self.proc.pid)
+        if rss is None or self.base_rss is None:
+            return 0
+        return rss - self.base_rss
+
+    def kill(self):
+        try:
+            self.proc.kill()
+        except OSError:
+            pass
+
+    def stop(self):
+        # Closing stdin ends the worker, killed if it doesn't
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        timer = threading.Timer(5, self.kill)
+        timer.daemon = True
+        timer.start()
+        self.proc.wait()
+        timer.cancel()
+
+class WorkerPool():
+    """
+    Class that keeps workers per tool and working directory, starting them on
+    demand and recycling them after max_requests requests or once their memory
+    grew by max_rss_growth MB
+    """
+    def __init__(self, commands=None, max_requests=None, max_rss_growth=None):
+        # {tool binary: (tool, worker command)}
+        self.commands = commands if commands else {}
+        self.max_requests = max_requests if max_requests else DEFAULT_MAX_REQUESTS
+        self.max_rss_growth = max_rss_growth if max_rss_growth else DEFAULT_MAX_RSS_GROWTH
+        self._idle = []
+        self._broken = set()
+        self._lock = threading.Lock()
+
+    def _acquire(self, tool, command, cwd, os_env):
+        with self._lock:
+            for _w in self._idle:
+                if _w.tool == tool and _w.cwd == cwd:
+                    self._idle.remove(_w)
+                    return _w
+        log.debug('Starting a %s worker' % (tool))
+        return Worker(tool, command, cwd, os_env)
+
+    def _release(self, worker):
+        if worker.requests >= self.max_requests or \
+                worker.get_rss_growth_kb() > self.max_rss_growth * 1024:
+            log.debug('Recycling the %s worker after %d requests' % (worker.tool,
+                                                                    worker.requests))
+            worker.stop()
+            return
+        with self._lock:
+            self._idle.append(worker)
+            if len(self._idle) <= MAX_IDLE_WORKERS:
+                return
+            oldest = min(self._idle, key=lambda _w: _w.used_at)
+            self._idle.remove(oldest)
+        oldest.stop()
+
+    def run(self, command=None, cwd=None, os_env=None, timeout=None):
+        """ Returns (exit status, stdout, stderr) of the command run on a worker,
+        None when it has to be run on its own """
+        if not self.commands.has_key(command[0]):
+            return None
+        tool, worker_command = self.commands[command[0]]
+        if tool in self._broken:
+            return None
+        try:
+            worker = self._acquire(tool, worker_command, cwd, os_env)
+        except WorkerError as e:
+            # Not tried again in this session
+            log.warn('%s, running %s on its own' % (e, tool))
+            self._broken.add(tool)
+            return None
+        try:
+            result = worker.run(command[1:], timeout)
+        except WorkerTimeout as e:
+            log.error('%s' % (e))
+            worker.stop()
+            return -signal.SIGKILL, '', ''
+        except WorkerError as e:
+            # i.e. the tool called System.exit(), the command is run again on its own
+            log.debug('%s' % (e))
+            worker.stop()
+            return None
+        self._release(worker)
+        return result
+
+    def stop(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for _w in idle:
+            _w.stop()
+
+# Compiles worker/UbsWorker.java into the cache, returns its class path
+def build_worker_class(javac_bin=None, cache_path=None, os_env=None):
+    if not javac_bin or not cache_path or not os.path.exists(WORKER_SOURCE):
+        return None
+    with open(WORKER_SOURCE, 'rb') as _f:
+        digest = hashlib.sha1(_f.read()).hexdigest()
+    class_path = os.path.join(cache_path, 'worker', digest)
+    if os.path.exists(os.path.join(class_path, '%s.class' % (WORKER_CLASS))):
+        return class_path
+    tmp = '%s.%d.tmp' % (class_path, os.getpid())
+    if not os.path.isdir(tmp):
+        os.makedirs(tmp)
+    with open(os.devnull, 'w') as devnull:
+        rc = subprocess.call([javac_bin, '-nowarn', '-d', tmp, WORKER_SOURCE],
+                             stdout=devnull, stderr=devnull, env=os_env)
+    if rc != 0:
+        log.warn('Unable to compile the JVM worker, tools run on their own')
+        return None
+    try:
+        os.rename(tmp, class_path)
+    except OSError:
+        # Compiled meanwhile by another build
+        pass
+    return class_path
+
+# Returns the worker command of each tool: "<tool>_worker" of setup.properties
+# or the Java worker run by java_bin
+def get_worker_commands(bs=None):
+    commands = {}
+    class_path = None
+    tool_bins = {'javac': bs.get_javac_bin(),
+                 'dx': bs.get_dx_bin(),
+                 'jarsigner': bs.get_jarsigner_bin()}
+    for _tool in WORKER_TOOLS:
+        tool_bin = tool_bins[_tool]
+        if not tool_bin:
+            continue
+        if bs.get_worker_command(_tool):
+            commands[tool_bin] = (_tool, shlex.split(bs.get_worker_command(_tool)))
+            continue
+        if not bs.get_java_bin():
+            continue
+        if class_path is None:
+            class_path = build_worker_class(bs.get_javac_bin(), bs.get_cache_path(),
+                                            bs.get_os_environ()) or False
+        if not class_path:
+            # The next tools may still have their own worker command
+            continue
+        jars = [class_path]
+        # dx.jar, and tools.jar of Java 8 for javac and jarsigner
+        if _tool == 'dx':
+            jars.append(os.path.join(os.path.dirname(tool_bin), 'lib', 'dx.jar'))
+        elif bs.get_java_home() and \
+                os.path.exists(os.path.join(bs.get_java_home(), 'lib', 'tools.jar')):
+            jars.append(os.path.join(bs.get_java_home(), 'lib', 'tools.jar'))
+        commands[tool_bin] = (_tool, [bs.get_java_bin(), '-cp', os.pathsep.join(jars),
+                                      WORKER_CLASS, _tool])
+    return commands
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+# Returns the worker pool of this process, None unless "workers=on" is set up
+def get_worker_pool():
+    global _pool, _pool_pid
+    with _pool_lock:
+        # Workers of the parent of a forked build are left to the parent
+        if _pool_pid != os.getpid():
+            _pool = None
+            _pool_pid = os.getpid()
+        if _pool is None:
+            from utils import BuildSetup
+            bs = BuildSetup()
+            if not bs.get_workers():
+                _pool = False
+            else:
+                _pool = WorkerPool(get_worker_commands(bs),
+                                   bs.get_worker_max_requests(),
+                                   bs.get_worker_max_rss_growth())
+        return _pool if _pool else None
+
+# Runs the command on a worker logging its output, returns its exit status or
+# None when it has to be run on its own
+def run_on_worker(command, cwd=None, os_env=None, timeout=None):
+    pool = get_worker_pool()
+    if pool is None:
+        return None
+    start = time.time()
+    result = pool.run(command, cwd, os_env, timeout)
+    if result is None:
+        return None
+    returncode, out, err = result
+    tool = os.path.basename(command[0])
+    for _line in out.splitlines():
+        log.debug('%s: %s', tool, _line)
+    for _line in err.splitlines():
+        log.warn('%s: %s', tool, _line)
+    add_span(tool, 'command', start, time.time(),
+             argv=' '.join(command),
+             exit=returncode,
+             worker=True)
+    return returncode
+
+# Stops the workers of this process
+def stop_workers():
+    global _pool
+    with _pool_lock:
+        if _pool and _pool_pid == os.getpid():
+            _pool.stop()
+        _pool = None
+
+# Workers don't outlive the process that started them
+atexit.register(stop_workers)
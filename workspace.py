@@ -0,0 +1,95 @@
+"""
+Module that builds several projects of the workspace concurrently
+"""
+
+import os
+import time
+import logging
+import traceback
+import multiprocessing
+from utils import BuildSetup
+from artifacts import close_caches
+from buildindex import close_indexes
+from tracing import span, flush_tracing
+from compile import compile_project
+from package import package_project
+
+# Setting logger
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+fmt = logging.Formatter(datefmt="%H:%M:%S",
+                        fmt='%(asctime)s %(levelname)-8s: %(name)s: %(message)s')
+sh = logging.StreamHandler()
+sh.setFormatter(fmt)
+log.addHandler(sh)
+
+ACTIONS = {
+    'compile': compile_project,
+    'package': package_project,
+}
+
+# Returns the name of every android project in the workspace
+def get_workspace_projects(workspace_path=None):
+    projects = []
+    if workspace_path and os.path.isdir(workspace_path):
+        for _name in sorted(os.listdir(workspace_path)):
+            if os.path.isfile(os.path.join(workspace_path, _name,
+                                           'AndroidManifest.xml')):
+                projects.append(_name)
+    return projects
+
+# Builds a single project, never raises so one failure doesn't abort others
+def build_project(action, name, options=None):
+    start = time.time()
+    error = None
+    try:
+        with span('%s %s' % (action, name), 'project'):
+            ok = True if ACTIONS[action](name=name, **(options if options else {})) else False
+    except Exception as e:
+        log.debug(traceback.format_exc())
+        ok = False
+        error = str(e)
+    # Forked workers hand their trace events over to the main process
+    flush_tracing()
+    return (name, ok, time.time() - start, error)
+
+def _build_project_star(args):
+    return build_project(*args)
+
+# Builds the given projects, at most jobs at the same time, options are given
+# to every build (i.e. explain). Returns a list of (name, ok, elapsed, error)
+def build_projects(action=None, names=None, jobs=None, options=None):
+    names = names if names else []
+    jobs = jobs if jobs and jobs > 0 else multiprocessing.cpu_count()
+    jobs = min(jobs, len(names))
+    # Each build gets its share of the CPUs for its javac shards and crunching
+    options = dict(options if options else {})
+    options['jobs'] = max(1, multiprocessing.cpu_count() // max(1, jobs))
+    if jobs <= 1:
+        return [build_project(action, _n, options) for _n in names]
+    # Read setup once, forked workers inherit the parsed properties
+    BuildSetup()
+    # SQLite connections must not be shared with the forked workers,
+    # each of them opens its own
+    close_indexes()
+    close_caches()
+    pool = multiprocessing.Pool(processes=jobs)
+    try:
+        return pool.map(_build_project_star,
+                        [(action, _n, options) for _n in names],
+                        chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def print_summary(action, results):
+    log.info('Summary of %s:' % (action))
+    for name, ok, elapsed, error in results:
+        log.info('\t%-8s %7.2fs\t%s%s' % ('OK' if ok else 'FAILED',
+                                          elapsed,
+                                          name,
+                                          ' (%s)' % (error) if error else ''))
+    failed = len([_r for _r in results if not _r[1]])
+    log.info('%d succeeded, %d failed' % (len(results) - failed, failed))
+    return failed == 0